@@ -2,22 +2,30 @@
 # Copyright (c) 2019-2024 Roke Manor Research Ltd
 #
 
+import asyncio
+import json
 from datetime import datetime, timedelta
 from importlib.metadata import metadata
-from typing import Optional
+from typing import Any, Callable, Hashable, Optional
 
-from fastapi import APIRouter, HTTPException, Query, status
+from fastapi import APIRouter, HTTPException, Query, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
 
 from sapient_apex_api.interface.base_interface import BaseInterface
 from sapient_apex_api.response_models import (
     AssociatedFilesResponse,
+    DetectionPageResponse,
     DetectionResponse,
     DetectionSource,
     NodeDefinitionResponse,
     NodeFieldOfViewResponse,
     NodeLocationResponse,
+    ResponseCacheMetricsResponse,
     RootResponse,
+    StreamMessageType,
 )
+from sapient_apex_api.response_cache import ResponseCache
+from sapient_apex_api.streaming import MessageBroadcaster, StreamFilter
 
 # Re-usable User Hints for parameters
 node_ids_query = Query(
@@ -51,16 +59,45 @@ detection_interval_query = Query(
 detection_count_query = Query(
     default=10, description="Number of Detections to obtain for a node_id"
 )
+detection_page_size_query = Query(
+    default=1000, gt=0, le=10000, description="Number of Detections searched per page"
+)
+detection_cursor_query = Query(
+    default=None,
+    description="Cursor from the previous page, absent for the first page",
+)
+stream_message_types_query = Query(
+    default=list(StreamMessageType),
+    description="Types of message to stream",
+)
+stream_confidence_query = Query(
+    default=0.0,
+    description="Streamed Detection's Confidence (At or above this value)",
+)
 
 
 class APIRouterDB(APIRouter):
     def __init__(self):
         super().__init__()
         self.db_interface: Optional[BaseInterface] = None
+        self.broadcaster: Optional[MessageBroadcaster] = None
+        self.response_cache: Optional[ResponseCache] = None
 
     def set_db_interface(self, db_interface: BaseInterface) -> None:
         self.db_interface = db_interface
 
+    def set_broadcaster(self, broadcaster: MessageBroadcaster) -> None:
+        self.broadcaster = broadcaster
+
+    def set_response_cache(self, response_cache: ResponseCache) -> None:
+        self.response_cache = response_cache
+
+    def cached(self, key: Hashable, node_ids: list[str], compute: Callable[[], Any]) -> Any:
+        """Returns the response from the cache (if enabled), otherwise computes it."""
+        if self.response_cache is None:
+            return compute()
+        return self.response_cache.get(key, node_ids, compute)
+
 
 router = APIRouterDB()
 
@@ -92,7 +129,7 @@ async def get_registered_node_ids() -> list[str]:
             detail="Database Service Unavailable or not started.",
         )
 
-    node_ids = router.db_interface.get_registered_node_ids()
+    node_ids = router.cached(("registered",), ["all"], router.db_interface.get_registered_node_ids)
     if len(node_ids) == 0:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -124,7 +161,11 @@ async def get_locations(
             detail="Database Service Unavailable or not started.",
         )
 
-    locations = router.db_interface.get_locations(node_ids=node_ids)
+    locations = router.cached(
+        ("locations", tuple(node_ids)),
+        node_ids,
+        lambda: router.db_interface.get_locations(node_ids=node_ids),
+    )
 
     if "all" not in node_ids and len(locations) == 0:
         raise HTTPException(
@@ -157,7 +198,11 @@ async def get_field_of_views(
             detail="Database Service Unavailable or not started.",
         )
 
-    field_of_views = router.db_interface.get_field_of_views(node_ids=node_ids)
+    field_of_views = router.cached(
+        ("field_of_views", tuple(node_ids)),
+        node_ids,
+        lambda: router.db_interface.get_field_of_views(node_ids=node_ids),
+    )
     if "all" not in node_ids and len(field_of_views) == 0:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -204,6 +249,94 @@ async def get_detections(
     return detections
 
 
+@router.get(
+    "/detections/page",
+    status_code=status.HTTP_200_OK,
+    responses={
+        status.HTTP_503_SERVICE_UNAVAILABLE: {"detail": ""},
+        status.HTTP_400_BAD_REQUEST: {"detail": ""},
+    },
+)
+async def get_detection_page(
+    node_ids: list[str] = node_ids_query,
+    detection_source: DetectionSource = detection_source_query,
+    detection_confidence: float = detection_confidence_query,
+    detection_classification: str = detection_classification_query,
+    detection_from: datetime = detection_from_query,
+    detection_to: datetime = detection_to_query,
+    page_size: int = detection_page_size_query,
+    cursor: Optional[str] = detection_cursor_query,
+) -> DetectionPageResponse:
+    """
+    Returns a page of detections in time order, for retrieving large numbers of detections.
+    Pass the returned next_cursor to get the following page. Pages may have fewer detections
+    than page_size (even none) when detections are filtered on their contents.
+    """
+    if router.db_interface is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Database Service Unavailable or not started.",
+        )
+
+    try:
+        detections, next_cursor = router.db_interface.get_detection_page(
+            node_ids=node_ids,
+            detection_source=detection_source,
+            detection_confidence=detection_confidence,
+            detection_classification=detection_classification,
+            detection_from=detection_from,
+            detection_to=detection_to,
+            page_size=page_size,
+            cursor=cursor,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    return DetectionPageResponse(detections=detections, next_cursor=next_cursor)
+
+
+@router.get(
+    "/detections/export",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+    responses={
+        status.HTTP_503_SERVICE_UNAVAILABLE: {"detail": ""},
+    },
+)
+async def export_detections(
+    node_ids: list[str] = node_ids_query,
+    detection_source: DetectionSource = detection_source_query,
+    detection_confidence: float = detection_confidence_query,
+    detection_classification: str = detection_classification_query,
+    detection_from: datetime = detection_from_query,
+    detection_to: datetime = detection_to_query,
+    page_size: int = detection_page_size_query,
+):
+    """
+    Streams all matching detections in time order as newline delimited JSON (one
+    DetectionResponse per line). Detections are read from the database a page at a time, as the
+    client reads them.
+    """
+    if router.db_interface is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Database Service Unavailable or not started.",
+        )
+
+    detections = router.db_interface.iter_detections(
+        node_ids=node_ids,
+        detection_source=detection_source,
+        detection_confidence=detection_confidence,
+        detection_classification=detection_classification,
+        detection_from=detection_from,
+        detection_to=detection_to,
+        page_size=page_size,
+    )
+    # A plain (not async) generator, so it is run in a worker thread by the StreamingResponse
+    lines = (detection.model_dump_json() + "\n" for detection in detections)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+
 @router.get(
     "/detections/locations",
     status_code=status.HTTP_200_OK,
@@ -296,4 +429,103 @@ async def get_node_definitions() -> list[NodeDefinitionResponse]:
             detail="Database Service Unavailable or not started.",
         )
 
-    return router.db_interface.get_node_definitions()
+    return router.cached(("node_definitions",), ["all"], router.db_interface.get_node_definitions)
+
+
+@router.get(
+    "/cache",
+    status_code=status.HTTP_200_OK,
+    responses={
+        status.HTTP_503_SERVICE_UNAVAILABLE: {"detail": ""},
+    },
+)
+async def get_response_cache_metrics() -> ResponseCacheMetricsResponse:
+    """
+    Hit and miss counts of the response cache used for the registration and status endpoints.
+    """
+    if router.response_cache is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Response Cache disabled or not started.",
+        )
+
+    return ResponseCacheMetricsResponse(
+        hits=router.response_cache.hits,
+        misses=router.response_cache.misses,
+        invalidations=router.response_cache.invalidations,
+        entries=len(router.response_cache.entries),
+    )
+
+
+@router.websocket("/stream")
+async def stream_websocket(
+    websocket: WebSocket,
+    node_ids: list[str] = node_ids_query,
+    message_types: list[StreamMessageType] = stream_message_types_query,
+    detection_confidence: float = stream_confidence_query,
+):
+    """
+    Streams detections, alerts and status changes as JSON messages as soon as Apex receives them.
+    """
+    if router.broadcaster is None:
+        await websocket.close(reason="Message Stream Unavailable or not started.")
+        return
+
+    await websocket.accept()
+    subscriber = router.broadcaster.subscribe(
+        StreamFilter(node_ids, message_types, detection_confidence)
+    )
+
+    async def send_messages():
+        while True:
+            await websocket.send_json(await subscriber.get())
+
+    # Keep reading too, so that a disconnect is noticed even if there is nothing to send
+    sender = asyncio.create_task(send_messages())
+    try:
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        router.broadcaster.unsubscribe(subscriber)
+
+
+@router.get(
+    "/stream/events",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+    responses={
+        status.HTTP_503_SERVICE_UNAVAILABLE: {"detail": ""},
+    },
+)
+async def stream_events(
+    node_ids: list[str] = node_ids_query,
+    message_types: list[StreamMessageType] = stream_message_types_query,
+    detection_confidence: float = stream_confidence_query,
+):
+    """
+    Streams detections, alerts and status changes as Server-Sent Events as soon as Apex receives
+    them.
+    """
+    if router.broadcaster is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Message Stream Unavailable or not started.",
+        )
+
+    broadcaster = router.broadcaster
+
+    async def events():
+        subscriber = broadcaster.subscribe(
+            StreamFilter(node_ids, message_types, detection_confidence)
+        )
+        try:
+            while True:
+                document = await subscriber.get()
+                yield f"event: {document['message_type']}\ndata: {json.dumps(document)}\n\n"
+        finally:
+            broadcaster.unsubscribe(subscriber)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
@@ -2,21 +2,92 @@
 # Copyright (c) 2019-2024 Roke Manor Research Ltd
 #
 
+import base64
+import binascii
+import json
 from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
-from typing import Any, Dict, Iterable, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 
 from sapient_apex_api.response_models import (
+    AssociatedFile,
     AssociatedFilesResponse,
     DetectionResponse,
     DetectionSource,
+)
+from sapient_apex_api.response_models import Location as LocationResponse
+from sapient_apex_api.response_models import (
+    LocationOrRangeBearing as LocationOrRangeBearingResponse,
+)
+from sapient_apex_api.response_models import (
+    NodeDefinition,
     NodeDefinitionResponse,
     NodeFieldOfViewResponse,
     NodeLocationResponse,
 )
+from sapient_apex_api.response_protos import setattr_all
+
+
+def is_detection_report_wanted(
+    detection_report_message: dict,
+    detection_source: DetectionSource,
+    detection_confidence: float,
+    detection_classification: str,
+) -> bool:
+    """Applies the detection filters that cannot be expressed as a database query.
+
+    Args:
+        detection_report_message (dict): The detection report contents (JSON representation)
+        detection_source (DetectionSource): Source of detection.
+        detection_confidence (float): confidence value to filter on (above)
+        detection_classification (str): classification
+
+    Returns:
+        bool: Whether the detection report passes all the filters
+    """
+    append_message = (
+        float(detection_report_message.get("detection_confidence", -1)) > detection_confidence
+    )
+    append_message &= (not detection_classification) or any(
+        detection_classification in classification.get("type", [])
+        for classification in detection_report_message.get("classification", {})
+    )
+
+    # If used by a fusion node, the “associated_detection” field shall represent a
+    # list of individual sensor edge node detections that were used to
+    # generate a fused detection.
+    # So we will use this to determine if a particular detection report is
+    # from a edge or fusion node.
+
+    associated_detection = detection_report_message.get("associated_detection", [])
+    if detection_source == DetectionSource.fused and not associated_detection:
+        append_message = False  # Looking for fused, but this is a sensor detection
+    elif detection_source == DetectionSource.edge and associated_detection:
+        append_message = False  # Looking for edge, but found a fused detection
+
+    return append_message
+
+
+def encode_cursor(state: Any) -> str:
+    """Encodes the position of a paged query as an opaque string for the client."""
+    return base64.urlsafe_b64encode(json.dumps(state).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Any:
+    """Decodes a cursor from encode_cursor. Raises ValueError if it is invalid."""
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor")
 
 
 class BaseInterface(ABC):
+    """Base class for the database implementations used by the REST API.
+
+    Derived classes implement the low level queries (latest registrations, latest status report and
+    recent detection reports of a node); the endpoint level queries are built on top of those here.
+    """
+
     @abstractmethod
     def insert_into(
         self,
@@ -44,18 +115,170 @@ class BaseInterface(ABC):
         pass
 
     @abstractmethod
-    def get_registered_node_ids() -> list[str]:
+    def get_latest_registration_messages(self, **kwargs) -> list:
+        """Returns the most recent registration message document for each node."""
         pass
 
     @abstractmethod
-    def get_locations(self, node_ids: list[str]) -> list[NodeLocationResponse]:
+    def get_latest_status_report_message(self, node_id: str) -> tuple[str, str, dict[str, Any]]:
+        """Returns the node ID, timestamp and contents of the latest status report of a node."""
         pass
 
     @abstractmethod
-    def get_field_of_views(self, node_ids: list[str]) -> list[NodeFieldOfViewResponse]:
+    def get_detection_reports(
+        self,
+        node_id: str,
+        detection_source: DetectionSource,
+        detection_confidence: float,
+        detection_classification: str,
+        detection_from: datetime,
+        detection_to: datetime,
+        detection_interval: timedelta,
+        detection_count: int,
+    ) -> (str, str, List[Dict[str, Any]]):
+        """Returns the node ID, timestamp and contents of recent detection reports of a node."""
         pass
 
     @abstractmethod
+    def get_detection_page(
+        self,
+        node_ids: list[str],
+        detection_source: DetectionSource,
+        detection_confidence: float,
+        detection_classification: str,
+        detection_from: datetime,
+        detection_to: datetime,
+        page_size: int,
+        cursor: Optional[str] = None,
+    ) -> tuple[list[DetectionResponse], Optional[str]]:
+        """Returns a page of detections in time order, and the cursor for the next page.
+
+        Unlike get_detections, the number of detections is not limited, so this is suitable for
+        large historical queries. The filters on detection contents are applied after paging, so
+        a page can have fewer than page_size detections even if there are more pages. The cursor
+        is None for the last page. Raises ValueError if the cursor is invalid or has expired.
+        """
+        pass
+
+    def iter_detections(
+        self,
+        node_ids: list[str],
+        detection_source: DetectionSource,
+        detection_confidence: float,
+        detection_classification: str,
+        detection_from: datetime,
+        detection_to: datetime,
+        page_size: int,
+    ) -> Iterator[DetectionResponse]:
+        """Yields all the matching detections in time order, a page at a time."""
+        cursor = None
+        while True:
+            detections, cursor = self.get_detection_page(
+                node_ids=node_ids,
+                detection_source=detection_source,
+                detection_confidence=detection_confidence,
+                detection_classification=detection_classification,
+                detection_from=detection_from,
+                detection_to=detection_to,
+                page_size=page_size,
+                cursor=cursor,
+            )
+            yield from detections
+            if cursor is None:
+                return
+
+    def get_registered_node_ids(self) -> list[str]:
+        return [r["node_id"] for r in self.get_latest_registration_messages()]
+
+    def get_node_definitions(self, **kwargs) -> list[NodeDefinitionResponse]:
+        return [
+            NodeDefinitionResponse(
+                node_id=r["node_id"],
+                timestamp=r["timestamp"],
+                node_definition=[
+                    NodeDefinition(**definition) for definition in r["message"]["node_definition"]
+                ],
+            )
+            for r in self.get_latest_registration_messages(**kwargs)
+        ]
+
+    def get_locations(self, node_ids: list[str]) -> list[NodeLocationResponse]:
+        """Get the (list of) NodeLocationResponse
+
+        Args:
+            node_ids (list[str]): The node_ids, defaults to empty list/all nodes.
+
+        Returns:
+            list[NodeLocationResponse]: NodeLocationResponse
+        """
+
+        # Run two types of searches on the database
+        # 1. Search all registration messages to get the node_ids & store unique values.
+        # 2. Use these node_ids to search for the latest status_report for each.
+        # and populate the NodeLocationResponse list
+
+        registered_node_ids = (
+            self.get_registered_node_ids() if node_ids and "all" in node_ids else node_ids
+        )
+
+        node_locations: list[NodeLocationResponse] = []
+        for node_id in registered_node_ids:
+            full_node_id, timestamp, status_report_message = self.get_latest_status_report_message(
+                node_id=node_id
+            )
+
+            if "node_location" in status_report_message:
+                node_location = LocationResponse()
+                setattr_all(node_location, status_report_message["node_location"])
+
+                node_locations.append(
+                    NodeLocationResponse(
+                        node_id=full_node_id,
+                        timestamp=timestamp,
+                        node_location=node_location,
+                    ),
+                )
+
+        return node_locations
+
+    def get_field_of_views(self, node_ids: list[str]) -> list[NodeFieldOfViewResponse]:
+        """Get the (list of) NodeFieldOfViewResponse
+
+        Args:
+            node_ids (list[str]): The node_ids, defaults to empty list/all nodes.
+
+        Returns:
+            list[NodeFieldOfViewResponse]: NodeFieldOfViewResponse
+        """
+
+        # Run two types of searches on the database
+        # 1. Search all registration messages to get the node_ids & store unique values.
+        # 2. Use these node_ids to search for the latest status_report for each.
+        # and populate the NodeLocationResponse list
+
+        registered_node_ids = (
+            self.get_registered_node_ids() if node_ids and "all" in node_ids else node_ids
+        )
+        node_field_of_views: list[NodeFieldOfViewResponse] = []
+        for node_id in registered_node_ids:
+            full_node_id, timestamp, status_report_message = self.get_latest_status_report_message(
+                node_id=node_id,
+            )
+
+            if "field_of_view" in status_report_message:
+                node_field_of_view = LocationOrRangeBearingResponse()
+                setattr_all(node_field_of_view, status_report_message["field_of_view"])
+
+                node_field_of_views.append(
+                    NodeFieldOfViewResponse(
+                        node_id=full_node_id,
+                        timestamp=timestamp,
+                        field_of_view=node_field_of_view,
+                    ),
+                )
+
+        return node_field_of_views
+
     def get_detections(
         self,
         node_ids: list[str],
@@ -67,9 +290,50 @@ class BaseInterface(ABC):
         detection_interval: timedelta,
         detection_count: int,
     ) -> list[DetectionResponse]:
-        pass
+        """Gets (a list of) detections.
+
+        Args:
+            node_ids (list[str]): The node_ids, defaults to empty list/all nodes.
+            detection_source (DetectionSource): Source of detection.
+            detection_confidence (float): confidence value to filter on (above)
+            detection_classification (str): classification
+            detection_from (datetime): from timestamp
+            detection_to (datetime): to timestamp
+            detection_interval (timedelta): delta time from current
+            detection_count (int): number of messages to retrieve per node_id
+
+        Returns:
+            list[DetectionResponse]: DetectionResponse
+        """
+
+        registered_node_ids = (
+            self.get_registered_node_ids() if node_ids and "all" in node_ids else node_ids
+        )
+
+        detection_reponses: list[DetectionResponse] = []
+        for node_id in registered_node_ids:
+            full_node_id, timestamp, detection_report_messages = self.get_detection_reports(
+                node_id=node_id,
+                detection_source=detection_source,
+                detection_confidence=detection_confidence,
+                detection_classification=detection_classification,
+                detection_from=detection_from,
+                detection_to=detection_to,
+                detection_interval=detection_interval,
+                detection_count=detection_count,
+            )
+
+            for detection_report_message in detection_report_messages:
+                detection_reponses.append(
+                    DetectionResponse(
+                        node_id=full_node_id,
+                        timestamp=timestamp,
+                        detection_report=detection_report_message,
+                    ),
+                )
+
+        return detection_reponses
 
-    @abstractmethod
     def get_detections_locations(
         self,
         node_ids: list[str],
@@ -81,13 +345,53 @@ class BaseInterface(ABC):
         detection_interval: timedelta,
         detection_count: int,
     ) -> list[NodeLocationResponse]:
-        pass
+        """Gets (a list of) locations for detections.
 
-    @abstractmethod
-    def get_node_definitions(self) -> list[NodeDefinitionResponse]:
-        pass
+        Args:
+            node_ids (list[str]): The node_ids, defaults to empty list/all nodes.
+            detection_source (DetectionSource): Source of detection.
+            detection_confidence (float): confidence value to filter on (above)
+            detection_classification (str): classification
+            detection_from (datetime): from timestamp
+            detection_to (datetime): to timestamp
+            detection_interval (timedelta): delta time from current
+            detection_count (int): number of messages to retrieve per node_id
+
+        Returns:
+            list[NodeLocationResponse]: NodeLocationResponse
+        """
+        registered_node_ids = (
+            self.get_registered_node_ids() if node_ids and "all" in node_ids else node_ids
+        )
+
+        detection_locations: list[NodeLocationResponse] = []
+        for node_id in registered_node_ids:
+            full_node_id, timestamp, detection_report_messages = self.get_detection_reports(
+                node_id=node_id,
+                detection_source=detection_source,
+                detection_confidence=detection_confidence,
+                detection_classification=detection_classification,
+                detection_from=detection_from,
+                detection_to=detection_to,
+                detection_interval=detection_interval,
+                detection_count=detection_count,
+            )
+
+            for detection_report_message in detection_report_messages:
+                if "location" in detection_report_message:
+                    detection_location = LocationResponse()
+                    setattr_all(detection_location, detection_report_message["location"])
+
+                    detection_locations.append(
+                        NodeLocationResponse(
+                            node_id=full_node_id,
+                            timestamp=timestamp,
+                            node_location=detection_location,
+                        ),
+                    )
+
+        return detection_locations
 
-    @abstractmethod
     def get_detections_associated_files(
         self,
         node_ids: list[str],
@@ -99,4 +403,56 @@ class BaseInterface(ABC):
         detection_interval: timedelta,
         detection_count: int,
     ) -> list[AssociatedFilesResponse]:
-        pass
+        """Gets (a list of) associated files for detections.
+
+        Args:
+            node_ids (list[str]): The node_ids, defaults to empty list/all nodes.
+            detection_source (DetectionSource): Source of detection.
+            detection_confidence (float): confidence value to filter on (above)
+            detection_classification (str): classification
+            detection_from (datetime): from timestamp
+            detection_to (datetime): to timestamp
+            detection_interval (timedelta): delta time from current
+            detection_count (int): number of messages to retrieve per node_id
+
+        Returns:
+            list[AssociatedFilesResponse]: AssociatedFilesResponse
+        """
+        registered_node_ids = (
+            self.get_registered_node_ids() if node_ids and "all" in node_ids else node_ids
+        )
+
+        detection_associated_files_response: list[AssociatedFilesResponse] = []
+        for node_id in registered_node_ids:
+            full_node_id, timestamp, detection_report_messages = self.get_detection_reports(
+                node_id=node_id,
+                detection_source=detection_source,
+                detection_confidence=detection_confidence,
+                detection_classification=detection_classification,
+                detection_from=detection_from,
+                detection_to=detection_to,
+                detection_interval=detection_interval,
+                detection_count=detection_count,
+            )
+
+            for detection_report_message in detection_report_messages:
+                if "associated_file" in detection_report_message:
+                    detection_associated_files: [AssociatedFile] = []
+                    for the_associated_file in detection_report_message["associated_file"]:
+                        detection_associated_file = AssociatedFile()
+                        setattr_all(
+                            detection_associated_file,
+                            the_associated_file,
+                        )
+
+                        detection_associated_files.append(detection_associated_file)
+
+                    detection_associated_files_response.append(
+                        AssociatedFilesResponse(
+                            node_id=full_node_id,
+                            timestamp=timestamp,
+                            associated_files=detection_associated_files,
+                        ),
+                    )
+
+        return detection_associated_files_response
@@ -3,33 +3,25 @@
 #
 
 import logging
-from datetime import datetime, timedelta
-from queue import Queue
-from threading import Thread
-from typing import Any, Dict, Iterable, List
+import time
+from datetime import datetime, timedelta, timezone
+from queue import Empty, Queue
+from threading import Lock, Thread
+from typing import Any, Dict, Iterable, List, Optional
 
 from elasticsearch import Elasticsearch, helpers
 from elasticsearch.exceptions import ConnectionError as ElasticConnectionError
+from elasticsearch.exceptions import NotFoundError
 
-from sapient_apex_api.interface.base_interface import BaseInterface
-from sapient_apex_api.response_models import (
-    AssociatedFile,
-    AssociatedFilesResponse,
-    DetectionResponse,
-    DetectionSource,
+from sapient_apex_api.interface.base_interface import (
+    BaseInterface,
+    decode_cursor,
+    encode_cursor,
+    is_detection_report_wanted,
 )
-from sapient_apex_api.response_models import Location as LocationResponse
-from sapient_apex_api.response_models import (
-    LocationOrRangeBearing as LocationOrRangeBearingResponse,
-)
-from sapient_apex_api.response_models import (
-    NodeDefinition,
-    NodeDefinitionResponse,
-    NodeFieldOfViewResponse,
-    NodeLocationResponse,
-)
-from sapient_apex_api.response_protos import setattr_all
+from sapient_apex_api.response_models import DetectionResponse, DetectionSource
 from sapient_apex_server.structures import DatabaseOperation
+from sapient_apex_server.time_util import str_to_datetime
 
 logger = logging.getLogger(__name__)
 
@@ -63,6 +55,26 @@ message_template = {
 }
 
 
+# Suffixes of the partition indices (which are named "<alias>-<suffix>") for each interval
+partition_formats = {
+    "hours": "%Y.%m.%d.%H",
+    "days": "%Y.%m.%d",
+    "months": "%Y.%m",
+}
+
+# How often to check for partitions which are older than the retention period
+retention_check_seconds = 3600
+
+# How long the point in time of a paged query is kept between pages
+point_in_time_keep_alive = "5m"
+
+
+def naive_utc(dt: datetime) -> datetime:
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
 class DefaultKeyword:
     """Tag for default keywords.
 
@@ -73,11 +85,27 @@ class DefaultKeyword:
 
 
 class ElasticInterface(BaseInterface):
+    """Stores messages in Elasticsearch and answers the REST API queries from them.
+
+    By default all messages go into a single index. If "partitionInterval" is configured, each
+    hour/day/month of messages goes into its own index instead, named "<index>-<date>", and the
+    index name becomes an alias to all of them. Queries with a time range then only search the
+    partitions that cover it, and partitions older than "retentionDays" are deleted.
+    """
+
     def __init__(
         self, elastic_config: dict, index: str = "messages", _start_op_thread: bool = True
     ):
         self.message_queue = Queue()
         self.index = index
+        self.partition_interval: Optional[str] = elastic_config.get("partitionInterval")
+        if self.partition_interval is not None and self.partition_interval not in partition_formats:
+            raise ValueError(
+                f"partitionInterval must be one of {', '.join(partition_formats)} (or absent)"
+            )
+        self.retention_days: int = elastic_config.get("retentionDays", 0)
+        self.partitions: set[str] = set()
+        self.partitions_lock = Lock()
         hostname = (
             elastic_config.get("host", "localhost") + ":" + str(elastic_config.get("port", 9200))
         )
@@ -150,24 +178,144 @@ class ElasticInterface(BaseInterface):
 
     def run(self):
         try:
-            if not self.es.indices.exists(index=self.index):
+            if self.partition_interval:
+                self.setup_partitions()
+            elif not self.es.indices.exists(index=self.index):
                 self.es.indices.create(index=self.index, mappings=message_template)
         except ElasticConnectionError:
             raise RuntimeError("Could not connect to Elasticsearch DB")
 
+        # Retention was just applied by setup_partitions(), and is then applied periodically
+        # whether or not messages are arriving
+        next_retention_time = time.monotonic() + retention_check_seconds
         while True:
+            now = time.monotonic()
+            if now >= next_retention_time:
+                self.apply_retention()
+                next_retention_time = now + retention_check_seconds
             # wait and read a message from the queue
-            message = self.message_queue.get()
+            try:
+                message = self.message_queue.get(timeout=next_retention_time - now)
+            except Empty:
+                continue
             # process message
             if message["operation"] is DatabaseOperation.CREATE:
-                logger.debug(
-                    f"Inserting message [{message['data']}] into index [{message['index']}]"
-                )
-                self.es.index(index=message["index"], document=message["data"])
+                index = message["index"]
+                if self.partition_interval and index == self.index:
+                    index = self.get_partition(message["data"])
+                logger.debug(f"Inserting message [{message['data']}] into index [{index}]")
+                self.es.index(index=index, document=message["data"])
             elif message["operation"] is DatabaseOperation.SHUTDOWN:
                 logger.info("Database thread shutting down...")
                 return
 
+    def setup_partitions(self):
+        """Prepares for writing to partition indices, which are created on demand."""
+        if self.es.indices.exists(index=self.index) and not self.es.indices.exists_alias(
+            name=self.index
+        ):
+            logger.error(
+                f"Elasticsearch index [{self.index}] already exists so cannot be used as the alias"
+                " of partitions. Partitioning disabled."
+            )
+            self.partition_interval = None
+            return
+
+        # New partitions are created with the mappings and added to the alias by this template
+        self.es.indices.put_index_template(
+            name=self.index,
+            index_patterns=[f"{self.index}-*"],
+            template={"mappings": message_template, "aliases": {self.index: {}}},
+        )
+        if self.es.indices.exists_alias(name=self.index):
+            with self.partitions_lock:
+                self.partitions = {
+                    index
+                    for index in self.es.indices.get_alias(name=self.index)
+                    if self.get_partition_start(index) is not None
+                }
+        self.apply_retention()
+
+    def get_partition(self, document: dict) -> str:
+        """Returns the name of the partition index for a message, noting it if new."""
+        timestamp = str_to_datetime(document["timestamp"])
+        partition = f"{self.index}-{timestamp.strftime(partition_formats[self.partition_interval])}"
+        if partition not in self.partitions:
+            with self.partitions_lock:
+                self.partitions = self.partitions | {partition}
+        return partition
+
+    def get_partition_start(self, partition: str) -> Optional[datetime]:
+        prefix = f"{self.index}-"
+        if not self.partition_interval or not partition.startswith(prefix):
+            return None
+        try:
+            return datetime.strptime(
+                partition[len(prefix) :], partition_formats[self.partition_interval]
+            )
+        except ValueError:
+            return None
+
+    def get_partition_end(self, start: datetime) -> datetime:
+        if self.partition_interval == "months":
+            return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+        return start + timedelta(**{self.partition_interval: 1})
+
+    def get_indices(
+        self, time_from: Optional[datetime] = None, time_to: Optional[datetime] = None
+    ) -> list[str]:
+        """Returns the indices which may hold messages within the (inclusive) time range.
+
+        The partitions are ordered by time, newest first.
+        """
+        if not self.partition_interval:
+            return [self.index]
+
+        time_from = naive_utc(time_from) if time_from else datetime.min
+        time_to = naive_utc(time_to) if time_to else datetime.max
+        partitions = []
+        for partition in self.partitions:
+            start = self.get_partition_start(partition)
+            if start is not None and start <= time_to and self.get_partition_end(start) > time_from:
+                partitions.append((start, partition))
+        return [partition for _, partition in sorted(partitions, reverse=True)]
+
+    def apply_retention(self):
+        """Deletes partitions which only hold messages older than the retention period."""
+        if not self.partition_interval or self.retention_days <= 0:
+            return
+
+        cutoff = datetime.utcnow() - timedelta(days=self.retention_days)
+        for partition in self.partitions:
+            start = self.get_partition_start(partition)
+            if start is not None and self.get_partition_end(start) <= cutoff:
+                logger.info(f"Deleting partition [{partition}] older than retention period")
+                self.es.indices.delete(index=partition, ignore_unavailable=True)
+                with self.partitions_lock:
+                    self.partitions = self.partitions - {partition}
+
+    def search_newest_first(self, query: dict, size: int) -> list[dict]:
+        """Searches the newest partition first, only searching the older ones if needed.
+
+        This keeps queries for recent messages fast however much history has been kept.
+        """
+        indices = self.get_indices()
+        if not indices:
+            return []
+        # Note: This is a normal elastic search, as the (scan)search appears to not support
+        # sorting or limiting. Also note the sort parameter is a list of ':' separated pairs and
+        # not a dict, which appears to be python specific elastic library implementation & not well
+        # documented.
+        hits = []
+        for batch in (indices[:1], indices[1:]) if len(indices) > 1 else (indices,):
+            result = self.search(
+                index=",".join(batch), query=query, sort=["timestamp:desc"], size=size
+            )
+            hits.extend(result["hits"]["hits"])
+            if len(hits) >= size:
+                break
+        return hits[:size]
+
     def stop(self):
         self.message_queue.put_nowait({"operation": DatabaseOperation.SHUTDOWN})
 
@@ -184,33 +332,40 @@ class ElasticInterface(BaseInterface):
         )
         return int(result["aggregations"]["node_ids"]["value"])
 
-    def get_node_definitions(self, **kwargs) -> list[NodeDefinitionResponse]:
-        return [
-            NodeDefinitionResponse(
-                node_id=r["node_id"],
-                timestamp=r["timestamp"],
-                node_definition=[
-                    NodeDefinition(**definition) for definition in r["message"]["node_definition"]
-                ],
-            )
-            for r in self.get_latest_registration_messages(**kwargs)
-        ]
-
     def get_latest_registration_messages(self, **kwargs) -> list:
-        nbdocs = self.get_number_of_nodes()
-        if nbdocs >= 5000:
-            raise NotImplementedError("Too many documents to collapse")
-
+        # A composite aggregation is paged through, so there is no limit on the number of nodes
+        # (unlike collapsing the search results, which is limited to 5000 nodes).
         query = kwargs.pop("query", {"bool": {"must": {"term": {"message_type": "registration"}}}})
-        result = self.es.search(
-            index=self.index,
-            query=query,
-            collapse={"field": "node_id"},
-            sort=["timestamp:desc"],
-            size=nbdocs,
-            **kwargs,
-        )
-        return [r["_source"] for r in result["hits"]["hits"]]
+        registrations = []
+        after_key = None
+        while True:
+            composite = {"size": 1000, "sources": [{"node_id": {"terms": {"field": "node_id"}}}]}
+            if after_key:
+                composite["after"] = after_key
+            result = self.es.search(
+                index=self.index,
+                query=query,
+                aggs={
+                    "node_ids": {
+                        "composite": composite,
+                        "aggs": {
+                            "latest": {
+                                "top_hits": {"size": 1, "sort": [{"timestamp": {"order": "desc"}}]}
+                            }
+                        },
+                    }
+                },
+                size=0,
+                **kwargs,
+            )
+            node_ids = result["aggregations"]["node_ids"]
+            registrations.extend(
+                bucket["latest"]["hits"]["hits"][0]["_source"] for bucket in node_ids["buckets"]
+            )
+            after_key = node_ids.get("after_key")
+            if not after_key or not node_ids["buckets"]:
+                break
+        return sorted(registrations, key=lambda r: r["timestamp"], reverse=True)
 
     def get_latest_status_report_message(self, node_id: str) -> tuple[str, str, dict[str, Any]]:
         full_node_id = ""
@@ -228,21 +383,7 @@ class ElasticInterface(BaseInterface):
             }
         }
 
-        # Note: This is a normal elastic search, as the (scan)search appears to not support
-        # sorting or limiting. As we expect only one message, scrolling/paging is not required.
-        # Also note the sort parameter is a list of ':' separated pairs and not a dict,
-        # which appears to be python specific elastic library implementation & not well
-        # documented.
-        sort = ["timestamp:desc"]
-
-        status_report_results = self.search(
-            index=self.index,
-            query=query,
-            sort=sort,
-            size=1,
-        )
-
-        for status_report_result in status_report_results["hits"]["hits"]:
+        for status_report_result in self.search_newest_first(query=query, size=1):
             full_node_id = status_report_result["_source"]["node_id"]
             timestamp = status_report_result["_source"]["timestamp"]
             status_report_message = status_report_result["_source"]["message"]
@@ -284,157 +425,57 @@ class ElasticInterface(BaseInterface):
         }
 
         # Time filters
+        time_range = None
         if detection_interval != timedelta(0):
-            current_time = datetime.now()
-            previous_time = current_time - detection_interval
-            query["bool"]["must"].append(
-                {
-                    "range": {
-                        "timestamp": {
-                            "gte": previous_time,
-                            "lte": current_time,
-                        }
-                    }
-                }
-            )
+            current_time = datetime.utcnow()
+            time_range = (current_time - detection_interval, current_time)
         elif detection_from != datetime.min and detection_to != datetime.min:
+            time_range = (detection_from, detection_to)
+
+        if time_range is None:
+            detection_report_results = self.search_newest_first(query=query, size=detection_count)
+        else:
             query["bool"]["must"].append(
                 {
                     "range": {
                         "timestamp": {
-                            "gte": detection_from,
-                            "lte": detection_to,
+                            "gte": time_range[0],
+                            "lte": time_range[1],
                         }
                     }
                 }
             )
+            # Only the partitions covering the time range need to be searched
+            indices = self.get_indices(*time_range)
+            detection_report_results = (
+                self.search(
+                    index=",".join(indices),
+                    query=query,
+                    sort=["timestamp:desc"],
+                    size=detection_count,
+                )["hits"]["hits"]
+                if indices
+                else []
+            )
 
-        # Note: This is a normal elastic search, as the (scan)search appears to not support
-        # sorting or limiting. As we expect only one message, scrolling/paging is not required.
-        # Also note the sort parameter is a list of ':' separated pairs and not a dict,
-        # which appears to be python specific elastic library implementation & not well
-        # documented.
-        sort = ["timestamp:desc"]
-
-        detection_report_results = self.search(
-            index="messages",
-            query=query,
-            sort=sort,
-            size=detection_count,
-        )
-
-        for detection_report_result in detection_report_results["hits"]["hits"]:
+        for detection_report_result in detection_report_results:
             full_node_id = detection_report_result["_source"]["node_id"]
             timestamp = detection_report_result["_source"]["timestamp"]
 
             detection_report_message = detection_report_result["_source"]["message"]
-            append_message = (
-                float(detection_report_message.get("detection_confidence", -1))
-                > detection_confidence
-            )
-            append_message &= (not detection_classification) or any(
-                detection_classification in classification.get("type", [])
-                for classification in detection_report_message.get("classification", {})
+            append_message = is_detection_report_wanted(
+                detection_report_message,
+                detection_source,
+                detection_confidence,
+                detection_classification,
             )
 
-            # If used by a fusion node, the “associated_detection” field shall represent a
-            # list of individual sensor edge node detections that were used to
-            # generate a fused detection.
-            # So we will use this to determine if a particular detection report is
-            # from a edge or fusion node.
-
-            associated_detection = detection_report_message.get("associated_detection", [])
-            if detection_source == DetectionSource.fused and not associated_detection:
-                append_message = False  # Looking for fused, but this is a sensor detection
-            elif detection_source == DetectionSource.edge and associated_detection:
-                append_message = False  # Looking for edge, but found a fused detection
-
             if append_message:
                 detection_report_messages.append(detection_report_message)
 
         return full_node_id, timestamp, detection_report_messages
 
-    def get_registered_node_ids(self) -> list[str]:
-        return [r["node_id"] for r in self.get_latest_registration_messages()]
-
-    def get_locations(self, node_ids: list[str]) -> list[NodeLocationResponse]:
-        """Get the (list of) NodeLocationResponse
-
-        Args:
-            node_ids (list[str]): The node_ids, defaults to empty list/all nodes.
-
-        Returns:
-            list[NodeLocationResponse]: NodeLocationResponse
-        """
-
-        # Run two types of searches on the database
-        # 1. Search all registration messages to get the node_ids & store unique values.
-        # 2. Use these node_ids to search for the latest status_report for each.
-        # and populate the NodeLocationResponse list
-
-        registered_node_ids = (
-            self.get_registered_node_ids() if node_ids and "all" in node_ids else node_ids
-        )
-
-        node_locations: list[NodeLocationResponse] = []
-        for node_id in registered_node_ids:
-            full_node_id, timestamp, status_report_message = self.get_latest_status_report_message(
-                node_id=node_id
-            )
-
-            if "node_location" in status_report_message:
-                node_location = LocationResponse()
-                setattr_all(node_location, status_report_message["node_location"])
-
-                node_locations.append(
-                    NodeLocationResponse(
-                        node_id=full_node_id,
-                        timestamp=timestamp,
-                        node_location=node_location,
-                    ),
-                )
-
-        return node_locations
-
-    def get_field_of_views(self, node_ids: list[str]) -> list[NodeFieldOfViewResponse]:
-        """Get the (list of) NodeFieldOfViewResponse
-
-        Args:
-            node_ids (list[str]): The node_ids, defaults to empty list/all nodes.
-
-        Returns:
-            list[NodeFieldOfViewResponse]: NodeFieldOfViewResponse
-        """
-
-        # Run two types of searches on the database
-        # 1. Search all registration messages to get the node_ids & store unique values.
-        # 2. Use these node_ids to search for the latest status_report for each.
-        # and populate the NodeLocationResponse list
-
-        registered_node_ids = (
-            self.get_registered_node_ids() if node_ids and "all" in node_ids else node_ids
-        )
-        node_field_of_views: list[NodeFieldOfViewResponse] = []
-        for node_id in registered_node_ids:
-            full_node_id, timestamp, status_report_message = self.get_latest_status_report_message(
-                node_id=node_id,
-            )
-
-            if "field_of_view" in status_report_message:
-                node_field_of_view = LocationOrRangeBearingResponse()
-                setattr_all(node_field_of_view, status_report_message["field_of_view"])
-
-                node_field_of_views.append(
-                    NodeFieldOfViewResponse(
-                        node_id=full_node_id,
-                        timestamp=timestamp,
-                        field_of_view=node_field_of_view,
-                    ),
-                )
-
-        return node_field_of_views
-
-    def get_detections(
+    def get_detection_page(
         self,
         node_ids: list[str],
         detection_source: DetectionSource,
@@ -442,172 +483,68 @@ class ElasticInterface(BaseInterface):
         detection_classification: str,
         detection_from: datetime,
         detection_to: datetime,
-        detection_interval: timedelta,
-        detection_count: int,
-    ) -> list[DetectionResponse]:
-        """Gets (a list of) detections.
-
-        Args:
-            node_ids (list[str]): The node_ids, defaults to empty list/all nodes.
-            detection_source (DetectionSource): Source of detection.
-            detection_confidence (float): confidence value to filter on (above)
-            detection_classification (str): classification
-            detection_from (datetime): from timestamp
-            detection_to (datetime): to timestamp
-            detection_interval (timedelta): delta time from current
-            detection_count (int): number of messages to retrieve per node_id
-
-        Returns:
-            list[DetectionResponse]: DetectionResponse
-        """
-
-        registered_node_ids = (
-            self.get_registered_node_ids() if node_ids and "all" in node_ids else node_ids
-        )
+        page_size: int,
+        cursor: Optional[str] = None,
+    ) -> tuple[list[DetectionResponse], Optional[str]]:
+        # Pages are read from a point in time, so they are consistent with each other even while
+        # new messages are being indexed. The cursor holds its ID and the sort values of the last
+        # detection of the page.
+        query = {"bool": {"must": [{"term": {"message_type": "detection_report"}}]}}
+        if "all" not in node_ids:
+            query["bool"]["must"].append({"terms": {"node_id": node_ids}})
+        time_range = {}
+        if detection_from != datetime.min:
+            time_range["gte"] = detection_from
+        if detection_to != datetime.min:
+            time_range["lte"] = detection_to
+        if time_range:
+            query["bool"]["must"].append({"range": {"timestamp": time_range}})
+
+        if cursor is None:
+            indices = self.get_indices(time_range.get("gte"), time_range.get("lte"))
+            if not indices:
+                return [], None
+            pit_id = self.es.open_point_in_time(
+                index=",".join(indices), keep_alive=point_in_time_keep_alive
+            )["id"]
+            search_after = None
+        else:
+            state = decode_cursor(cursor)
+            try:
+                pit_id, search_after = state["pit"], state["after"]
+            except (KeyError, TypeError):
+                raise ValueError("Invalid cursor")
 
-        detection_reponses: list[DetectionResponse] = []
-        for node_id in registered_node_ids:
-            full_node_id, timestamp, detection_report_messages = self.get_detection_reports(
-                node_id=node_id,
-                detection_source=detection_source,
-                detection_confidence=detection_confidence,
-                detection_classification=detection_classification,
-                detection_from=detection_from,
-                detection_to=detection_to,
-                detection_interval=detection_interval,
-                detection_count=detection_count,
+        try:
+            result = self.es.search(
+                pit={"id": pit_id, "keep_alive": point_in_time_keep_alive},
+                query=query,
+                sort=[{"timestamp": "asc"}],
+                size=page_size,
+                search_after=search_after,
+                source=True,
             )
-
-            for detection_report_message in detection_report_messages:
-                detection_reponses.append(
-                    DetectionResponse(
-                        node_id=full_node_id,
-                        timestamp=timestamp,
-                        detection_report=detection_report_message,
-                    ),
-                )
-
-        return detection_reponses
-
-    def get_detections_locations(
-        self,
-        node_ids: list[str],
-        detection_source: DetectionSource,
-        detection_confidence: float,
-        detection_classification: str,
-        detection_from: datetime,
-        detection_to: datetime,
-        detection_interval: timedelta,
-        detection_count: int,
-    ) -> list[NodeLocationResponse]:
-        """Gets (a list of) locations for detections.
-
-        Args:
-            node_ids (list[str]): The node_ids, defaults to empty list/all nodes.
-            detection_source (DetectionSource): Source of detection.
-            detection_confidence (float): confidence value to filter on (above)
-            detection_classification (str): classification
-            detection_from (datetime): from timestamp
-            detection_to (datetime): to timestamp
-            detection_interval (timedelta): delta time from current
-            detection_count (int): number of messages to retrieve per node_id
-
-        Returns:
-            list[NodeLocationResponse]: NodeLocationResponse
-        """
-        registered_node_ids = (
-            self.get_registered_node_ids() if node_ids and "all" in node_ids else node_ids
-        )
-
-        detection_locations: list[NodeLocationResponse] = []
-        for node_id in registered_node_ids:
-            full_node_id, timestamp, detection_report_messages = self.get_detection_reports(
-                node_id=node_id,
-                detection_source=detection_source,
-                detection_confidence=detection_confidence,
-                detection_classification=detection_classification,
-                detection_from=detection_from,
-                detection_to=detection_to,
-                detection_interval=detection_interval,
-                detection_count=detection_count,
+        except NotFoundError:
+            raise ValueError("Cursor has expired")
+        pit_id = result.get("pit_id", pit_id)
+        hits = result["hits"]["hits"]
+
+        detections = [
+            DetectionResponse(
+                node_id=hit["_source"]["node_id"],
+                timestamp=hit["_source"]["timestamp"],
+                detection_report=hit["_source"]["message"],
             )
-
-            for detection_report_message in detection_report_messages:
-                if "location" in detection_report_message:
-                    detection_location = LocationResponse()
-                    setattr_all(detection_location, detection_report_message["location"])
-
-                    detection_locations.append(
-                        NodeLocationResponse(
-                            node_id=full_node_id,
-                            timestamp=timestamp,
-                            node_location=detection_location,
-                        ),
-                    )
-
-        return detection_locations
-
-    def get_detections_associated_files(
-        self,
-        node_ids: list[str],
-        detection_source: DetectionSource,
-        detection_confidence: float,
-        detection_classification: str,
-        detection_from: datetime,
-        detection_to: datetime,
-        detection_interval: timedelta,
-        detection_count: int,
-    ) -> list[AssociatedFilesResponse]:
-        """Gets (a list of) associated files for detections.
-
-        Args:
-            node_ids (list[str]): The node_ids, defaults to empty list/all nodes.
-            detection_source (DetectionSource): Source of detection.
-            detection_confidence (float): confidence value to filter on (above)
-            detection_classification (str): classification
-            detection_from (datetime): from timestamp
-            detection_to (datetime): to timestamp
-            detection_interval (timedelta): delta time from current
-            detection_count (int): number of messages to retrieve per node_id
-
-        Returns:
-            list[AssociatedFilesResponse]: AssociatedFilesResponse
-        """
-        registered_node_ids = (
-            self.get_registered_node_ids() if node_ids and "all" in node_ids else node_ids
-        )
-
-        detection_associated_files_response: list[AssociatedFilesResponse] = []
-        for node_id in registered_node_ids:
-            full_node_id, timestamp, detection_report_messages = self.get_detection_reports(
-                node_id=node_id,
-                detection_source=detection_source,
-                detection_confidence=detection_confidence,
-                detection_classification=detection_classification,
-                detection_from=detection_from,
-                detection_to=detection_to,
-                detection_interval=detection_interval,
-                detection_count=detection_count,
+            for hit in hits
+            if is_detection_report_wanted(
+                hit["_source"]["message"],
+                detection_source,
+                detection_confidence,
+                detection_classification,
             )
+        ]
 
-            for detection_report_message in detection_report_messages:
-                if "associated_file" in detection_report_message:
-                    detection_associated_files: [AssociatedFile] = []
-                    for the_associated_file in detection_report_message["associated_file"]:
-                        detection_associated_file = AssociatedFile()
-                        setattr_all(
-                            detection_associated_file,
-                            the_associated_file,
-                        )
-
-                        detection_associated_files.append(detection_associated_file)
-
-                    detection_associated_files_response.append(
-                        AssociatedFilesResponse(
-                            node_id=full_node_id,
-                            timestamp=timestamp,
-                            associated_files=detection_associated_files,
-                        ),
-                    )
-
-        return detection_associated_files_response
+        if len(hits) < page_size:
+            self.es.close_point_in_time(id=pit_id)
+            return detections, None
+        return detections, encode_cursor({"pit": pit_id, "after": hits[-1]["sort"]})
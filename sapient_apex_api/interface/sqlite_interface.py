@@ -0,0 +1,312 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Optional
+
+from google.protobuf.json_format import MessageToDict
+from sqlalchemy import Engine, create_engine, text
+
+from sapient_apex_api.interface.base_interface import (
+    BaseInterface,
+    decode_cursor,
+    encode_cursor,
+    is_detection_report_wanted,
+)
+from sapient_apex_api.response_models import DetectionResponse, DetectionSource
+from sapient_apex_server.structures import SapientVersion
+from sapient_apex_server.time_util import datetime_int_to_str, datetime_to_int
+from sapient_apex_server.translator.proto_to_proto_translator import (
+    empty_sapient_message,
+)
+
+logger = logging.getLogger(__name__)
+
+# Maps the fields of the (elastic style) message documents to the columns of the Message table
+document_columns = {
+    "node_id": "parsed_node_id",
+    "message_type": "parsed_type",
+    "timestamp": "parsed_timestamp",
+}
+
+message_columns = "parsed_node_id, parsed_type, parsed_timestamp, json, proto, sapient_version"
+
+
+class SqliteInterface(BaseInterface):
+    """Answers the REST API queries from the SQLite database written by Apex itself.
+
+    This allows the REST API to be used without an Elasticsearch instance. Nothing is inserted by
+    this interface as every message is already stored by the SqliteThread; when the database rolls
+    over the queries follow on to the new file, so results are limited to what that file holds.
+    """
+
+    def __init__(self, filename: str):
+        self.lock = Lock()
+        self.filename = filename
+        self.engine = self._create_engine(filename)
+
+    @staticmethod
+    def _create_engine(filename: str) -> Engine:
+        logger.info(f"REST API using SQLite database: {filename}")
+        return create_engine(f"sqlite:///{filename}")
+
+    def _get_engine(self) -> Engine:
+        """Returns the engine for the current database file, following any rollovers."""
+        with self.lock:
+            while True:
+                with self.engine.connect() as connection:
+                    rollover = connection.execute(
+                        text(
+                            "SELECT absolute_filepath FROM RolloverFilename"
+                            " ORDER BY id DESC LIMIT 1"
+                        )
+                    ).first()
+                if rollover is None or not os.path.exists(rollover.absolute_filepath):
+                    return self.engine
+                self.engine.dispose()
+                self.filename = rollover.absolute_filepath
+                self.engine = self._create_engine(self.filename)
+
+    def _execute(self, sql: str, **params) -> List[Any]:
+        with self._get_engine().connect() as connection:
+            return connection.execute(text(sql), params).all()
+
+    @staticmethod
+    def _row_to_document(row: Any) -> Dict[str, Any]:
+        """Converts a Message row into the same document that is stored in Elasticsearch."""
+        try:
+            sapient_message = json.loads(row.json)
+        except (TypeError, ValueError):
+            # Messages received as XML do not have a usable json column, so decode the proto
+            version = SapientVersion(row.sapient_version)
+            if version == SapientVersion.VERSION6:
+                version = SapientVersion.LATEST
+            proto_message = empty_sapient_message(version)
+            proto_message.ParseFromString(row.proto or b"")
+            sapient_message = MessageToDict(proto_message, preserving_proto_field_name=True)
+
+        return {
+            "node_id": str(row.parsed_node_id),
+            "destination_id": sapient_message.get("destination_id", ""),
+            "timestamp": datetime_int_to_str(row.parsed_timestamp),
+            "message_type": row.parsed_type,
+            "message": sapient_message.get(row.parsed_type, {}),
+        }
+
+    @staticmethod
+    def _where(query: dict) -> tuple[str, dict]:
+        conditions = ["parsed_type IS NOT NULL"]
+        params = {}
+        for i, (field, value) in enumerate(query.items()):
+            if field not in document_columns:
+                raise ValueError(f"Unsupported query field: {field}")
+            conditions.append(f"{document_columns[field]} = :value{i}")
+            params[f"value{i}"] = value
+        return " AND ".join(conditions), params
+
+    def insert_into(self, index: str, data: dict):
+        """Does nothing, messages are already written to the database by the SqliteThread."""
+        pass
+
+    def scan(self, index: str, query: dict) -> Iterable[dict[str, Any]]:
+        """Returns all messages matching the query.
+
+        Args:
+            index (str): Not used, there is only the Message table.
+            query (dict): Mapping of document field (node_id, message_type, timestamp) to value.
+
+        Returns:
+            Iterable[dict[str, Any]]: A generator object with the found results.
+        """
+        where, params = self._where(query)
+        rows = self._execute(f"SELECT {message_columns} FROM Message WHERE {where}", **params)
+        return (self._row_to_document(row) for row in rows)
+
+    def search(
+        self,
+        index: str,
+        query: dict,
+        sort: Any = None,
+        size: Optional[int] = None,
+    ) -> Any:
+        """Returns the messages matching the query, sorted and limited in number.
+
+        Args:
+            index (str): Not used, there is only the Message table.
+            query (dict): Mapping of document field (node_id, message_type, timestamp) to value.
+            sort (Any): As for elastic, a list of ':' separated pairs, defining the
+            field_name:sort_order
+            size (Optional[int]): Maximum number of results, defaults to 10 like elastic.
+
+        Returns:
+            Any: A list of the found results
+        """
+        where, params = self._where(query)
+        order_by = []
+        for item in sort or []:
+            field, _, order = item.partition(":")
+            if field not in document_columns or order.lower() not in ("", "asc", "desc"):
+                raise ValueError(f"Unsupported sort: {item}")
+            order_by.append(f"{document_columns[field]} {order.upper()}".strip())
+        order_sql = f" ORDER BY {', '.join(order_by)}" if order_by else ""
+        rows = self._execute(
+            f"SELECT {message_columns} FROM Message WHERE {where}{order_sql} LIMIT :size",
+            size=10 if size is None else size,
+            **params,
+        )
+        return [self._row_to_document(row) for row in rows]
+
+    def stop(self):
+        self.engine.dispose()
+
+    def join(self):
+        pass
+
+    def get_latest_registration_messages(self, **kwargs) -> list:
+        # SQLite returns the bare columns from the row holding the MAX() of each group
+        rows = self._execute(
+            f"""SELECT {message_columns}, MAX(parsed_timestamp)
+                FROM Message
+                WHERE parsed_type = 'registration'
+                GROUP BY parsed_node_id
+                ORDER BY parsed_timestamp DESC"""
+        )
+        return [self._row_to_document(row) for row in rows]
+
+    def get_latest_status_report_message(self, node_id: str) -> tuple[str, str, dict[str, Any]]:
+        for document in self.search(
+            index="messages",
+            query={"message_type": "status_report", "node_id": node_id},
+            sort=["timestamp:desc"],
+            size=1,
+        ):
+            return document["node_id"], document["timestamp"], document["message"]
+        return "", "", {}
+
+    def get_detection_reports(
+        self,
+        node_id: str,
+        detection_source: DetectionSource,
+        detection_confidence: float,
+        detection_classification: str,
+        detection_from: datetime,
+        detection_to: datetime,
+        detection_interval: timedelta,
+        detection_count: int,
+    ) -> (str, str, List[Dict[str, Any]]):
+        full_node_id = ""
+        timestamp: str = ""
+        detection_report_messages = []
+
+        # Time filters
+        time_range = None
+        if detection_interval != timedelta(0):
+            current_time = datetime.utcnow()
+            time_range = (current_time - detection_interval, current_time)
+        elif detection_from != datetime.min and detection_to != datetime.min:
+            time_range = (detection_from, detection_to)
+
+        time_sql = ""
+        params = {"node_id": node_id, "size": detection_count}
+        if time_range is not None:
+            time_sql = "AND parsed_timestamp BETWEEN :time_from AND :time_to"
+            params["time_from"], params["time_to"] = (to_utc_int(t) for t in time_range)
+
+        rows = self._execute(
+            f"""SELECT {message_columns}
+                FROM Message
+                WHERE parsed_type = 'detection_report' AND parsed_node_id = :node_id {time_sql}
+                ORDER BY parsed_timestamp DESC
+                LIMIT :size""",
+            **params,
+        )
+
+        for row in rows:
+            document = self._row_to_document(row)
+            full_node_id = document["node_id"]
+            timestamp = document["timestamp"]
+
+            if is_detection_report_wanted(
+                document["message"],
+                detection_source,
+                detection_confidence,
+                detection_classification,
+            ):
+                detection_report_messages.append(document["message"])
+
+        return full_node_id, timestamp, detection_report_messages
+
+    def get_detection_page(
+        self,
+        node_ids: list[str],
+        detection_source: DetectionSource,
+        detection_confidence: float,
+        detection_classification: str,
+        detection_from: datetime,
+        detection_to: datetime,
+        page_size: int,
+        cursor: Optional[str] = None,
+    ) -> tuple[list[DetectionResponse], Optional[str]]:
+        # Keyset pagination: the cursor is the (timestamp, id) of the last row of the page, so
+        # each page is read straight from the index however far through the results it is.
+        conditions = ["parsed_type = 'detection_report'"]
+        params = {"size": page_size}
+        if "all" not in node_ids:
+            conditions.append(
+                f"parsed_node_id IN ({', '.join(f':node{i}' for i in range(len(node_ids)))})"
+            )
+            params.update({f"node{i}": node_id for i, node_id in enumerate(node_ids)})
+        if detection_from != datetime.min:
+            conditions.append("parsed_timestamp >= :time_from")
+            params["time_from"] = to_utc_int(detection_from)
+        if detection_to != datetime.min:
+            conditions.append("parsed_timestamp <= :time_to")
+            params["time_to"] = to_utc_int(detection_to)
+        if cursor is not None:
+            try:
+                params["after_timestamp"], params["after_id"] = decode_cursor(cursor)
+            except (TypeError, ValueError):
+                raise ValueError("Invalid cursor")
+            conditions.append("(parsed_timestamp, id) > (:after_timestamp, :after_id)")
+
+        rows = self._execute(
+            f"""SELECT id, {message_columns}
+                FROM Message
+                WHERE {" AND ".join(conditions)}
+                ORDER BY parsed_timestamp, id
+                LIMIT :size""",
+            **params,
+        )
+
+        detections = []
+        for row in rows:
+            document = self._row_to_document(row)
+            if is_detection_report_wanted(
+                document["message"],
+                detection_source,
+                detection_confidence,
+                detection_classification,
+            ):
+                detections.append(
+                    DetectionResponse(
+                        node_id=document["node_id"],
+                        timestamp=document["timestamp"],
+                        detection_report=document["message"],
+                    )
+                )
+
+        if len(rows) < page_size:
+            return detections, None
+        return detections, encode_cursor([rows[-1].parsed_timestamp, rows[-1].id])
+
+
+def to_utc_int(dt: datetime) -> int:
+    """Converts a (possibly timezone aware) datetime to the integer used in the database."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return datetime_to_int(dt)
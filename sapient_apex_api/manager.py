@@ -28,6 +28,14 @@ class Manager:
             # Seems to be the case for ApexRecorder messages and will throw exceptions
             # Also we dont want duplicated messages in the (elastic) database.
             return
+        if msg.parsed.parsed_proto is None:
+            # E.g. detections dropped by the confidence filter before being parsed, which are only
+            # stored in SQLite (with the fields peeked at), so are not in the (elastic) database
+            logger.debug(
+                f"Not inserting unparsed {msg.parsed.message_type} message with node id"
+                f" [{msg.parsed.node_id}] and timestamp [{msg.parsed.message_timestamp}]"
+            )
+            return
 
         logger.debug(
             f"inserting SAPIENT message with node id [{msg.parsed.node_id}] and timestamp"
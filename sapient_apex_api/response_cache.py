@@ -0,0 +1,97 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+"""Caches REST API responses which depend on rarely changing per-node information.
+
+Entries expire after a TTL and are also invalidated as soon as Apex receives a registration or a
+changed status report from a node that the response covers.
+"""
+
+import logging
+import time
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Callable, Hashable
+
+from sapient_apex_server.structures import MessageRecord
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheEntry:
+    value: Any
+    expiry: float
+    node_ids: frozenset[str]
+
+
+class ResponseCache:
+    # Messages are written to the database after invalidation, so responses computed shortly
+    # after an invalidation may not include the change yet and are not cached.
+    settle_seconds: float = 1.0
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self.entries: dict[Hashable, CacheEntry] = {}
+        self.lock = Lock()
+        self.last_invalidation: dict[str, float] = {}
+        self.last_any_invalidation = float("-inf")
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable, node_ids: list[str], compute: Callable[[], Any]) -> Any:
+        """Returns the cached response for the key, or computes and caches it.
+
+        Args:
+            key (Hashable): Identifies the response, e.g. the endpoint and its parameters.
+            node_ids (list[str]): The nodes the response depends on, "all" for any node.
+            compute (Callable[[], Any]): Computes the response when it is not cached.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expiry > now:
+                self.hits += 1
+                return entry.value
+            self.misses += 1
+
+        value = compute()
+
+        entry = CacheEntry(value, now + self.ttl_seconds, frozenset(node_ids))
+        with self.lock:
+            if "all" in entry.node_ids:
+                last_invalidation = self.last_any_invalidation
+            else:
+                last_invalidation = max(
+                    (self.last_invalidation.get(node_id, float("-inf")) for node_id in node_ids),
+                    default=float("-inf"),
+                )
+            if last_invalidation + self.settle_seconds < now:
+                self.entries[key] = entry
+        return value
+
+    def invalidate(self, node_id: str):
+        """Removes the responses that depend on the node."""
+        now = time.monotonic()
+        with self.lock:
+            self.last_invalidation[node_id] = now
+            self.last_any_invalidation = now
+            stale = [
+                key
+                for key, entry in self.entries.items()
+                if node_id in entry.node_ids or "all" in entry.node_ids
+            ]
+            for key in stale:
+                del self.entries[key]
+            self.invalidations += len(stale)
+
+    def on_message(self, msg: MessageRecord):
+        """Called for every message received by Apex, invalidates responses it changes."""
+        if msg.parsed is None or msg.error is not None or not msg.parsed.node_id:
+            return
+        if msg.registration is not None or (
+            msg.status_report is not None and not msg.status_report.is_unchanged
+        ):
+            self.invalidate(msg.parsed.node_id)
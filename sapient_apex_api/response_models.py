@@ -33,6 +33,13 @@ class RootResponse(BaseModel):
     version: str = Field(description="Version Number")
 
 
+class ResponseCacheMetricsResponse(BaseModel):
+    hits: int = Field(description="Responses returned from the cache")
+    misses: int = Field(description="Responses computed from the database")
+    invalidations: int = Field(description="Cached responses removed due to new messages")
+    entries: int = Field(description="Responses currently cached")
+
+
 class BaseNodeResponse(BaseModel):
     node_id: str = Field(description="Node ID in UUID format")
     timestamp: str = Field(description="Timestamp")
@@ -52,6 +59,12 @@ class DetectionSource(Enum):
     fused = "fused"  # Fused detections from the DMM
 
 
+class StreamMessageType(Enum):
+    detection_report = "detection_report"
+    alert = "alert"
+    status_report = "status_report"  # Only status reports with changes (i.e. not INFO_UNCHANGED)
+
+
 class AssociatedFile(BaseModel):
     type: str = Field(default_factory=str)
     url: str = Field(default_factory=str)
@@ -67,5 +80,12 @@ class DetectionResponse(BaseNodeResponse):
     # schema for detection_report due to its nested subclasses
 
 
+class DetectionPageResponse(BaseModel):
+    detections: list[DetectionResponse] = Field(default_factory=list)
+    next_cursor: Optional[str] = Field(
+        None, description="Cursor to get the next page with, absent for the last page"
+    )
+
+
 class NodeDefinitionResponse(BaseNodeResponse):
     node_definition: list[NodeDefinition] = Field(default_factory=list)
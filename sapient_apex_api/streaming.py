@@ -0,0 +1,110 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+"""Pushes messages from the Apex message pipeline to live REST API subscribers.
+
+The pipeline calls MessageBroadcaster.publish() from the Apex server thread, while subscribers are
+read from the REST server's event loop. Each subscriber has its own bounded queue which drops the
+oldest message when full, so a slow client never holds up the pipeline.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Optional
+
+from sapient_apex_api.response_models import StreamMessageType
+from sapient_apex_server.structures import MessageRecord, ParsedRecord
+
+logger = logging.getLogger(__name__)
+
+STREAM_MESSAGE_TYPES = {message_type.value for message_type in StreamMessageType}
+
+
+@dataclass
+class StreamFilter:
+    node_ids: list[str]
+    message_types: list[StreamMessageType]
+    detection_confidence: float = 0.0
+
+    def matches(self, parsed: ParsedRecord) -> bool:
+        if "all" not in self.node_ids and parsed.node_id not in self.node_ids:
+            return False
+        if all(parsed.message_type != message_type.value for message_type in self.message_types):
+            return False
+        if parsed.message_type == StreamMessageType.detection_report.value:
+            return (parsed.detection_confidence or 0.0) >= self.detection_confidence
+        return True
+
+
+class Subscriber:
+    def __init__(self, stream_filter: StreamFilter, queue_size: int):
+        self.stream_filter = stream_filter
+        self.queue: deque[dict[str, Any]] = deque(maxlen=queue_size)
+        self.dropped_count = 0
+        self.lock = Lock()
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    def put(self, document: dict[str, Any]):
+        """Adds a message to the queue, dropping the oldest one if full. Thread safe."""
+        with self.lock:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped_count += 1
+            self.queue.append(document)
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            pass  # Event loop has already closed; the subscriber is going away anyway
+
+    async def get(self) -> dict[str, Any]:
+        """Waits for the next message. Must be called from the subscriber's event loop."""
+        while True:
+            with self.lock:
+                if self.queue:
+                    return self.queue.popleft()
+            await self.event.wait()
+            self.event.clear()
+
+
+class MessageBroadcaster:
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self.subscribers: list[Subscriber] = []
+        self.lock = Lock()
+
+    def subscribe(self, stream_filter: StreamFilter) -> Subscriber:
+        subscriber = Subscriber(stream_filter, self.queue_size)
+        with self.lock:
+            self.subscribers = self.subscribers + [subscriber]
+        logger.info(f"Stream subscriber added ({len(self.subscribers)} subscribers)")
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not subscriber]
+        logger.info(
+            f"Stream subscriber removed ({len(self.subscribers)} subscribers),"
+            f" {subscriber.dropped_count} messages were dropped for it"
+        )
+
+    def publish(self, msg: MessageRecord):
+        """Called for every message received by Apex, passes it on to matching subscribers."""
+        subscribers = self.subscribers  # Replaced rather than modified, so no lock needed
+        if not subscribers or msg.parsed is None or msg.error is not None:
+            return
+        if msg.parsed.message_type not in STREAM_MESSAGE_TYPES:
+            return
+        if msg.status_report is not None and msg.status_report.is_unchanged:
+            return  # Only stream changes of status
+
+        # Only converted to JSON if at least one subscriber wants it
+        document: Optional[dict[str, Any]] = None
+        for subscriber in subscribers:
+            if subscriber.stream_filter.matches(msg.parsed):
+                document = document or msg.parsed.get_message_json()
+                if document:
+                    subscriber.put(document)
@@ -30,7 +30,17 @@ class MsgTimes:
             )
 
 
-sql_get_connections = """
+# Gets the connections that have changed since the watermarks from the previous query: those with
+# new messages (above :last_message_id), new connections (above :last_connection_id), and those
+# open then or now (so disconnections are seen). Only the messages since the watermark are counted,
+# so the cost depends on how much has happened since rather than on the size of the database.
+_sql_get_changed_connections = """
+WITH NewMessages AS (
+    SELECT connection_id, COUNT(*) AS new_msg_count, MAX(id) AS max_new_msg_id
+    FROM Message
+    WHERE id > :last_message_id
+    GROUP BY connection_id
+)
 SELECT
     Connection.id,
     Connection.client_type,
@@ -38,11 +48,8 @@ SELECT
     Connection.connect_time,
     Connection.disconnect_time,
     Connection.disconnect_reason,
-    (
-        SELECT COUNT(*)
-        FROM Message AS MsgCounted
-        WHERE MsgCounted.connection_id = Connection.id
-    ) AS msg_count,
+    NewMessages.new_msg_count,
+    NewMessages.max_new_msg_id,
     RegMsg.parsed_node_id AS reg_msg_node_id,
     RegMsg.registration_node_type AS reg_msg_node_type,
     RegMsg.timestamp_received AS reg_msg_timestamp_received,
@@ -62,6 +69,8 @@ SELECT
     DetectionMsg.timestamp_saved AS detection_msg_timestamp_saved
 FROM
     Connection
+LEFT OUTER JOIN
+    NewMessages ON NewMessages.connection_id = Connection.id
 LEFT OUTER JOIN
     Message RegMsg ON Connection.recent_msg_id_registration = RegMsg.id
 LEFT OUTER JOIN
@@ -69,10 +78,25 @@ LEFT OUTER JOIN
 LEFT OUTER JOIN
     Message StatusMsgUnchanged ON Connection.recent_msg_id_status_unchanged = StatusMsgUnchanged.id
 LEFT OUTER JOIN
-    Message DetectionMsg ON Connection.recent_msg_id_detection = DetectionMsg.id;
+    Message DetectionMsg ON Connection.recent_msg_id_detection = DetectionMsg.id
+WHERE
+    NewMessages.connection_id IS NOT NULL
+    OR Connection.id > :last_connection_id
+    OR Connection.disconnect_time IS NULL
+    {open_sql}
 """
 
 
+def sql_get_changed_connections(open_connection_count: int) -> str:
+    """Query for changed connections; also rereads :open0, :open1 etc., the connections that
+    were open at the previous query."""
+    open_sql = ""
+    if open_connection_count:
+        names = ", ".join(f":open{i}" for i in range(open_connection_count))
+        open_sql = f"OR Connection.id IN ({names})"
+    return _sql_get_changed_connections.format(open_sql=open_sql)
+
+
 @dataclass
 class ConnectionInfo:
     # "Node" column
@@ -114,7 +138,9 @@ class ConnectionInfo:
         return result
 
     @staticmethod
-    def from_row(row: dict):
+    def from_row(row: dict, previous_message_count: int = 0):
+        """Converts a row of the changed connections query, adding any new messages to the count
+        from the previous query."""
         return ConnectionInfo(
             id=row["id"],
             node_id=row["reg_msg_node_id"],
@@ -129,5 +155,5 @@ class ConnectionInfo:
             status_new_times=MsgTimes.from_row(row, "status_new_msg_"),
             status_unch_times=MsgTimes.from_row(row, "status_unch_msg_"),
             detection_times=MsgTimes.from_row(row, "detection_msg_"),
-            message_count=row["msg_count"],
+            message_count=previous_message_count + (row["new_msg_count"] or 0),
         )
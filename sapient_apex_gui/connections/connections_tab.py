@@ -9,7 +9,7 @@ from PySide6.QtWidgets import QTreeView
 
 from sapient_apex_gui.connections.connections_query import (
     ConnectionInfo,
-    sql_get_connections,
+    sql_get_changed_connections,
 )
 from sapient_apex_gui.connections.tree_builder import column_names, connections_to_tree
 from sapient_apex_gui.core.database_thread import (
@@ -29,25 +29,59 @@ class ConnectionsTab(QTreeView):
         self.setColumnWidth(0, 200)  # Leave plenty of space for Node type
         self.setColumnWidth(2, 150)  # A bit of extra space needed for disconnection
         self.setExpandsOnDoubleClick(False)  # Double click switches to messages tab instead
+        # Connections from previous queries, by ID; each query only rereads the changed ones
+        self.connections: dict[int, ConnectionInfo] = {}
+        self.result_row_cache = {}
+        self.last_message_id = 0
+        self.last_connection_id = 0
+        # Parameters of the query in progress; responses to others (e.g. from before a different
+        # database was opened) are ignored
+        self.request_params = None
         self.timer = QTimer()
         self.timer.setInterval(1000)
         self.timer.setSingleShot(True)
         self.timer.timeout.connect(self.on_timer)
         self.timer.start()
 
+    def reset(self):
+        """Forgets the connections read so far, as a different database has been opened."""
+        self.connections.clear()
+        self.result_row_cache.clear()
+        self.last_message_id = 0
+        self.last_connection_id = 0
+        self.request_params = None
+
     def on_timer(self):
+        open_ids = [info.id for info in self.connections.values() if info.disconnected_time is None]
+        self.request_params = {
+            "last_message_id": self.last_message_id,
+            "last_connection_id": self.last_connection_id,
+            **{f"open{i}": connection_id for i, connection_id in enumerate(open_ids)},
+        }
         req = DatabaseExecuteRequest(
             name="get connections",
-            query=sql_get_connections,
-            params=(),
+            query=sql_get_changed_connections(len(open_ids)),
+            params=self.request_params,
             callback=self.on_fetched,
             should_fetch_results=True,
         )
         self.db_thread.put(req)
 
     def on_fetched(self, response: DatabaseResponse):
-        tree_rows = connections_to_tree(
-            [ConnectionInfo.from_row(r._asdict()) for r in response.results]
-        )
-        self.model_merger.merge(tree_rows)
+        if response.params is self.request_params:
+            self.request_params = None
+            is_changed = not self.connections  # Clear the tree if a new database has none
+            for r in response.results:
+                row = r._asdict()
+                previous = self.connections.get(row["id"])
+                info = ConnectionInfo.from_row(row, previous.message_count if previous else 0)
+                is_changed = is_changed or info != previous
+                self.connections[info.id] = info
+                self.last_message_id = max(self.last_message_id, row["max_new_msg_id"] or 0)
+                self.last_connection_id = max(self.last_connection_id, info.id)
+            if is_changed:
+                tree_rows = connections_to_tree(
+                    list(self.connections.values()), self.result_row_cache
+                )
+                self.model_merger.merge(tree_rows)
         self.timer.start()
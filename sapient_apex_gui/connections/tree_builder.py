@@ -383,13 +383,29 @@ def node_info_to_result_row(info_and_result_list: List[Tuple[ConnectionInfo, Res
 #
 
 
-def connections_to_tree(db_results):
+def connections_to_tree(db_results, result_row_cache: Optional[dict] = None):
+    """Converts the connections to a tree of rows.
+
+    If result_row_cache is given, the rows for each connection are kept in it (by connection ID)
+    and only recreated for connections that have changed since the previous call.
+    """
     if not db_results:
         return []
 
     # STEP 1: ConnectionInfo object to ResultRow for individual connection
     max_time = max(conn_info.max_time() for conn_info in db_results)
-    result_row_list = [connection_info_to_result_row(info, max_time) for info in db_results]
+    # Times are displayed relative to the date of max_time, so rows only change with its date
+    max_date = max_time.date()
+    result_row_list = []
+    for info in db_results:
+        cached = result_row_cache.get(info.id) if result_row_cache is not None else None
+        if cached is not None and cached[0] == info and cached[1] == max_date:
+            result_row_list.append(cached[2])
+            continue
+        result_row = connection_info_to_result_row(info, max_time)
+        if result_row_cache is not None:
+            result_row_cache[info.id] = (info, max_date, result_row)
+        result_row_list.append(result_row)
 
     # STEP 2: Group results together
     result_row_grouped = defaultdict(list)
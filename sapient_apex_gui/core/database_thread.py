@@ -79,6 +79,8 @@ class OpenDatabaseResponse:
     is_live: bool
     # Flag if message conversion was enabled when db was created
     conversion_enabled: bool
+    # Flag if db has the full-text search index of messages
+    has_search_index: bool = False
 
 
 @dataclass
@@ -159,6 +161,7 @@ class DatabaseThread(QtCore.QObject):
         error_str = None
         rollover_result = None
         conversion_enabled = True
+        has_search_index = False
         if not Path(req.filename).exists():
             error_str = "Could not find file"
             self._connection = None
@@ -173,13 +176,20 @@ class DatabaseThread(QtCore.QObject):
                     # Also need to check if db is live or old
                     rollover_result = self._connection.execute(select(RolloverFilename)).fetchall()
                     db_version_rows = self._connection.execute(select(Version)).fetchall()
+                    has_search_index = bool(
+                        self._connection.execute(
+                            text("SELECT 1 FROM sqlite_master WHERE name = 'MessageSearch'")
+                        ).fetchall()
+                    )
                 error_str, conversion_enabled = self._db_version_supported(db_version_rows)
             except SQLAlchemyError as e:
                 error_str = f"{type(e).__name__}: {e}"
                 logger.error(f"While opening {req.filename} caught {error_str}")
                 self._connection = None
         is_live = rollover_result is not None and len(rollover_result) == 0
-        response = OpenDatabaseResponse(req.filename, error_str, is_live, conversion_enabled)
+        response = OpenDatabaseResponse(
+            req.filename, error_str, is_live, conversion_enabled, has_search_index
+        )
         self._response_signal.emit(req.callback, response)
 
     def _handle_execute_request(self, req: DatabaseExecuteRequest):
@@ -189,7 +199,7 @@ class DatabaseThread(QtCore.QObject):
             try:
                 with self._connection.begin():
                     cursor = self._connection.execute(text(req.query), req.params)
-                    if req.should_fetch_results is not None:
+                    if req.should_fetch_results:
                         results = cursor.fetchall()
             except SQLAlchemyError as e:
                 logger.error(f"For query {req.name} got error: {e}")
@@ -44,6 +44,7 @@ class MainWindow(QMainWindow):
         self.db_thread = DatabaseThread()
         self.filename_label = QLabel()
         self.tab_widget = QTabWidget()
+        self.connections_tab = ConnectionsTab(self.db_thread)
         self.messages_tab = MessagesTab(self.db_thread)
         self.timer = QTimer()
         self.timer.timeout.connect(self.on_rollover_timer)
@@ -65,7 +66,7 @@ class MainWindow(QMainWindow):
                     },
                 },
                 self.tab_widget: {
-                    (ConnectionsTab(self.db_thread), "Connections"): {
+                    (self.connections_tab, "Connections"): {
                         "doubleClicked": self.on_connection_double_clicked
                     },
                     (MessageTypesTab(self.db_thread), "Message Types"): {},
@@ -138,11 +139,13 @@ class MainWindow(QMainWindow):
             label_text = f"({response.error_str}) {response.filename}"
         else:
             label_text = response.filename
+            self.connections_tab.reset()
             if response.is_live:
                 self.timer.start()
             else:
                 self.timer.stop()
         self.messages_tab.set_conversion_flag(response.conversion_enabled)
+        self.messages_tab.set_search_index_flag(response.has_search_index, response.is_live)
         self.filename_label.setText(label_text)
 
     def on_connection_double_clicked(self, index: QModelIndex):
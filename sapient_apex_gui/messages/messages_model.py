@@ -0,0 +1,228 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+"""Table model for the messages tab, which fetches its rows from the database as they are needed.
+
+Only the columns shown in the table are kept for each row; the (much larger) XML, JSON and proto
+payloads are fetched separately when a row is selected. Rows are fetched a block at a time when the
+view scrolls to the end of them (Qt's canFetchMore/fetchMore), up to a maximum number of rows, so
+the memory used is bounded however large the database is. Beyond that, the tab's Next button moves
+the window on.
+"""
+
+from enum import Enum, auto
+from typing import Optional
+
+from PySide6.QtCore import QAbstractTableModel, QModelIndex, Qt, Signal
+
+from sapient_apex_gui.core.database_thread import (
+    DatabaseExecuteRequest,
+    DatabaseResponse,
+    DatabaseThread,
+)
+from sapient_apex_gui.messages.messages_query import (
+    sql_filter_all,
+    sql_get_messages_after,
+    sql_get_messages_before,
+)
+from sapient_apex_server.time_util import datetime_int_to_str
+
+FETCH_SIZE = 100  # Rows fetched at a time
+MAX_ROWS = 10000  # Rows kept at most
+_MAX_ID = 2**63 - 1  # Largest possible SQLite row ID
+
+message_column_names = [
+    "ID",
+    "Connection",
+    "Node ID",
+    "Type",
+    "Forwarded",
+    "Timestamp",
+    "Received",
+    "Saved",
+    "Error Severity",
+    "Error Message",
+    "Status System",
+    "Is Unchanged",
+    "Node Type",
+]
+
+
+def db_row_to_columns(row: dict) -> tuple:
+    """Converts a row of the messages query into the values shown in each column."""
+    return (
+        row["id"],
+        row["connection_id"],
+        row["parsed_node_id"] or "-",
+        row["parsed_type"] or "-",
+        row["forwarded_count"],
+        datetime_int_to_str(row["parsed_timestamp"], quiet=True),
+        datetime_int_to_str(row["timestamp_received"], quiet=True),
+        datetime_int_to_str(row["timestamp_saved"], quiet=True),
+        row["error_severity"] or "-",
+        row["error_summary"] or "-",
+        row["status_report_system"] or "-",
+        (
+            bool(row["status_report_is_unchanged"])
+            if row["status_report_is_unchanged"] is not None
+            else "-"
+        ),
+        row["registration_node_type"] or "-",
+    )
+
+
+class FetchMode(Enum):
+    """What a fetch of messages is for, which decides how its results are used."""
+
+    PAGE = auto()  # Replace the rows, even if there are no results
+    MOVE = auto()  # Replace the rows, unless there are no results (already at first/last rows)
+    MORE = auto()  # Append the results, as the view has scrolled to the end
+    LIVE = auto()  # Append the results, dropping the oldest rows if there are too many
+
+
+class MessagesModel(QAbstractTableModel):
+    # Emitted when fetched rows have been applied to the model, with the number of new messages
+    # appended when following live (-1 if unknown), so the tab can keep its total up to date
+    fetched = Signal(int)
+
+    def __init__(self, db_thread: DatabaseThread, parent=None):
+        super().__init__(parent)
+        self.db_thread = db_thread
+        self.rows: list[tuple] = []
+        self.filter_sql = sql_filter_all
+        self.filter_params = {}
+        self.is_search = False
+        # Whether there are no more messages after the last row (until more arrive)
+        self.is_at_end = True
+        # Parameters and mode of the most recent fetch; responses to earlier ones are ignored
+        self.fetch_params = None
+        self.fetch_mode = FetchMode.PAGE
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(message_column_names)
+
+    def data(self, index: QModelIndex, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return self.rows[index.row()][index.column()]
+        return None
+
+    def headerData(self, section: int, orientation: Qt.Orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return message_column_names[section]
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()) -> bool:
+        return (
+            not parent.isValid()
+            and not self.is_at_end
+            and self.fetch_params is None
+            and len(self.rows) < MAX_ROWS
+        )
+
+    def fetchMore(self, parent=QModelIndex()):
+        if self.canFetchMore(parent):
+            self.fetch(FetchMode.MORE, after_id=self.last_id)
+
+    @property
+    def first_id(self) -> Optional[int]:
+        return self.rows[0][0] if self.rows else None
+
+    @property
+    def last_id(self) -> Optional[int]:
+        return self.rows[-1][0] if self.rows else None
+
+    def message_id(self, row: int) -> int:
+        return self.rows[row][0]
+
+    def set_filter(self, filter_sql: str, filter_params: dict, is_search: bool = False):
+        self.filter_sql = filter_sql
+        self.filter_params = filter_params
+        self.is_search = is_search
+
+    def fetch(self, mode: FetchMode, after_id=None, before_id=None):
+        """Fetches a block of messages after or before the given message ID."""
+        params = {"count_per_page": FETCH_SIZE, **self.filter_params}
+        if after_id is not None:
+            query = sql_get_messages_after(self.filter_sql, self.is_search)
+            params["after_id"] = after_id
+        else:
+            query = sql_get_messages_before(self.filter_sql, self.is_search)
+            params["before_id"] = before_id
+        self.fetch_params = params
+        self.fetch_mode = mode
+        self.db_thread.put(
+            DatabaseExecuteRequest(
+                name="get messages",
+                query=query,
+                params=params,
+                callback=self.on_fetched,
+                should_fetch_results=True,
+            )
+        )
+
+    def fetch_first(self):
+        self.fetch(FetchMode.PAGE, after_id=0)
+
+    def fetch_last(self, mode=FetchMode.PAGE):
+        self.fetch(mode, before_id=_MAX_ID)
+
+    def fetch_new(self):
+        """Fetches the messages that have arrived since the last row."""
+        if self.last_id is None:
+            self.fetch_last(FetchMode.LIVE)
+        else:
+            self.fetch(FetchMode.LIVE, after_id=self.last_id)
+
+    def on_fetched(self, response: DatabaseResponse):
+        if response.params is not self.fetch_params:
+            # Query response from previous inputs
+            return
+        self.fetch_params = None
+        rows = [db_row_to_columns(row._asdict()) for row in response.results]
+        is_after = "after_id" in response.params
+        if not is_after:
+            rows.reverse()
+        new_count = 0
+        if self.fetch_mode == FetchMode.LIVE and is_after:
+            if len(rows) == FETCH_SIZE:
+                # There may be even more new messages, so skip straight to the latest ones
+                self.fetch_last(FetchMode.LIVE)
+                return
+            new_count = len(rows)
+            self._append(rows)
+            self._remove_first(len(self.rows) - MAX_ROWS)
+        elif self.fetch_mode == FetchMode.MORE:
+            self._append(rows)
+            self.is_at_end = len(rows) < FETCH_SIZE
+        elif self.fetch_mode == FetchMode.MOVE and not rows:
+            # Already at the first or last rows, so leave them as they are
+            self.fetched.emit(0)
+            return
+        else:
+            if self.fetch_mode == FetchMode.LIVE:
+                new_count = -1  # Unknown, as messages were skipped to get to the latest ones
+            self.beginResetModel()
+            self.rows = rows
+            if is_after:
+                self.is_at_end = len(rows) < FETCH_SIZE
+            else:
+                # Rows fetched back from the end are the latest, otherwise later ones follow
+                self.is_at_end = response.params["before_id"] == _MAX_ID
+            self.endResetModel()
+        self.fetched.emit(new_count)
+
+    def _append(self, rows: list[tuple]):
+        if rows:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(rows) - 1)
+            self.rows.extend(rows)
+            self.endInsertRows()
+
+    def _remove_first(self, count: int):
+        if count > 0:
+            self.beginRemoveRows(QModelIndex(), 0, count - 1)
+            del self.rows[:count]
+            self.endRemoveRows()
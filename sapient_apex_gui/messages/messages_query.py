@@ -2,91 +2,87 @@
 # Copyright (c) 2019-2024 Roke Manor Research Ltd
 #
 
-"""SQL query for fetching data for the messages tab."""
+"""SQL queries for fetching data for the messages tab.
 
-sql_get_messages = """
-SELECT
-    id, connection_id, forwarded_count,
-    timestamp_received, timestamp_decoded, timestamp_saved,
-    xml, proto, json,
-    parsed_type, parsed_node_id, parsed_timestamp,
-    registration_node_type,
-    status_report_system, status_report_is_unchanged,
-    error_severity, error_description
-FROM
-    Message
-WHERE
-    id > (:current_page - 1) * :count_per_page
-    AND id <= :current_page * :count_per_page
-ORDER BY id
-"""
+Pages of messages are found by their IDs (keyset pagination) rather than with OFFSET, so that
+fetching a page costs the same however far into a large database it is: every filter below is
+covered by an index that ends in the message ID.
 
-sql_get_messages_for_connection = """
-SELECT
-    id, connection_id, forwarded_count,
-    timestamp_received, timestamp_decoded, timestamp_saved,
-    xml, proto, json,
-    parsed_type, parsed_node_id, parsed_timestamp,
-    registration_node_type,
-    status_report_system, status_report_is_unchanged,
-    error_severity, error_description
-FROM
-    Message
-WHERE
-    connection_id = :connection_id
-ORDER BY id
-LIMIT :count_per_page OFFSET (:current_page - 1) * :count_per_page
+A full-text search of the message JSON can be added to any filter, if the database has the search
+index (see sapient_apex_server.sqlite_saver). The index is then read in message ID order, so pages
+are still found by message ID and only as many matches are read as are shown.
 """
 
-sql_get_messages_for_connection_and_type = """
-SELECT
-    id, connection_id, forwarded_count,
-    timestamp_received, timestamp_decoded, timestamp_saved,
-    xml, proto, json,
-    parsed_type, parsed_node_id, parsed_timestamp,
-    registration_node_type,
-    status_report_system, status_report_is_unchanged,
-    error_severity, error_description
-FROM
-    Message
-WHERE
-    connection_id = :connection_id
-    AND parsed_type = :parsed_type
-ORDER BY id
-LIMIT :count_per_page OFFSET (:current_page - 1) * :count_per_page
-"""
+# Conditions for the messages shown, depending on whether connection ID and message type are set
+sql_filter_all = "1"
+sql_filter_connection = "connection_id = :connection_id"
+sql_filter_connection_and_type = "connection_id = :connection_id AND parsed_type = :parsed_type"
+sql_filter_connection_and_type_null = "connection_id = :connection_id AND parsed_type IS NULL"
+sql_filter_search = "MessageSearch MATCH :search"
+
+sql_has_search_index = "SELECT 1 FROM sqlite_master WHERE name = 'MessageSearch'"
+
+_from_sql = "Message"
+_search_from_sql = "MessageSearch JOIN Message ON Message.id = MessageSearch.rowid"
+
+
+def search_text_to_match(search_text: str) -> str:
+    """Converts text typed in the search box into an FTS5 MATCH expression. Each word must appear
+    in the message, so that IDs like UUIDs (which contain punctuation) can be typed as they are.
+    Text containing a double quote is passed through as an FTS5 query, e.g. for phrases or OR."""
+    if '"' in search_text:
+        return search_text
+    return " ".join(f'"{word}"' for word in search_text.split())
 
-sql_get_messages_for_connection_and_type_null = """
+
+# Only the columns shown in the table, with just the first line of any error description
+_sql_get_messages = """
 SELECT
     id, connection_id, forwarded_count,
-    timestamp_received, timestamp_decoded, timestamp_saved,
-    xml, proto, json,
+    timestamp_received, timestamp_saved,
     parsed_type, parsed_node_id, parsed_timestamp,
     registration_node_type,
     status_report_system, status_report_is_unchanged,
-    error_severity, error_description
+    error_severity,
+    substr(error_description, 1, instr(error_description || char(10), char(10)) - 1)
+        AS error_summary
 FROM
-    Message
+    {from_sql}
 WHERE
-    connection_id = :connection_id
-    AND parsed_type IS NULL
-ORDER BY id
-LIMIT :count_per_page OFFSET (:current_page - 1) * :count_per_page
+    {filter_sql}
+    AND {id_column} {id_comparison}
+ORDER BY {id_column} {direction}
+LIMIT :count_per_page
 """
 
 
-sql_count_messages = """
-SELECT COUNT(*) FROM Message
-"""
+def _sql_get_messages_by_id(filter_sql: str, is_search: bool, id_comparison: str, direction: str):
+    return _sql_get_messages.format(
+        from_sql=_search_from_sql if is_search else _from_sql,
+        filter_sql=filter_sql,
+        # Order by the search index's own row IDs (the message IDs), so it is read in order
+        id_column="MessageSearch.rowid" if is_search else "id",
+        id_comparison=id_comparison,
+        direction=direction,
+    )
 
-sql_count_messages_for_connection = """
-SELECT COUNT(*) FROM Message WHERE connection_id = :connection_id
-"""
 
-sql_count_messages_for_connection_and_type = """
-SELECT COUNT(*) FROM Message WHERE connection_id = :connection_id AND parsed_type = :parsed_type
-"""
+def sql_get_messages_after(filter_sql: str, is_search: bool = False) -> str:
+    """Query for the first :count_per_page messages with IDs above :after_id, in ID order."""
+    return _sql_get_messages_by_id(filter_sql, is_search, "> :after_id", "")
+
+
+def sql_get_messages_before(filter_sql: str, is_search: bool = False) -> str:
+    """Query for the last :count_per_page messages with IDs below :before_id, in reverse ID
+    order."""
+    return _sql_get_messages_by_id(filter_sql, is_search, "< :before_id", "DESC")
+
+
+def sql_count_messages(filter_sql: str, is_search: bool = False) -> str:
+    return f"SELECT COUNT(*) FROM {_search_from_sql if is_search else _from_sql} WHERE {filter_sql}"
+
 
-sql_count_messages_for_connection_and_type_null = """
-SELECT COUNT(*) FROM Message WHERE connection_id = :connection_id AND parsed_type IS NULL
+# The payloads of a single message, fetched when it is selected
+sql_get_message_payloads = """
+SELECT xml, json, proto, error_description FROM Message WHERE id = :id
 """
@@ -3,10 +3,9 @@
 #
 
 import logging
-import math
 import xml.etree.ElementTree as ET
 
-from PySide6.QtCore import QMargins, QModelIndex, Qt
+from PySide6.QtCore import QMargins, QModelIndex, Qt, QTimer
 from PySide6.QtGui import QFont, QGuiApplication
 from PySide6.QtWidgets import (
     QCheckBox,
@@ -27,21 +26,23 @@ from sapient_apex_gui.core.database_thread import (
     DatabaseResponse,
     DatabaseThread,
 )
-from sapient_apex_gui.messages.message_to_tree_row import (
-    db_row_to_tree_row,
-    message_column_names,
-)
+from sapient_apex_gui.messages.messages_model import FetchMode, MessagesModel
 from sapient_apex_gui.messages.messages_query import (
+    search_text_to_match,
     sql_count_messages,
-    sql_count_messages_for_connection,
-    sql_count_messages_for_connection_and_type,
-    sql_count_messages_for_connection_and_type_null,
-    sql_get_messages,
-    sql_get_messages_for_connection,
-    sql_get_messages_for_connection_and_type,
-    sql_get_messages_for_connection_and_type_null,
+    sql_filter_all,
+    sql_filter_connection,
+    sql_filter_connection_and_type,
+    sql_filter_connection_and_type_null,
+    sql_filter_search,
+    sql_get_message_payloads,
+    sql_has_search_index,
+)
+from sapient_apex_server.sqlite_saver import (
+    sql_create_search_table,
+    sql_create_search_trigger,
+    sql_rebuild_search_index,
 )
-from sapient_apex_qt_helpers.model_merger import ModelMerger
 from sapient_apex_qt_helpers.syntax_highligher_json import SyntaxHighlighterJson
 from sapient_apex_qt_helpers.syntax_highlighter_xml import SyntaxHighlighterXml
 from sapient_apex_qt_helpers.view_builder import build_view
@@ -49,7 +50,7 @@ from sapient_apex_qt_helpers.view_builder import build_view
 logger = logging.getLogger("apex_gui")
 
 
-_COUNT_PER_PAGE = 20
+_LIVE_INTERVAL_MS = 1000
 
 
 def _bytes_as_hex(x: bytes) -> str:
@@ -70,24 +71,40 @@ def _bytes_as_hex(x: bytes) -> str:
 class MessagesTab(QWidget):
     def __init__(self, db_thread: DatabaseThread):
         super().__init__()
-        # << First	< Prev	Page: 7	Of: 12	Next >	Last >>
+        # << First	< Prev	From ID: 1234	Total: 5678	Next >	Last >>	[] Follow live
         self.db_thread = db_thread
-        self.current_page = 1
-        self.last_page_pending = False
         self.current_connection_id = None
         self.current_message_type = None  # If not None, filter by this string
         self.current_message_type_is_null = False  # If True, filter by IS NULL
         self.conversion_enabled = False
+        self.has_search_index = False
+        self.filter_sql = None  # So that the first get_results counts the messages
+        self.filter_params = {}
+        self.is_search = False
+        self.total_count = 0
+        # Parameters of the most recent count and payload queries; earlier responses are ignored
+        self.count_params = None
+        self.payload_params = None
 
         # Controls on top line
-        self.current_page_edit = QLineEdit()
-        self.total_pages_edit = QLineEdit()
+        self.from_id_edit = QLineEdit()
+        self.total_count_edit = QLineEdit()
         self.current_connection_id_edit = QLineEdit()
         self.current_message_type_edit = QLineEdit()
+        self.search_edit = QLineEdit()
+        self.build_search_index_button = QPushButton("Build search index")
+        self.follow_live_check = QCheckBox("Follow &live")
+
+        # Fetches new messages while following live
+        self.live_timer = QTimer()
+        self.live_timer.setInterval(_LIVE_INTERVAL_MS)
+        self.live_timer.setSingleShot(True)
+        self.live_timer.timeout.connect(self.on_live_timer)
 
         # Main tree view showing list of messages
         self.messages_results_treeview = QTreeView()
-        self.messages_results_model_merger = ModelMerger(message_column_names)
+        self.messages_results_model = MessagesModel(db_thread)
+        self.messages_results_model.fetched.connect(self.on_messages_fetched)
 
         # Editor showing message
         font = QFont("Consolas")
@@ -125,19 +142,34 @@ class MessagesTab(QWidget):
                         "(Only valid if connection ID set; blank for all, 'null' for unparsed)"
                     ): {},
                 },
+                # Fourth toolbar for searching the message JSON
+                QHBoxLayout(): {
+                    QLabel("&Search:"): {
+                        "buddy": self.search_edit,
+                    },
+                    self.search_edit: {
+                        "returnPressed": self.get_results,
+                        "enabled": False,
+                    },
+                    QLabel("(Words in the message JSON; use double quotes for FTS5 syntax)"): {},
+                    self.build_search_index_button: {
+                        "clicked": self.build_search_index,
+                        "enabled": False,
+                    },
+                },
                 # Third toolbar for navigating pages
                 QHBoxLayout(): {
                     QPushButton("<< First"): {"clicked": self.page_first},
                     QPushButton("< Prev"): {"clicked": self.page_previous},
-                    QLabel("&Page:"): {
-                        "buddy": self.current_page_edit,
+                    QLabel("&From ID:"): {
+                        "buddy": self.from_id_edit,
                     },
-                    self.current_page_edit: {
+                    self.from_id_edit: {
                         "returnPressed": self.get_results,
                         "text": "1",
                     },
-                    QLabel("Of:"): {},
-                    self.total_pages_edit: {
+                    QLabel("Total:"): {},
+                    self.total_count_edit: {
                         "readOnly": True,
                         "text": "0",
                     },
@@ -147,12 +179,17 @@ class MessagesTab(QWidget):
                     QPushButton("Last >>"): {
                         "clicked": self.page_last,
                     },
+                    self.follow_live_check: {
+                        "clicked": self.follow_live_check_changed,
+                    },
                 },
                 QSplitter(): {
                     "orientation": Qt.Vertical,
                     # List of messages
                     self.messages_results_treeview: {
-                        "model": self.messages_results_model_merger.model,
+                        "model": self.messages_results_model,
+                        "rootIsDecorated": False,
+                        "uniformRowHeights": True,
                     },
                     # Individual message content, along with side buttons
                     QTabWidget(): {
@@ -216,61 +253,51 @@ class MessagesTab(QWidget):
     def set_conversion_flag(self, flag: bool):
         self.conversion_enabled = flag
 
-    def db_fetch_messages(self):
-        request = DatabaseExecuteRequest(
-            name="get messages",
-            query=sql_get_messages,
-            params={
-                "count_per_page": _COUNT_PER_PAGE,
-                "current_page": self.current_page,
-            },
-            callback=self.on_messages_fetched,
-            should_fetch_results=True,
+    def set_search_index_flag(self, has_search_index: bool, is_live: bool):
+        self.has_search_index = has_search_index
+        self.search_edit.setEnabled(has_search_index)
+        # Building the index of a live database would hold up Apex writing to it
+        self.build_search_index_button.setEnabled(not has_search_index and not is_live)
+
+    def build_search_index(self):
+        """Creates the search index of a database that was saved without it. This reads every
+        message, so may take a while for a large database."""
+        self.build_search_index_button.setEnabled(False)
+        self.build_search_index_button.setText("Building search index ...")
+        for name, query in (
+            ("create search table", sql_create_search_table),
+            ("create search trigger", sql_create_search_trigger),
+            ("build search index", sql_rebuild_search_index),
+        ):
+            self.db_thread.put(DatabaseExecuteRequest(name=name, query=query, params={}))
+        self.db_thread.put(
+            DatabaseExecuteRequest(
+                name="check search index",
+                query=sql_has_search_index,
+                params={},
+                callback=self.on_search_index_built,
+                should_fetch_results=True,
+            )
         )
-        if self.current_connection_id is not None:
-            request.params["connection_id"] = self.current_connection_id
-        if self.current_message_type_is_null:
-            request.name = "get msgs conn null type"
-            request.query = sql_get_messages_for_connection_and_type_null
-        elif self.current_message_type is not None:
-            request.name = "get msgs conn type"
-            request.query = sql_get_messages_for_connection_and_type
-            request.params["parsed_type"] = self.current_message_type
-        else:
-            request.name = "get msgs for conn"
-            request.query = sql_get_messages_for_connection
 
-        self.db_thread.put(request)
+    def on_search_index_built(self, response: DatabaseResponse):
+        self.build_search_index_button.setText("Build search index")
+        self.set_search_index_flag(bool(response.results), is_live=False)
 
     def db_count_messages(self):
-        request = DatabaseExecuteRequest(
-            name="count messages",
-            query=sql_count_messages,
-            params=(),
-            callback=self.on_count_fetched,
-            should_fetch_results=True,
+        self.count_params = dict(self.filter_params)
+        self.db_thread.put(
+            DatabaseExecuteRequest(
+                name="count messages",
+                query=sql_count_messages(self.filter_sql, self.is_search),
+                params=self.count_params,
+                callback=self.on_count_fetched,
+                should_fetch_results=True,
+            )
         )
-        if self.current_connection_id is not None:
-            if self.current_message_type_is_null:
-                request.name = "count msgs conn null type"
-                request.query = sql_count_messages_for_connection_and_type_null
-                request.params = {"connection_id": self.current_connection_id}
-            elif self.current_message_type is not None:
-                request.name = "count msgs conn type"
-                request.query = sql_count_messages_for_connection_and_type
-                request.params = {
-                    "connection_id": self.current_connection_id,
-                    "parsed_type": self.current_message_type,
-                }
-            else:
-                request.name = "count msgs for conn"
-                request.query = sql_count_messages_for_connection
-                request.params = {"connection_id": self.current_connection_id}
-
-        self.db_thread.put(request)
 
     def get_results(self, should_get_last_page=False):
-        """Parses connection ID and page number text boxes and calls above database routines"""
+        """Parses connection ID, message type and from ID text boxes and fetches messages"""
         try:
             if self.current_connection_id_edit.text().strip() == "":
                 new_connection_id = None
@@ -302,80 +329,127 @@ class MessagesTab(QWidget):
                 self.current_message_type_is_null = False
                 self.current_message_type = message_type_text
                 self.current_message_type_edit.setText(message_type_text)
-        if should_get_last_page:
-            self.last_page_pending = True
+
+        if self.current_connection_id is None:
+            filter_sql, filter_params = sql_filter_all, {}
+        elif self.current_message_type_is_null:
+            filter_sql = sql_filter_connection_and_type_null
+            filter_params = {"connection_id": self.current_connection_id}
+        elif self.current_message_type is not None:
+            filter_sql = sql_filter_connection_and_type
+            filter_params = {
+                "connection_id": self.current_connection_id,
+                "parsed_type": self.current_message_type,
+            }
+        else:
+            filter_sql = sql_filter_connection
+            filter_params = {"connection_id": self.current_connection_id}
+        search_text = self.search_edit.text().strip()
+        is_search = self.has_search_index and search_text != ""
+        if is_search:
+            filter_sql = f"{filter_sql} AND {sql_filter_search}"
+            filter_params = {**filter_params, "search": search_text_to_match(search_text)}
+        if (filter_sql, filter_params) != (self.filter_sql, self.filter_params):
+            # Only count the messages when the filter changes, not on every page
+            self.filter_sql, self.filter_params = filter_sql, filter_params
+            self.is_search = is_search
+            self.messages_results_model.set_filter(filter_sql, filter_params, is_search)
             self.db_count_messages()
-            # on_count_fetched will check the last_page_pending flag and then call db_fetch_messages
-            # with page number set to page count, so nothing else to do now
+
+        if should_get_last_page:
+            self.page_last()
             return
         try:
-            new_page = int(self.current_page_edit.text())
-            if new_page <= 0:
+            from_id = int(self.from_id_edit.text())
+            if from_id <= 0:
                 raise ValueError
         except ValueError:
-            self.current_page_edit.setText(str(self.current_page))
+            first_id = self.messages_results_model.first_id
+            self.from_id_edit.setText("" if first_id is None else str(first_id))
             return
-        self.current_page = new_page
-        self.last_page_pending = False  # On the off chance that count for last page is in flight
-        self.db_count_messages()
-        self.db_fetch_messages()
-
-    def on_messages_fetched(self, response: DatabaseResponse):
-        params = {"count_per_page": _COUNT_PER_PAGE, "current_page": self.current_page}
-        if self.current_connection_id is not None:
-            params["connection_id"] = self.current_connection_id
-        if self.current_message_type is not None:
-            params["parsed_type"] = self.current_message_type
-        if params != response.params:
-            # Query response from previous inputs
-            return
-        self.messages_results_model_merger.merge(
-            [db_row_to_tree_row(msg._asdict()) for msg in response.results]
-        )
+        self.set_following_live(False)
+        self.messages_results_model.fetch(FetchMode.PAGE, after_id=from_id - 1)
+
+    def on_messages_fetched(self, new_count: int):
+        if new_count < 0:
+            self.db_count_messages()
+        elif new_count:
+            self.total_count += new_count
+            self.total_count_edit.setText(str(self.total_count))
+        first_id = self.messages_results_model.first_id
+        self.from_id_edit.setText("" if first_id is None else str(first_id))
+        if self.follow_live_check.isChecked():
+            self.messages_results_treeview.scrollToBottom()
+            self.live_timer.start()
 
     def on_count_fetched(self, response: DatabaseResponse):
-        connection_id = response.params["connection_id"]
-        if connection_id != self.current_connection_id:
-            return
-        parsed_type = response.params.get("parsed_type", None)
-        if self.current_message_type != parsed_type:
+        if response.params is not self.count_params:
             return
-        count = response.results[0][0]
-        page_count = math.ceil(count / _COUNT_PER_PAGE)
-        self.total_pages_edit.setText(str(page_count))
-        if self.last_page_pending:
-            # If this query was triggered by clicking last page button, need to get actual messages
-            self.last_page_pending = False
-            if page_count == 0:
-                page_count = 1
-            self.current_page = page_count
-            self.current_page_edit.setText(str(self.current_page))
-            self.db_fetch_messages()
+        self.total_count = response.results[0][0] if response.results else 0
+        self.total_count_edit.setText(str(self.total_count))
+
+    def on_live_timer(self):
+        if self.follow_live_check.isChecked():
+            # Only the messages that have arrived since the last one shown
+            self.messages_results_model.fetch_new()
+
+    def set_following_live(self, is_following: bool):
+        self.follow_live_check.setChecked(is_following)
+        if not is_following:
+            self.live_timer.stop()
+
+    def follow_live_check_changed(self, is_checked):
+        if is_checked:
+            self.db_count_messages()
+            self.messages_results_model.fetch_last(FetchMode.LIVE)
+        else:
+            self.live_timer.stop()
 
     def page_first(self):
-        self.current_page_edit.setText("1")
-        self.get_results()
+        self.set_following_live(False)
+        self.messages_results_model.fetch_first()
 
     def page_previous(self):
-        self.current_page_edit.setText(str(self.current_page - 1))
-        self.get_results()
+        first_id = self.messages_results_model.first_id
+        if first_id is None:
+            return
+        self.set_following_live(False)
+        self.messages_results_model.fetch(FetchMode.MOVE, before_id=first_id)
 
     def page_next(self):
-        self.current_page_edit.setText(str(self.current_page + 1))
-        self.get_results()
+        last_id = self.messages_results_model.last_id
+        if last_id is None:
+            return
+        self.set_following_live(False)
+        self.messages_results_model.fetch(FetchMode.MOVE, after_id=last_id)
 
     def page_last(self):
-        self.get_results(should_get_last_page=True)
+        self.set_following_live(False)
+        self.messages_results_model.fetch_last()
 
     def on_selection_changed(self, index: QModelIndex, old_index: QModelIndex):
         if not index.isValid():
+            self.payload_params = None
             self.message_json_editor.setText("")
             self.message_proto_editor.setText("")
             self.message_errors.setText("")
             return
-        # The data is stored in the user data of the first column.
-        first_column = index.siblingAtColumn(0)
-        xml, json, proto_bytes, error_desc = first_column.data(Qt.UserRole)
+        # The payloads are not kept in the model, so fetch them for just this message
+        self.payload_params = {"id": self.messages_results_model.message_id(index.row())}
+        self.db_thread.put(
+            DatabaseExecuteRequest(
+                name="get message payloads",
+                query=sql_get_message_payloads,
+                params=self.payload_params,
+                callback=self.on_payloads_fetched,
+                should_fetch_results=True,
+            )
+        )
+
+    def on_payloads_fetched(self, response: DatabaseResponse):
+        if response.params is not self.payload_params or not response.results:
+            return
+        xml, json, proto_bytes, error_desc = response.results[0]
         if self.conversion_enabled:
             if isinstance(xml, bytes):
                 self.message_xml_editor.setText(xml.decode("utf8"))
@@ -0,0 +1,104 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+"""Works out which of the (rolled over) database files in a directory cover a time range.
+
+The first and last message times of each file are cached in a JSON file in the directory, so each
+file is only examined again if it has changed since.
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+
+logger = logging.getLogger("apex_replay")
+
+cache_filename = "replay_index.json"
+
+
+class ArchiveFile(NamedTuple):
+    filename: str
+    first_timestamp: int  # timestamp_received of the first and last messages in the file
+    last_timestamp: int
+
+
+class ArchiveIndex:
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.cache_path = self.directory / cache_filename
+
+    def _load_cache(self) -> dict:
+        try:
+            with self.cache_path.open("r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self, cache: dict):
+        try:
+            with self.cache_path.open("w") as f:
+                json.dump(cache, f, indent=2)
+        except OSError as e:
+            logger.warning(f"Could not save archive index {self.cache_path}: {e}")
+
+    @staticmethod
+    def _signature(path: Path) -> list[int]:
+        """Size and modification time of the file, including its write-ahead log if Apex is still
+        writing to it."""
+        signature = []
+        for file_path in (path, path.with_name(path.name + "-wal")):
+            if file_path.exists():
+                stat = file_path.stat()
+                signature += [stat.st_size, stat.st_mtime_ns]
+        return signature
+
+    @staticmethod
+    def _read_time_range(path: Path) -> Optional[tuple[int, int]]:
+        """Reads the first and last message times from a database file."""
+        engine = create_engine(f"sqlite:///{path}")
+        try:
+            with engine.connect() as connection:
+                first, last = connection.execute(
+                    text("SELECT MIN(timestamp_received), MAX(timestamp_received) FROM Message")
+                ).one()
+        except SQLAlchemyError as e:
+            logger.warning(f"Could not read database {path}: {e}")
+            return None
+        finally:
+            engine.dispose()
+        if first is None:
+            return None
+        return first, last
+
+    def get_files(self) -> list[ArchiveFile]:
+        """Gets the time range of every database file in the directory, in time order."""
+        cache = self._load_cache()
+        updated_cache = {}
+        files = []
+        for path in sorted(self.directory.glob("*.sqlite")):
+            signature = self._signature(path)
+            entry = cache.get(path.name)
+            if entry is None or entry["signature"] != signature:
+                logger.info(f"Indexing database file {path}")
+                entry = {"signature": signature, "range": self._read_time_range(path)}
+            updated_cache[path.name] = entry
+            if entry["range"] is not None:
+                files.append(ArchiveFile(str(path), *entry["range"]))
+        if updated_cache != cache:
+            self._save_cache(updated_cache)
+        # After a rollover, the new file also holds copies of recent messages from the old file,
+        # so its first timestamp is not useful for ordering
+        return sorted(files, key=lambda file: (file.last_timestamp, file.filename))
+
+    def get_files_covering(self, start_time: int, end_time: int) -> list[ArchiveFile]:
+        """Gets the files, in time order, with messages in the time range [start_time, end_time)."""
+        return [
+            file
+            for file in self.get_files()
+            if file.last_timestamp >= start_time and file.first_timestamp < end_time
+        ]
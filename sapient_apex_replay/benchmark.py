@@ -0,0 +1,123 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+"""Measures how quickly Apex forwards the messages sent to it by the replay tool.
+
+The receiver connects to a "forwardAll" Parent port of Apex, and matches each message forwarded to
+it with the message the replay tool sent, to give the end-to-end latency through Apex.
+"""
+
+import logging
+import statistics
+from collections import defaultdict, deque
+from typing import Iterable, Optional
+
+import trio
+
+from sapient_apex_server.structures import SapientVersion, to_sapient_version
+from sapient_apex_server.translator.proto_to_proto_translator import (
+    empty_sapient_message,
+)
+from sapient_apex_server.trio_util import receive_size_prefixed
+
+logger = logging.getLogger("apex_replay")
+
+
+class LatencyTracker:
+    """Matches forwarded messages to sent messages, and keeps their latencies.
+
+    Messages are matched by node ID and message type, first in first out, as Apex forwards the
+    messages from each node in the order they were received.
+    """
+
+    def __init__(self):
+        self.sent_times: dict[tuple, deque] = defaultdict(deque)
+        self.latencies: list[float] = []
+        self.sent_count = 0
+        self.received_count = 0
+        self.unmatched_count = 0
+        self.first_send_time: Optional[float] = None
+        self.last_send_time: Optional[float] = None
+        self.last_receive_time: Optional[float] = None
+
+    def on_sent(self, keys: Iterable[tuple], send_time: float):
+        if self.first_send_time is None:
+            self.first_send_time = send_time
+        self.last_send_time = send_time
+        for key in keys:
+            self.sent_times[key].append(send_time)
+            self.sent_count += 1
+
+    def on_received(self, key: tuple, receive_time: float):
+        self.received_count += 1
+        self.last_receive_time = receive_time
+        sent_times = self.sent_times.get(key)
+        if sent_times:
+            self.latencies.append(receive_time - sent_times.popleft())
+        else:
+            self.unmatched_count += 1
+
+    @property
+    def pending_count(self) -> int:
+        return sum(len(sent_times) for sent_times in self.sent_times.values())
+
+    def __str__(self):
+        result = f"messages forwarded: {self.received_count} of {self.sent_count} sent"
+        if self.first_send_time is not None and self.last_receive_time is not None:
+            elapsed = max(self.last_receive_time - self.first_send_time, 1e-6)
+            result += f" ({self.received_count / elapsed:0.1f} msg/s)"
+        if self.unmatched_count:
+            result += f", {self.unmatched_count} unmatched"
+        if len(self.latencies) >= 2:
+            percentiles = statistics.quantiles(self.latencies, n=100)
+            result += (
+                f"; latency p50: {percentiles[49] * 1000:0.1f}ms"
+                f", p90: {percentiles[89] * 1000:0.1f}ms"
+                f", p99: {percentiles[98] * 1000:0.1f}ms"
+                f", max: {max(self.latencies) * 1000:0.1f}ms"
+            )
+        return result
+
+
+class BenchmarkReceiver:
+    """Connection to an Apex Parent port, receiving the messages that Apex forwards."""
+
+    def __init__(self, config: dict, tracker: LatencyTracker):
+        self.host = config.get("host", "127.0.0.1")
+        self.port = config["port"]
+        self.sapient_version = to_sapient_version(
+            config.get("icd_version", SapientVersion.LATEST.name)
+        )
+        self.drain_seconds = config.get("drain_seconds", 2.0)
+        self.tracker = tracker
+
+    async def run(self, task_status=trio.TASK_STATUS_IGNORED):
+        stream = await trio.open_tcp_stream(self.host, self.port)
+        logger.info(f"Benchmark receiver connected to {self.host}:{self.port}")
+        task_status.started()
+        read_buffer = bytearray()
+        async with stream:
+            while True:
+                try:
+                    msg_bytes = await receive_size_prefixed(
+                        stream, read_buffer, max_size=128 * 1024 * 1024
+                    )
+                except EOFError:
+                    return
+                message = empty_sapient_message(self.sapient_version)
+                message.ParseFromString(bytes(msg_bytes))
+                self.tracker.on_received(
+                    (message.node_id, message.WhichOneof("content")), trio.current_time()
+                )
+
+    async def wait_until_drained(self):
+        """Waits until every sent message is forwarded, or none are for drain_seconds."""
+        while self.tracker.pending_count:
+            last_activity = max(
+                self.tracker.last_receive_time or float("-inf"),
+                self.tracker.last_send_time or float("-inf"),
+            )
+            if trio.current_time() - last_activity > self.drain_seconds:
+                break
+            await trio.sleep(0.1)
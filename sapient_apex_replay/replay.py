@@ -7,14 +7,19 @@ import logging
 import os
 import struct
 import sys
+from collections import Counter, defaultdict
 from pathlib import Path
+from typing import NamedTuple, Optional, Union
 
 import trio
 from google.protobuf.json_format import MessageToJson
 from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
 
+from sapient_apex_replay.archive_index import ArchiveIndex
+from sapient_apex_replay.benchmark import BenchmarkReceiver, LatencyTracker
 from sapient_apex_server.message_io import to_version
-from sapient_apex_server.structures import SapientVersion, MessageFormat
+from sapient_apex_server.structures import MessageFormat, SapientVersion, to_sapient_version
 from sapient_apex_server.time_util import datetime_int_to_str, datetime_str_to_int
 from sapient_apex_server.translator.proto_to_proto_translator import (
     empty_sapient_message,
@@ -28,26 +33,95 @@ from sapient_msg.latest.sapient_message_pb2 import SapientMessage
 
 logger = logging.getLogger("apex_replay")
 
+# Indices needed to seek to the start time. They are created when a database is first replayed,
+# so Apex does not maintain them while recording.
+replay_indices = {
+    "index_message_timestamp_received": """
+        CREATE INDEX IF NOT EXISTS index_message_timestamp_received
+            ON Message(timestamp_received)
+        """,
+    "index_message_type_node_unchanged_received": """
+        CREATE INDEX IF NOT EXISTS index_message_type_node_unchanged_received
+            ON Message(parsed_type, parsed_node_id, status_report_is_unchanged, timestamp_received)
+        """,
+}
+
+# Optional filters on the messages to replay: config key -> (column, index name, index SQL).
+# The indices are only created when the filter is used, so Apex does not maintain them otherwise.
+replay_filters = {
+    "node_ids": (
+        "parsed_node_id",
+        "index_message_node_received",
+        """
+        CREATE INDEX IF NOT EXISTS index_message_node_received
+            ON Message(parsed_node_id, timestamp_received)
+        """,
+    ),
+    "message_types": (
+        "parsed_type",
+        "index_message_type_received",
+        """
+        CREATE INDEX IF NOT EXISTS index_message_type_received
+            ON Message(parsed_type, timestamp_received)
+        """,
+    ),
+    "connection_ids": (
+        "connection_id",
+        "index_message_connection_received",
+        """
+        CREATE INDEX IF NOT EXISTS index_message_connection_received
+            ON Message(connection_id, timestamp_received)
+        """,
+    ),
+}
+
+
+class ReplayMessage(NamedTuple):
+    timestamp: int
+    data: bytes
+    node_id: Optional[str]
+    message_type: Optional[str]
+    connection_id: Optional[int] = None
+
+
+class RecordedConnection(NamedTuple):
+    """A connection recorded in the database, with the format to replay its messages in."""
+
+    id: int
+    client_type: str
+    peer: str
+    message_format: MessageFormat
+    sapient_version: SapientVersion
+
 
 class Database:
     """Handles opening a connection to the database and reading messages from it."""
 
     def __init__(self, config):
         self.config_url = config["filename"]
+        self.config_data_directory = config.get("data_directory", "data")
         self.config_start_time_str = config["start_time"]
         self.config_start_time = datetime_str_to_int(self.config_start_time_str)
         self.config_end_time = datetime_str_to_int(config["end_time"])
         self.connection = None
         self.has_got_initial_messages = False
         self.cursor = None
-        self.most_recent_row = None
-        self.sapient_version = SapientVersion[
+        # The files to replay and their connections; the first one is also self.connection
+        self.filenames: list[str] = []
+        self.file_connections = []
+        self.file_start_times: list[int] = []
+        self.file_number = 0
+        self.next_rows = []
+        self.block_size = config.get("block_size", 1000)
+        # Only the filters that are configured, as lists of values to match
+        self.filters: dict[str, list] = {
+            key: config[key] for key in replay_filters if config.get(key)
+        }
+        self.sapient_version = to_sapient_version(
             config.get("icd_version", SapientVersion.LATEST.name)
-            .replace(" ", "_")
-            .replace(".", "_")
-            .replace("-", "_")
-            .upper()
-        ]
+        )
+        # When replaying each recorded connection separately: the format for each connection ID
+        self.connection_formats: dict[int, tuple[MessageFormat, SapientVersion]] = {}
 
     @staticmethod
     def _connection_info_to_str(connection_info):
@@ -72,24 +146,50 @@ class Database:
         result += " - msg count: " + str(msg_count)
         return result
 
-    def connect(self):
-        """Connects to the database."""
+    def _find_files(self):
+        """Works out which files to replay, and the time to start replaying each one from."""
+        if self.config_url:
+            self.filenames = [self.config_url]
+            self.file_start_times = [self.config_start_time]
+            return
 
-        # Create the connection
-        url = self.config_url
-        if not url:
-            logger.info("No filename specified - using latest file in data directory")
-            files = sorted(Path("data").glob("*.sqlite"))
-            if not files:
-                logger.critical("No files found in data directory")
-            url = str(files[-1])
-        logger.info(f"Connecting to database: {url}")
+        logger.info(
+            f"No filename specified - using files in {self.config_data_directory} directory"
+            + " covering the time range"
+        )
+        files = ArchiveIndex(Path(self.config_data_directory)).get_files_covering(
+            self.config_start_time, self.config_end_time
+        )
+        if not files:
+            logger.critical(f"No files found in {self.config_data_directory} directory")
+            raise ValueError("No files covering start time " + self.config_start_time_str)
+        self.filenames = [file.filename for file in files]
+        # After a rollover, the new file starts with copies of recent messages from the previous
+        # one, so only replay messages after the last one in the previous file
+        self.file_start_times = [self.config_start_time] + [
+            max(self.config_start_time, file.last_timestamp + 1) for file in files[:-1]
+        ]
 
+    @staticmethod
+    def _open(filename: str):
+        url = filename
         if ":///" not in url:
             url = f"sqlite:///{url}"
+        return create_engine(url).connect()
+
+    def connect(self):
+        """Connects to the database."""
 
-        self.engine = create_engine(url)
-        self.connection = self.engine.connect()
+        # Create the connections
+        self._find_files()
+        for filename in self.filenames:
+            logger.info(f"Connecting to database: {filename}")
+            connection = self._open(filename)
+            self.file_connections.append(connection)
+            self._create_indices(connection)
+        if self.filters:
+            logger.info(f"Only replaying messages with {self.filters}")
+        self.connection = self.file_connections[0]
 
         # Log some information about connections in the database
         connection_info_sql = """
@@ -117,93 +217,278 @@ class Database:
         ]
         logger.info(f"{len(connection_strs)} connections:\n" + "\n".join(connection_strs))
 
-        # Start the main query that iterates over messages
+        self._execute_messages_query()
+        self.next_rows = self._fetch_rows()
+
+    def _execute_messages_query(self):
+        # Start the main query that iterates over messages in the requested time window
         messages_sql = """
         SELECT
             timestamp_received,
+            connection_id,
             xml,
             proto,
             parsed_type,
             parsed_node_id,
-            status_report_is_unchanged,
             sapient_version
         FROM
             Message
         WHERE
             error_severity IS NULL
+            AND timestamp_received >= :start_time
+            AND timestamp_received < :end_time
+            {filter_sql}
+        ORDER BY
+            timestamp_received, id
+        """
+        filter_sql, filter_params = self._get_filter_sql(self.filters)
+        if self.cursor is not None:
+            self.cursor.close()
+        self.cursor = self.file_connections[self.file_number].execute(
+            text(messages_sql.format(filter_sql=filter_sql)),
+            {
+                "start_time": self.file_start_times[self.file_number],
+                "end_time": self.config_end_time,
+                **filter_params,
+            },
+        )
+
+    @staticmethod
+    def _get_filter_sql(filters: dict[str, list]) -> tuple[str, dict]:
+        """Gets the SQL conditions (and their parameters) that apply the configured filters."""
+        conditions = []
+        params = {}
+        for key, values in filters.items():
+            column = replay_filters[key][0]
+            names = [f"{key}{i}" for i in range(len(values))]
+            conditions.append(f"AND {column} IN ({', '.join(':' + name for name in names)})")
+            params.update(zip(names, values))
+        return " ".join(conditions), params
+
+    def _fetch_rows(self) -> list:
+        """Fetches the next rows, moving on to the next file when one has been read."""
+        while True:
+            rows = self.cursor.fetchmany(self.block_size)
+            if rows or self.file_number + 1 >= len(self.filenames):
+                return rows
+            self.file_number += 1
+            logger.info(f"Continuing replay from database: {self.filenames[self.file_number]}")
+            self._execute_messages_query()
+
+    def _create_indices(self, connection):
+        """Creates the indices used to seek to the start time and to apply the configured filters,
+        if the database does not have them yet."""
+        indices = dict(replay_indices)
+        indices.update(replay_filters[key][1:] for key in self.filters)
+        existing = set(
+            connection.execute(
+                text("SELECT name FROM sqlite_master WHERE type = 'index'")
+            ).scalars()
+        )
+        missing = [name for name in indices if name not in existing]
+        if not missing:
+            return
+        logger.info(f"Creating indices {missing}, this may take a while for a large database")
+        try:
+            with connection.engine.begin() as index_connection:
+                for name in missing:
+                    index_connection.execute(text(indices[name]))
+        except SQLAlchemyError as e:
+            logger.warning(f"Could not create indices, replay will be slow to start: {e}")
+
+    def _get_node_ids(self, msg_type: str) -> list:
+        """Gets the IDs of the nodes that sent any message of the given type.
+
+        Each node ID is looked up in the index after the previous one, rather than scanning every
+        message of that type.
+        """
+        node_ids = []
+        node_id = self.connection.execute(
+            text("SELECT MIN(parsed_node_id) FROM Message WHERE parsed_type = :msg_type"),
+            {"msg_type": msg_type},
+        ).scalar()
+        while node_id is not None:
+            node_ids.append(node_id)
+            node_id = self.connection.execute(
+                text(
+                    "SELECT MIN(parsed_node_id) FROM Message"
+                    " WHERE parsed_type = :msg_type AND parsed_node_id > :node_id"
+                ),
+                {"msg_type": msg_type, "node_id": node_id},
+            ).scalar()
+        return node_ids
+
+    def _get_latest_before_start(self, msg_type: str, node_id, is_unchanged):
+        """Gets the most recent message of the given type from the node before the start time."""
+        latest_sql = """
+        SELECT
+            timestamp_received,
+            id,
+            connection_id,
+            xml,
+            proto,
+            parsed_type,
+            parsed_node_id,
+            sapient_version
+        FROM
+            Message
+        WHERE
+            parsed_type = :msg_type
+            AND parsed_node_id = :node_id
+            AND status_report_is_unchanged IS :is_unchanged
+            AND timestamp_received < :start_time
+            AND error_severity IS NULL
+            {filter_sql}
+        ORDER BY
+            timestamp_received DESC, id DESC
+        LIMIT 1
+        """
+        # The message type and node ID are already given, so only filter by connection
+        filter_sql, filter_params = self._get_filter_sql(
+            {key: values for key, values in self.filters.items() if key == "connection_ids"}
+        )
+        return self.connection.execute(
+            text(latest_sql.format(filter_sql=filter_sql)),
+            {
+                "msg_type": msg_type,
+                "node_id": node_id,
+                "is_unchanged": is_unchanged,
+                "start_time": self.config_start_time,
+                **filter_params,
+            },
+        ).first()
+
+    def get_connections(self) -> list[RecordedConnection]:
+        """Gets the connections that were open during the specified time range.
+
+        Each connection is replayed in the format (and ICD version) of its first message. Connection
+        IDs are kept when they are copied to a new file on rollover, so are the same in every file.
+        """
+        connections_sql = """
+        SELECT
+            Connection.id,
+            Connection.client_type,
+            Connection.peer,
+            (
+                SELECT sapient_version
+                FROM Message
+                WHERE Message.connection_id = Connection.id
+                ORDER BY Message.id
+                LIMIT 1
+            ) AS sapient_version
+        FROM
+            Connection
+        WHERE
+            connect_time < :end_time
+            AND (disconnect_time IS NULL OR disconnect_time >= :start_time)
         ORDER BY
-            id
+            Connection.id
         """
-        self.cursor = self.connection.execute(text(messages_sql))
-        self.most_recent_row = self.cursor.fetchone()
+        rows = {}
+        for connection in self.file_connections:
+            for row in connection.execute(
+                text(connections_sql),
+                {"start_time": self.config_start_time, "end_time": self.config_end_time},
+            ):
+                if row.sapient_version is None:
+                    continue  # No messages to replay
+                if row.id in self.filters.get("connection_ids", [row.id]):
+                    rows.setdefault(row.id, row)
+        connections = []
+        for _, row in sorted(rows.items()):
+            sapient_version = SapientVersion[row.sapient_version]
+            message_format = (
+                MessageFormat.XML
+                if sapient_version == SapientVersion.VERSION6
+                else MessageFormat.PROTO
+            )
+            connections.append(
+                RecordedConnection(
+                    row.id, row.client_type, row.peer, message_format, sapient_version
+                )
+            )
+        return connections
+
+    def _to_replay_message(self, row, message_format: MessageFormat) -> ReplayMessage:
+        sapient_version = self.sapient_version
+        if row.connection_id in self.connection_formats:
+            message_format, sapient_version = self.connection_formats[row.connection_id]
+        if message_format == MessageFormat.PROTO:
+            msg_data = to_version_as_bytes(
+                row.proto, SapientVersion[row.sapient_version], sapient_version
+            )
+        elif message_format == MessageFormat.XML:
+            # Directly take the xml column, as its already
+            # been downgraded via parse_proto message conversion
+            msg_data = row.xml
+        node_id = str(row.parsed_node_id) if row.parsed_node_id is not None else None
+        return ReplayMessage(
+            row.timestamp_received, msg_data, node_id, row.parsed_type, row.connection_id
+        )
 
     def get_initial_messages(self, message_format: MessageFormat):
         """Gets the most recent registration etc from before start time.
         messages up to, but not including, the start time.
         """
+        if not self.next_rows:
+            raise ValueError("No messages after start time " + self.config_start_time_str)
+
         messages = {}
-        while True:
-            if self.most_recent_row is None:
-                raise ValueError("No messages after start time " + self.config_start_time_str)
-            (
-                timestamp,
-                xml,
-                proto,
-                msg_type,
-                node_id,
-                is_unchanged,
-                sapient_version,
-            ) = self.most_recent_row
-            if timestamp >= self.config_start_time:
-                break  # Reached first message in requested time window
-
-            if msg_type in ("registration", "status_report"):
-                if msg_type == "status_report":
-                    if is_unchanged:
-                        msg_type = "status_report_unch"
-                    elif (node_id, "status_report_unch") in messages:
-                        # "New" status reports replace earlier "Unchanged" reports
-                        del messages[node_id, "status_report_unch"]
-
-                if message_format == MessageFormat.PROTO:
-                    messages[node_id, msg_type] = to_version_as_bytes(
-                        proto,
-                        SapientVersion[sapient_version],
-                        self.sapient_version,
-                    )
-                elif message_format == MessageFormat.XML:
-                    # Directly take the xml column, as its already
-                    # been downgraded via parse_proto message conversion
-                    messages[node_id, msg_type] = xml
+        msg_types = self.filters.get("message_types", ["registration", "status_report"])
+        if "node_ids" in self.filters:
+            node_ids = set(self.filters["node_ids"])
+        else:
+            node_ids = set(self._get_node_ids("registration"))
+            node_ids.update(self._get_node_ids("status_report"))
+        for node_id in node_ids:
+            registration = status_new = status_unch = None
+            if "registration" in msg_types:
+                registration = self._get_latest_before_start("registration", node_id, None)
+            if "status_report" in msg_types:
+                status_new = self._get_latest_before_start("status_report", node_id, False)
+                status_unch = self._get_latest_before_start("status_report", node_id, True)
+            if (
+                status_new is not None
+                and status_unch is not None
+                and status_unch[:2] < status_new[:2]
+            ):
+                # "New" status reports replace earlier "Unchanged" reports
+                status_unch = None
 
+            for msg_type, row in (
+                ("registration", registration),
+                ("status_report", status_new),
+                ("status_report_unch", status_unch),
+            ):
+                if row is not None:
+                    messages[node_id, msg_type] = self._to_replay_message(row, message_format)
+
+        return [message for _, message in sorted(messages.items())]
+
+    def fetch_block(self) -> list:
+        """Gets the next block of rows within the specified time range, empty when all are read."""
+        rows, self.next_rows = self.next_rows, []
+        if not rows:
             assert self.cursor is not None
-            self.most_recent_row = self.cursor.fetchone()
+            rows = self._fetch_rows()
+        return rows
 
-        return [msg_data for _, msg_data in sorted(messages.items())]
+    def convert_block(self, rows: list, message_format: MessageFormat) -> list[ReplayMessage]:
+        """Converts a block of rows to messages ready to send."""
+        return [self._to_replay_message(row, message_format) for row in rows]
 
     def get_messages(self, message_format: MessageFormat):
         """Gets all messages within the specified time range."""
-        while self.most_recent_row is not None:
-            timestamp, xml, proto, *_ = self.most_recent_row
-            if self.config_end_time is not None and timestamp >= self.config_end_time:
-                break
-
-            msg_data = proto
-            if message_format == MessageFormat.PROTO:
-                sapient_version = SapientVersion[self.most_recent_row[-1]]
-                proto = to_version_as_bytes(proto, sapient_version, self.sapient_version)
-            elif message_format == MessageFormat.XML:
-                msg_data = xml
-
-            yield timestamp, msg_data
-            assert self.cursor is not None
-            self.most_recent_row = self.cursor.fetchone()
+        while rows := self.fetch_block():
+            yield from self.convert_block(rows, message_format)
 
     def close(self):
         if self.cursor is not None:
             self.cursor.close()
-        if self.connection is not None:
-            self.connection.close()
+        for connection in self.file_connections:
+            connection.close()
+        self.file_connections = []
+        self.connection = None
 
 
 async def read_proto_message(receive_stream: trio.abc.ReceiveStream, read_buffer: bytearray):
@@ -228,6 +513,7 @@ class NetworkConnection:
         self.streams = []
         self.connection_establish_signal = trio.lowlevel.ParkingLot()
         self.message_format = MessageFormat[self.config.get("format", "PROTO")]
+        self.received_counts = Counter()  # Messages received back from Apex e.g. acks, by type
 
     async def connect(self, nursery: trio.Nursery, task_status=trio.TASK_STATUS_IGNORED):
         """Open the network connection.
@@ -263,22 +549,34 @@ class NetworkConnection:
                 message_bytes = await read_proto_message(stream, read_buffer)
                 message_proto = SapientMessage()
                 message_proto.ParseFromString(message_bytes)
+                self.received_counts[message_proto.WhichOneof("content")] += 1
                 message_json = MessageToJson(message_proto, preserving_proto_field_name=True)
                 logger.debug("Received proto message from connection:\n" + message_json)
             elif self.message_format == MessageFormat.XML:
                 message_bytes = await read_xml_message(stream, read_buffer)
                 message_xml = message_bytes.decode("utf8")
+                self.received_counts["xml"] += 1
                 logger.debug("Received xml message from connection:\n" + message_xml)
 
     async def send(self, msg_data):
         """Sends the given data to the connection."""
-        logger.debug(f"Sending {self.message_format} message:\n{msg_data}")
+        await self.send_many([msg_data])
+
+    async def send_messages(self, messages: list[ReplayMessage]):
+        await self.send_many([msg.data for msg in messages])
+
+    async def send_many(self, msg_data_list: list):
+        """Sends the given messages to the connection, with a single write."""
+        if logger.isEnabledFor(logging.DEBUG):
+            for msg_data in msg_data_list:
+                logger.debug(f"Sending {self.message_format} message:\n{msg_data}")
+        if self.message_format == MessageFormat.PROTO:
+            msg_bytes = b"".join(
+                struct.pack("<I", len(msg_data)) + msg_data for msg_data in msg_data_list
+            )
+        elif self.message_format == MessageFormat.XML:
+            msg_bytes = b"".join(msg_data + b"\0" for msg_data in msg_data_list)
         for stream in self.streams:
-            if self.message_format == MessageFormat.PROTO:
-                packed_len = struct.pack("<I", len(msg_data))
-                msg_bytes = packed_len + msg_data
-            elif self.message_format == MessageFormat.XML:
-                msg_bytes = msg_data + b"\0"
             await stream.send_all(msg_bytes)
 
     async def close(self):
@@ -286,6 +584,142 @@ class NetworkConnection:
             await stream.aclose()
 
 
+class ConnectionPool:
+    """Replays each recorded connection on a separate connection, preserving the topology.
+
+    Each connection is made to the port in the "connections" config with the same type and format
+    as the recorded connection, preferring one with the same ICD version. Messages are sent by a
+    task for each connection, so a slow connection does not hold up the others.
+    """
+
+    queue_size = 16  # Batches of messages waiting to be sent, per connection
+
+    def __init__(self, config: dict, recorded_connections: list[RecordedConnection]):
+        self.connections: dict[int, NetworkConnection] = {}
+        self.formats: dict[int, tuple[MessageFormat, SapientVersion]] = {}
+        self.send_channels: dict[int, trio.MemorySendChannel] = {}
+        self.senders_done: list[trio.Event] = []
+        self.dropped_count = 0
+        for recorded in recorded_connections:
+            target = self._find_target(config["connections"], recorded)
+            if target is None:
+                logger.warning(
+                    f"No {recorded.client_type} {recorded.message_format.name} connection"
+                    f" configured, not replaying connection {recorded.id} ({recorded.peer})"
+                )
+                continue
+            sapient_version = recorded.sapient_version
+            if recorded.message_format == MessageFormat.PROTO and "icd_version" in target:
+                sapient_version = to_sapient_version(target["icd_version"])
+            self.formats[recorded.id] = (recorded.message_format, sapient_version)
+            self.connections[recorded.id] = NetworkConnection(
+                {
+                    **config,
+                    "is_outbound": True,
+                    "host": target.get("host", config["host"]),
+                    "port": target["port"],
+                    "format": recorded.message_format.name,
+                }
+            )
+        logger.info(f"Replaying {len(self.connections)} connections")
+
+    @staticmethod
+    def _find_target(targets: list[dict], recorded: RecordedConnection) -> Optional[dict]:
+        matches = [
+            target
+            for target in targets
+            if target["type"].upper() == recorded.client_type.upper()
+            and MessageFormat[target.get("format", "PROTO")] == recorded.message_format
+        ]
+        for target in matches:
+            if to_sapient_version(target.get("icd_version", "LATEST")) == recorded.sapient_version:
+                return target
+        return matches[0] if matches else None
+
+    @property
+    def received_counts(self) -> Counter:
+        return sum(
+            (connection.received_counts for connection in self.connections.values()), Counter()
+        )
+
+    async def connect(self, nursery: trio.Nursery, task_status=trio.TASK_STATUS_IGNORED):
+        """Opens all the connections, and waits until they are all established."""
+        task_status.started()
+        async with trio.open_nursery() as connect_nursery:
+            for connection in self.connections.values():
+                connect_nursery.start_soon(connection.connect, nursery)
+        for connection_id, connection in self.connections.items():
+            send_channel, receive_channel = trio.open_memory_channel(self.queue_size)
+            self.send_channels[connection_id] = send_channel
+            done = trio.Event()
+            self.senders_done.append(done)
+            nursery.start_soon(self._send_from_channel, connection, receive_channel, done)
+
+    @staticmethod
+    async def _send_from_channel(
+        connection: NetworkConnection, receive_channel: trio.MemoryReceiveChannel, done: trio.Event
+    ):
+        async with receive_channel:
+            async for msg_data_list in receive_channel:
+                await connection.send_many(msg_data_list)
+        done.set()
+
+    async def send_messages(self, messages: list[ReplayMessage]):
+        """Passes the messages to the tasks sending on their recorded connections."""
+        msg_data_lists = defaultdict(list)
+        for msg in messages:
+            msg_data_lists[msg.connection_id].append(msg.data)
+        for connection_id, msg_data_list in msg_data_lists.items():
+            send_channel = self.send_channels.get(connection_id)
+            if send_channel is None:
+                self.dropped_count += len(msg_data_list)
+                continue
+            await send_channel.send(msg_data_list)
+
+    async def close(self):
+        # Let the messages already queued be sent before closing
+        for send_channel in self.send_channels.values():
+            await send_channel.aclose()
+        for done in self.senders_done:
+            await done.wait()
+        self.send_channels = {}
+        self.senders_done = []
+        if self.dropped_count:
+            logger.warning(f"{self.dropped_count} messages from connections not replayed")
+            self.dropped_count = 0
+        for connection in self.connections.values():
+            await connection.close()
+
+
+class ReplayStats:
+    """Throughput and lag statistics of the replayed messages."""
+
+    def __init__(self):
+        self.start_time = trio.current_time()
+        self.message_count = 0
+        self.byte_count = 0
+        self.send_count = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    def record_send(self, message_count: int, byte_count: int, lag: float):
+        self.message_count += message_count
+        self.byte_count += byte_count
+        self.send_count += 1
+        self.total_lag += lag * message_count
+        self.max_lag = max(self.max_lag, lag)
+
+    def __str__(self):
+        elapsed = max(trio.current_time() - self.start_time, 1e-6)
+        mean_lag = self.total_lag / self.message_count if self.message_count else 0.0
+        return (
+            f"messages sent: {self.message_count} in {self.send_count} writes "
+            f"({self.message_count / elapsed:0.1f} msg/s, "
+            f"{self.byte_count / elapsed / 1000:0.1f} kB/s); "
+            f"lag mean: {mean_lag:0.3f}s, max: {self.max_lag:0.3f}s"
+        )
+
+
 class Sleeper:
     """Sleeps a suitable amount of time until messages are ready to send.
 
@@ -303,37 +737,104 @@ class Sleeper:
         self.db_start_time = datetime_str_to_int(config["start_time"]) / 1_000_000
         self.real_start_time = trio.current_time()
         self.speed_multiplier = config["speed_multiplier"]
+        self.max_speed = config.get("max_speed", False)  # Send as fast as possible if True
         self.last_lag_warn_time = self.real_start_time - 10  # Note last log time so not too chatty
         self.last_info_time = self.real_start_time - 10  # Separate counter for info level
-        self.message_count = 0
+        self.stats = ReplayStats()
 
-    async def sleep_until_message_time(self, db_current_time_ms: int):
-        # Compute deadline
+    def get_deadline(self, db_current_time_ms: int) -> float:
+        """Gets the (trio) time at which a message with the given database time is due."""
         db_current_time = db_current_time_ms / 1_000_000
         db_time_difference = db_current_time - self.db_start_time
         real_time_difference = db_time_difference / self.speed_multiplier
-        deadline = self.real_start_time + real_time_difference
+        return self.real_start_time + real_time_difference
 
-        # Warn if high lag or about to wait a long time (due to big gap between messages)
+    async def sleep_until_message_time(self, db_current_time_ms: int):
         current_time = trio.current_time()
-        wait_time = deadline - current_time
-        if wait_time < -1 and (current_time - self.last_lag_warn_time) >= 1:
-            logger.warning(f"Lag of {-wait_time:0.1f}s")
-            self.last_lag_warn_time = current_time
-        elif wait_time > 5:
-            logger.warning(f"Waiting for extended time: {wait_time:0.1f}s")
+        if self.max_speed:
+            await trio.lowlevel.checkpoint()
+        else:
+            # Compute deadline
+            deadline = self.get_deadline(db_current_time_ms)
+
+            # Warn if high lag or about to wait a long time (due to big gap between messages)
+            wait_time = deadline - current_time
+            if wait_time < -1 and (current_time - self.last_lag_warn_time) >= 1:
+                logger.warning(f"Lag of {-wait_time:0.1f}s")
+                self.last_lag_warn_time = current_time
+            elif wait_time > 5:
+                logger.warning(f"Waiting for extended time: {wait_time:0.1f}s")
 
-        # Actually perform the sleep
-        await trio.sleep_until(deadline)
+            # Actually perform the sleep
+            await trio.sleep_until(deadline)
 
-        # Log time and number of messages sometimes
+        # Log time, number of messages and rates sometimes
         if current_time - self.last_info_time > 2:
             logger.info(
                 f"Current database time: {datetime_int_to_str(db_current_time_ms)}; "
-                + f"messages sent: {self.message_count}"
+                + str(self.stats)
             )
             self.last_info_time = current_time
-        self.message_count += 1
+
+
+async def fetch_blocks(database: Database, send_channel: trio.MemorySendChannel):
+    """First stage of the replay pipeline: reads blocks of rows from the database."""
+    async with send_channel:
+        while rows := await trio.to_thread.run_sync(database.fetch_block):
+            await send_channel.send(rows)
+
+
+async def convert_blocks(
+    database: Database,
+    message_format: MessageFormat,
+    receive_channel: trio.MemoryReceiveChannel,
+    send_channel: trio.MemorySendChannel,
+):
+    """Second stage of the replay pipeline: converts rows to messages of the ICD version."""
+    async with receive_channel, send_channel:
+        async for rows in receive_channel:
+            block = await trio.to_thread.run_sync(database.convert_block, rows, message_format)
+            await send_channel.send(block)
+
+
+async def send_blocks(
+    receive_channel: trio.MemoryReceiveChannel,
+    network_connection: Union[NetworkConnection, ConnectionPool],
+    sleeper: Sleeper,
+    coalesce_seconds: float,
+    tracker: Optional[LatencyTracker] = None,
+):
+    """Last stage of the replay pipeline: sends the messages when they are due.
+
+    Messages due within coalesce_seconds of the first unsent one are sent with it, in one write.
+    In max speed mode each block is sent straight away, in one write.
+    """
+
+    async def send_batch(batch: list[ReplayMessage]):
+        await sleeper.sleep_until_message_time(batch[0].timestamp)
+        lag = 0.0
+        if not sleeper.max_speed:
+            lag = max(trio.current_time() - sleeper.get_deadline(batch[0].timestamp), 0.0)
+        if tracker is not None:
+            tracker.on_sent(((msg.node_id, msg.message_type) for msg in batch), trio.current_time())
+        await network_connection.send_messages(batch)
+        sleeper.stats.record_send(len(batch), sum(len(msg.data) for msg in batch), lag)
+
+    batch = []
+    async with receive_channel:
+        async for block in receive_channel:
+            if sleeper.max_speed:
+                await send_batch(block)
+                continue
+            for msg in block:
+                if batch and (msg.timestamp - batch[0].timestamp) / 1_000_000 > (
+                    coalesce_seconds * sleeper.speed_multiplier
+                ):
+                    await send_batch(batch)
+                    batch = []
+                batch.append(msg)
+        if batch:
+            await send_batch(batch)
 
 
 async def start_replayer(config, task_status=trio.TASK_STATUS_IGNORED):
@@ -345,24 +846,54 @@ async def start_replayer(config, task_status=trio.TASK_STATUS_IGNORED):
         )
         database = Database(config)
         database.connect()
-        network_connection = NetworkConnection(config)
+        if "connections" in config:
+            network_connection = ConnectionPool(config, database.get_connections())
+            database.connection_formats = network_connection.formats
+        else:
+            network_connection = NetworkConnection(config)
         message_format = MessageFormat[config.get("format", "PROTO")]
+        tracker = None
+        receiver = None
+        if "benchmark_receiver" in config:
+            tracker = LatencyTracker()
+            receiver = BenchmarkReceiver(config["benchmark_receiver"], tracker)
         async with trio.open_nursery() as nursery:
+            if receiver is not None:
+                # Connect first so that all the forwarded messages are received
+                await nursery.start(receiver.run)
             await network_connection.connect(nursery, task_status)
-            msg_count = 0
-            for msg_count, msg_data in enumerate(
-                database.get_initial_messages(message_format), start=1
-            ):
-                await network_connection.send(msg_data)
-            logger.info(f"Sent {msg_count} initial messages")
+            initial_messages = database.get_initial_messages(message_format)
+            if tracker is not None:
+                tracker.on_sent(
+                    ((msg.node_id, msg.message_type) for msg in initial_messages),
+                    trio.current_time(),
+                )
+            await network_connection.send_messages(initial_messages)
+            logger.info(f"Sent {len(initial_messages)} initial messages")
             sleeper = Sleeper(config)  # Must be constructed after above potentially slow calls
-            msg_count = 0
-            for msg_count, (msg_time, msg_data) in enumerate(
-                database.get_messages(message_format), start=1
-            ):
-                await sleeper.sleep_until_message_time(msg_time)
-                await network_connection.send(msg_data)
-            logger.info(f"Sent all {msg_count} non-initial messages")
+            # Rows are read and converted ahead of time in worker threads, so that neither holds
+            # up the sending of messages
+            prefetch_blocks = config.get("prefetch_blocks", 4)
+            rows_send, rows_receive = trio.open_memory_channel(prefetch_blocks)
+            blocks_send, blocks_receive = trio.open_memory_channel(prefetch_blocks)
+            async with trio.open_nursery() as pipeline_nursery:
+                pipeline_nursery.start_soon(fetch_blocks, database, rows_send)
+                pipeline_nursery.start_soon(
+                    convert_blocks, database, message_format, rows_receive, blocks_send
+                )
+                await send_blocks(
+                    blocks_receive,
+                    network_connection,
+                    sleeper,
+                    config.get("coalesce_seconds", 0.01),
+                    tracker,
+                )
+            logger.info(f"Sent all non-initial messages; {sleeper.stats}")
+            if receiver is not None:
+                await receiver.wait_until_drained()
+                logger.info(f"Benchmark results: {tracker}")
+            if network_connection.received_counts:
+                logger.info(f"Received from Apex: {dict(network_connection.received_counts)}")
             await network_connection.close()
             network_connection = None
     except trio.ClosedResourceError:
@@ -17,7 +17,10 @@ from fastapi import FastAPI
 from sapient_apex_api.server import create_server
 from sapient_apex_api.controller import router
 from sapient_apex_api.interface.elastic_interface import ElasticInterface
+from sapient_apex_api.interface.sqlite_interface import SqliteInterface
 from sapient_apex_api.manager import Manager
+from sapient_apex_api.response_cache import ResponseCache
+from sapient_apex_api.streaming import MessageBroadcaster
 
 from sapient_apex_server.apex_server import Callbacks, ApexServer
 from sapient_apex_server.sqlite_thread import SqliteThread
@@ -66,29 +69,52 @@ class ApexMain:
     def __init__(self, config):
         self.startup_complete = Event()
         self.database = None
-
-        # Connect to Elasticsearch
-        self.database_queue = Queue()
-        if config.get("elasticConfig", {}).get("enabled", False):
-            self.database = ElasticInterface(config.get("elasticConfig", {}))
-        if self.database:
-            router.set_db_interface(self.database)
-            self.manager = Manager(self.database)
+        self.manager = None
 
         # Create the database (by running the database thread)
         Path("data").mkdir(exist_ok=True)
         date_str = datetime_to_str(datetime.utcnow()).replace(":", "-")
         sqlite_filename = f"data/data-{date_str}.sqlite"
+        use_elastic = config.get("elasticConfig", {}).get("enabled", False)
+        use_sqlite_api = not use_elastic and config.get("apiConfig", {}).get(
+            "useSqliteDatabase", False
+        )
         self.sqlite_thread = SqliteThread(
             filename=sqlite_filename,
             rollover_config=config.get("rollover"),
             conversion_enabled=config.get("enableMessageConversion", True),
+            search_index=config.get("enableSearchIndex", False),
+            api_indices=use_sqlite_api,
+        )
+
+        # Connect to Elasticsearch, or else answer the REST API from the SQLite database
+        self.database_queue = Queue()
+        if use_elastic:
+            self.database = ElasticInterface(config.get("elasticConfig", {}))
+            self.manager = Manager(self.database)
+        elif use_sqlite_api:
+            self.database = SqliteInterface(sqlite_filename)
+        self.response_cache = None
+        if self.database:
+            router.set_db_interface(self.database)
+            cache_ttl = config.get("apiConfig", {}).get("cacheTtlSeconds", 10)
+            if cache_ttl > 0:
+                self.response_cache = ResponseCache(cache_ttl)
+                router.set_response_cache(self.response_cache)
+
+        # Live message streams of the REST API
+        self.broadcaster = MessageBroadcaster(
+            queue_size=config.get("apiConfig", {}).get("streamQueueSize", 100)
         )
+        router.set_broadcaster(self.broadcaster)
 
         def write_message_to_db(msg: MessageRecord):
             self.sqlite_thread.add(msg)
-            if self.database:
+            if self.manager:
                 self.manager.add_sapient_message(msg)
+            if self.response_cache:
+                self.response_cache.on_message(msg)
+            self.broadcaster.publish(msg)
 
         # Run the server
         callbacks = Callbacks(
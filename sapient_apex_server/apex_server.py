@@ -8,26 +8,41 @@ import math
 from dataclasses import dataclass
 from datetime import datetime
 from threading import Event
-from typing import Callable
+from typing import Callable, Dict, Optional
 
 import trio
 
-from sapient_apex_server.connection import ConnectionCreator
+from sapient_apex_server.connection import (
+    ChildConnection,
+    ConnectionCreator,
+    ParentConnection,
+)
 from sapient_apex_server.message_io import ConnectionWriter
-from sapient_apex_server.parse_proto import parse_proto
+from sapient_apex_server.overload import LoadLevel, OverloadController
+from sapient_apex_server.parse_proto import parse_proto, peek_detection
 from sapient_apex_server.parse_xml import parse_xml
+from sapient_apex_server.rate_limit import (
+    RateLimit,
+    RateLimitAction,
+    RateLimiter,
+    TokenBucket,
+    rate_limited_record,
+)
 from sapient_apex_server.structures import (
     ConnectionRecord,
     DisconnectionRecord,
+    ErrorRecord,
     ErrorSeverity,
     MessageFormat,
     MessageRecord,
     ReceivedDataRecord,
     SapientVersion,
+    UnstoredError,
 )
 from sapient_apex_server.translator.id_generator import IdGenerator
 from sapient_apex_server.trio_util import (
     BufferedWriter,
+    SlowConsumerPolicy,
     ThreadSafeCancelScope,
     connect_tcp_repeatedly,
     receive_size_prefixed,
@@ -68,6 +83,16 @@ class ApexServer:
         )
         self.top_level_cancel_scope = ThreadSafeCancelScope()
         self.id_generator = IdGenerator(config)
+        # Writers of connections with the BLOCK slow consumer policy, which all connections wait
+        # for before handling each message they read
+        self.blocking_writers: list[BufferedWriter] = []
+        # Rate limits for particular node IDs, and their token buckets shared by all connections
+        self.node_rate_limits = {
+            node_id: RateLimit.from_config(limit_config)
+            for node_id, limit_config in config.get("nodeRateLimits", {}).items()
+        }
+        self.node_rate_buckets: Dict[str, TokenBucket] = {}
+        self.overload = OverloadController(config.get("overloadShedding", {}))
 
     async def serve(self, stream: trio.SocketStream, connection_config: dict):
         """The main connection handling function, which shuffles data between other classes."""
@@ -78,7 +103,11 @@ class ApexServer:
             connection_config, self.config["enableMessageConversion"]
         )
 
-        buffered_writer = BufferedWriter(stream, self.config["messageMaxSizeKb"] * 1024 * 10)
+        buffered_writer = BufferedWriter(
+            stream,
+            self.config["messageMaxSizeKb"] * 1024 * 10,
+            policy=connection_config["slowConsumerPolicy"],
+        )
         connection_id, connection = self.connection_creator.create(
             connection_config,
             ConnectionWriter(
@@ -97,6 +126,15 @@ class ApexServer:
                 datetime.utcnow(),
             )
         )
+        buffered_writer.name = f"Connection {connection_id}"
+        rate_limiter = RateLimiter(
+            buffered_writer.name,
+            connection_config["rateLimit"],
+            self.node_rate_limits,
+            self.node_rate_buckets,
+        )
+        if buffered_writer.policy == SlowConsumerPolicy.BLOCK:
+            self.blocking_writers.append(buffered_writer)
         msg_send_channel, msg_recv_channel = trio.open_memory_channel(max_buffer_size=math.inf)
 
         # One of the tasks for this connection: just reads messages and puts on a memory channel.
@@ -117,6 +155,14 @@ class ApexServer:
                     max_size=self.config["messageMaxSizeKb"] * 1024,
                     return_delimiter=True,
                 )
+                # Check rate limits before the message costs anything more; only a registered
+                # Child connection has a node ID
+                action = rate_limiter.check(
+                    connection.node_id if isinstance(connection, ChildConnection) else None,
+                    trio.current_time(),
+                )
+                if action == RateLimitAction.DROP:
+                    continue
                 global _previous_message_id
                 _previous_message_id += 1
                 raw_message = ReceivedDataRecord(
@@ -124,31 +170,85 @@ class ApexServer:
                     message_id=_previous_message_id,
                     timestamp=datetime.utcnow(),
                     data_bytes=message_bytes,
+                    is_rate_limited=action == RateLimitAction.RECORD_ONLY,
                 )
                 msg_send_channel.send_nowait(raw_message)
+                self.overload.backlog += 1
 
+        enable_message_conversion = self.config.get("enableMessageConversion", True)
+        detection_filter = (
+            connection.detection_filter_error if isinstance(connection, ChildConnection) else None
+        )
         parser = _get_parser(
             connection_config["format"],
-            enable_message_conversion=self.config.get("enableMessageConversion", True),
+            enable_message_conversion=enable_message_conversion,
             enable_sensor_id_auto=self.config.get("autoAssignSensorIDInRegistration", {}).get(
                 "enable", True
             ),
             sapient_version=connection_config["icd_version"],
+            detection_filter=detection_filter,
+        )
+        is_proto = (
+            not enable_message_conversion or connection_config["format"] == MessageFormat.PROTO
         )
 
+        def is_sampled_before_parsing(raw_message: ReceivedDataRecord) -> bool:
+            """Whether a protobuf message is a detection that can be sampled before parsing, which
+            excludes those the parser will drop anyway for their confidence."""
+            if not is_proto or self.overload.level < LoadLevel.SAMPLE_DETECTIONS:
+                return False
+            peeked = peek_detection(raw_message.data_bytes)
+            return peeked is not None and (
+                detection_filter is None or detection_filter(peeked.detection_confidence) is None
+            )
+
         # The main read task for the connection: pulls messages off of the read channel and
         # processes them.
         async def read_from_channel():
             validator = Validator(self.validation_config)
             async for raw_message in msg_recv_channel:
+                self.overload.backlog -= 1
+                if raw_message.is_rate_limited:
+                    self.callbacks.on_message_receive(
+                        rate_limited_record(
+                            raw_message,
+                            connection_config["format"],
+                            connection_config["icd_version"],
+                        )
+                    )
+                    continue
+
+                # Only some detections are handled while most overloaded; protobuf detections are
+                # sampled before parsing, so those not sampled are discarded without being parsed
+                is_sampled = is_sampled_before_parsing(raw_message)
+                if is_sampled and not self.overload.keep_detection():
+                    self.overload.update(datetime.utcnow() - raw_message.timestamp)
+                    continue
+
                 # Parse the message (if valid); use a worker thread in case it takes a while
+                # (doing less while overloaded)
                 msg = await trio.to_thread.run_sync(
-                    parser,
+                    functools.partial(parser, load_level=self.overload.level),
                     raw_message,
                     validator,
                     self.id_generator,
                     limiter=self.parser_thread_token,
                 )
+                self.overload.update(datetime.utcnow() - raw_message.timestamp)
+                # Other detections (from XML, or that could not be peeked at) are sampled once
+                # they have been parsed
+                if (
+                    not is_sampled
+                    and msg.error is None
+                    and msg.parsed is not None
+                    and msg.parsed.message_type == "detection_report"
+                    and not self.overload.keep_detection()
+                ):
+                    msg.error = UnstoredError("Detection not sampled while overloaded")
+
+                # Wait for any slow connection that must not miss messages
+                for blocking_writer in list(self.blocking_writers):
+                    await blocking_writer.wait_writable()
 
                 # Actually handle the message; this is done in the connection object.
                 # This can set more fields in the message record (error, forwarded_count).
@@ -165,6 +265,7 @@ class ApexServer:
                     raise ApexError(msg.error.description)
 
         error_messages = []
+        downsampler = connection.downsampler if isinstance(connection, ParentConnection) else None
 
         def exception_handler(e):
             """To cope with members of trio exceptions, we use this with MultiError.catch()."""
@@ -189,6 +290,8 @@ class ApexServer:
                     nursery.start_soon(buffered_writer.perform_writes)
                     nursery.start_soon(read_to_channel)
                     nursery.start_soon(read_from_channel)
+                    if downsampler is not None:
+                        nursery.start_soon(downsampler.run)
         finally:
             if read_buffer:
                 if len(read_buffer) > 40:
@@ -196,6 +299,22 @@ class ApexServer:
                 else:
                     buf_str = repr(read_buffer[:40])
                 error_messages.append(f" ({len(read_buffer)} read bytes outstanding: {buf_str})")
+            if buffered_writer.dropped_count or buffered_writer.coalesced_count:
+                error_messages.append(
+                    f"({buffered_writer.dropped_count} messages dropped and"
+                    f" {buffered_writer.coalesced_count} coalesced as writes were slow)"
+                )
+            if (
+                rate_limiter.dropped_count
+                or rate_limiter.sampled_count
+                or rate_limiter.recorded_count
+            ):
+                error_messages.append(f"({rate_limiter.counts_str()} messages over the rate limit)")
+            if downsampler is not None and downsampler.held_back_count:
+                error_messages.append(f"({downsampler.counts_str()})")
+            self.overload.backlog -= msg_recv_channel.statistics().current_buffer_used
+            if buffered_writer in self.blocking_writers:
+                self.blocking_writers.remove(buffered_writer)
             error = "; ".join(error_messages)
             logger.info(f"Connection {connection_id} fatal error: {error}")
             connection.handle_closed()
@@ -265,18 +384,21 @@ def _get_parser(
     enable_message_conversion: bool = True,
     enable_sensor_id_auto: bool = True,
     sapient_version: SapientVersion = SapientVersion.LATEST,
+    detection_filter: Optional[Callable[[Optional[float]], Optional[ErrorRecord]]] = None,
 ):
     if not enable_message_conversion:
         return functools.partial(
             parse_proto,
             enable_message_conversion=False,
             sapient_version=sapient_version,
+            detection_filter=detection_filter,
         )
     if message_format == MessageFormat.PROTO:
         return functools.partial(
             parse_proto,
             enable_message_conversion=True,
             sapient_version=sapient_version,
+            detection_filter=detection_filter,
         )
     if message_format == MessageFormat.XML:
         return functools.partial(parse_xml, enable_sensor_id_auto=enable_sensor_id_auto)
@@ -297,4 +419,10 @@ def normalize_connection_config(config: dict, enable_conversion: bool = True) ->
     else:
         format = config["icd_version"].upper().replace(" ", "_").replace(".", "_")
         config["icd_version"] = SapientVersion[format]
+    config["slowConsumerPolicy"] = SlowConsumerPolicy[
+        config.get("slowConsumerPolicy", "DISCONNECT")
+    ]
+    config["rateLimit"] = (
+        RateLimit.from_config(config["rateLimit"]) if "rateLimit" in config else None
+    )
     return config
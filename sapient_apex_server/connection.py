@@ -19,11 +19,18 @@ import string
 import textwrap
 import uuid
 import xml.etree.ElementTree as ET
-from dataclasses import dataclass
+from collections import OrderedDict
+from collections.abc import Hashable
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
+from enum import Enum, auto
 from itertools import chain
 from typing import Dict, List, Optional
 
+import trio
+
+from sapient_apex_server.downsample import DetectionDownsampler
+from sapient_apex_server.geofence import Geofence
 from sapient_apex_server.message_io import WriterType
 from sapient_apex_server.parse_xml import insert_sensor_id
 from sapient_apex_server.structures import (
@@ -65,10 +72,187 @@ class SensorInfo:
     recent_status_unchanged: Optional[MessageRecord] = None
 
 
+@dataclass(frozen=True)
+class Subscription:
+    """Which messages a Parent connection wants, from the "subscriptions" in its config.
+
+    These narrow down the messages the Parent would otherwise be sent (high-level messages, or all
+    messages if forwardAll is set). Each condition is ignored if it is not set.
+    """
+
+    message_types: Optional[frozenset[str]] = None
+    node_ids: Optional[frozenset[str]] = None
+    min_detection_confidence: Optional[float] = None
+    zones: Optional[frozenset[str]] = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> "Subscription":
+        message_types = config.get("messageTypes")
+        node_ids = config.get("nodeIds")
+        zones = config.get("zones")
+        return cls(
+            frozenset(message_types) if message_types else None,
+            frozenset(node_ids) if node_ids else None,
+            config.get("minDetectionConfidence"),
+            frozenset(zones) if zones else None,
+        )
+
+    def wants_type(self, message_type: Optional[str]) -> bool:
+        return self.message_types is None or message_type in self.message_types
+
+    def needs_message_check(self, message_type: Optional[str]) -> bool:
+        """Whether messages of this type must also be passed to wants_message()."""
+        return self.node_ids is not None or (
+            (self.min_detection_confidence is not None or self.zones is not None)
+            and message_type == "detection_report"
+        )
+
+    def wants_message(self, msg: MessageRecord) -> bool:
+        """Checks the conditions that depend on more than the message type."""
+        if self.node_ids is not None and msg.parsed.node_id not in self.node_ids:
+            return False
+        if (
+            self.min_detection_confidence is not None
+            and msg.parsed.detection_confidence is not None
+            and msg.parsed.detection_confidence < self.min_detection_confidence
+        ):
+            return False
+        if (
+            self.zones is not None
+            and msg.geofence_zones is not None
+            and not msg.geofence_zones & self.zones
+        ):
+            return False
+        return True
+
+    def wants(self, msg: MessageRecord) -> bool:
+        message_type = msg.parsed.message_type if msg.parsed else None
+        return self.wants_type(message_type) and (
+            not self.needs_message_check(message_type) or self.wants_message(msg)
+        )
+
+
 @dataclass
 class ParentWriter:
     writer: WriterType
     message_format: MessageFormat
+    forward_all: bool = False
+    subscription: Subscription = Subscription()
+    downsampler: Optional[DetectionDownsampler] = None
+
+
+class ParentRouter:
+    """Routing table of which Parent connections each message is forwarded to.
+
+    The Parents that want each type of message are worked out the first time that type is sent
+    (separately for high-level messages, which are also sent to Parents without forwardAll), and
+    then reused until a Parent connects or disconnects. Each entry has the Parents that want every
+    message of that type, and those that must check each message against their subscription.
+    """
+
+    def __init__(self):
+        self.writers: List[ParentWriter] = []
+        self.routes: Dict[tuple, tuple[List[ParentWriter], List[ParentWriter]]] = {}
+
+    def add(self, parent_writer: ParentWriter):
+        self.writers.append(parent_writer)
+        self.routes.clear()
+
+    def remove(self, parent_writer: ParentWriter):
+        self.writers.remove(parent_writer)
+        self.routes.clear()
+
+    def _get_route(self, high_level: bool, message_type: Optional[str]):
+        route = self.routes.get((high_level, message_type))
+        if route is None:
+            subscribers = [
+                parent_writer
+                for parent_writer in self.writers
+                if (high_level or parent_writer.forward_all)
+                and parent_writer.subscription.wants_type(message_type)
+            ]
+            route = (
+                [w for w in subscribers if not w.subscription.needs_message_check(message_type)],
+                [w for w in subscribers if w.subscription.needs_message_check(message_type)],
+            )
+            self.routes[(high_level, message_type)] = route
+        return route
+
+    def send(
+        self,
+        msg: MessageRecord,
+        high_level: bool,
+        except_writer: Optional[WriterType] = None,
+    ):
+        unconditional, conditional = self._get_route(high_level, msg.parsed.message_type)
+        for parent_writer in chain(
+            unconditional, (w for w in conditional if w.subscription.wants_message(msg))
+        ):
+            if parent_writer.writer is except_writer:
+                continue
+            if (
+                parent_writer.downsampler is not None
+                and msg.parsed.message_type == "detection_report"
+            ):
+                if parent_writer.downsampler.send(msg, trio.current_time()):
+                    msg.forwarded_count += 1
+            else:
+                parent_writer.writer(msg, msg.sapient_version)
+                msg.forwarded_count += 1
+
+
+class DuplicateKey(Enum):
+    """What makes a detection report a duplicate of an earlier one from the same node."""
+
+    PAYLOAD = auto()  # Identical message bytes, e.g. retransmitted by the node
+    OBJECT = auto()  # Same object ID and message timestamp, e.g. from several sensors of a node
+
+
+@dataclass
+class DuplicateFilter:
+    """Detection reports seen recently, from the "duplicateSuppression" config.
+
+    Each report is remembered for the window after it was received (or until there are more than
+    max_entries newer ones), and any copy received in that time is a duplicate.
+    """
+
+    key: DuplicateKey
+    window: timedelta
+    max_entries: int
+    seen: "OrderedDict[Hashable, datetime]" = field(default_factory=OrderedDict)
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["DuplicateFilter"]:
+        if not config.get("enable"):
+            return None
+        return cls(
+            key=DuplicateKey[config.get("key", "PAYLOAD")],
+            window=timedelta(seconds=config.get("windowSeconds", 5)),
+            max_entries=config.get("maxEntries", 100_000),
+        )
+
+    def _key(self, msg: MessageRecord) -> Hashable:
+        if self.key == DuplicateKey.PAYLOAD:
+            return msg.parsed.node_id, hash(bytes(msg.received.data_bytes))
+        return (
+            msg.parsed.node_id,
+            msg.parsed.parsed_proto.detection_report.object_id,
+            msg.parsed.message_timestamp,
+        )
+
+    def is_duplicate(self, msg: MessageRecord) -> bool:
+        """Whether the message is a copy of one seen recently, remembering it if not."""
+        now = msg.received.timestamp
+        while self.seen:
+            oldest_time = next(iter(self.seen.values()))
+            if now - oldest_time <= self.window and len(self.seen) < self.max_entries:
+                break
+            self.seen.popitem(last=False)
+        key = self._key(msg)
+        if key in self.seen:
+            return True
+        self.seen[key] = now
+        return False
 
 
 @dataclass
@@ -81,9 +265,10 @@ class SharedData:
     next_auto_sensor_id: int
     dmm_msg_format: MessageFormat
     dmm_writers: List[WriterType]
-    parent_high_level_writers: List[ParentWriter]
-    parent_all_writers: List[ParentWriter]
+    parent_router: ParentRouter
     parent_message_format: MessageFormat
+    duplicate_filter: Optional[DuplicateFilter] = None
+    geofence: Optional[Geofence] = None
 
     def send_to_parent(
         self,
@@ -93,13 +278,13 @@ class SharedData:
     ):
         if msg.error is not None:
             return
-        writers = self.parent_all_writers
-        if high_level:
-            writers = chain(writers, self.parent_high_level_writers)
-        for writer in writers:
-            if writer != except_writer:
-                writer.writer(msg, msg.sapient_version)
-                msg.forwarded_count += 1
+        if (
+            self.geofence is not None
+            and msg.geofence_zones is None
+            and msg.parsed.message_type == "detection_report"
+        ):
+            msg.geofence_zones = self.geofence.zones_of(msg)
+        self.parent_router.send(msg, high_level, except_writer)
 
     def send_registration_ack(
         self,
@@ -182,7 +367,8 @@ def _apply_timestamp_offset(
         )
         return
     msg.parsed.message_timestamp += offset
-    if message_format is MessageFormat.PROTO:
+    # Without parsed XML (e.g. while overloaded), XML is translated from the proto when written
+    if message_format is MessageFormat.PROTO or msg.parsed.parsed_xml is None:
         msg.parsed.parsed_proto.timestamp.FromDatetime(msg.parsed.message_timestamp)
         msg.updated_data_bytes = msg.parsed.parsed_proto.SerializeToString()
     else:
@@ -230,24 +416,33 @@ class ChildConnection:
             else:
                 self.detection_filter_error_severity = ErrorSeverity.UNSTORED
 
-    def _filter_detection(self, msg: MessageRecord):
+    def detection_filter_error(
+        self, detection_confidence: Optional[float]
+    ) -> Optional[ErrorRecord]:
+        """Returns the error for a detection with this confidence if it fails the filter, or None.
+        This only reads the config, so the parser thread calls it to drop detections early."""
         # Check whether it makes sense to apply filter
-        if self.detection_confidence_threshold is None:
-            return
-        if msg.parsed is None or msg.parsed.detection_confidence is None:
-            return
+        if self.detection_confidence_threshold is None or detection_confidence is None:
+            return None
 
         # Check whether filter is passed
-        if msg.parsed.detection_confidence >= self.detection_confidence_threshold:
-            return
+        if detection_confidence >= self.detection_confidence_threshold:
+            return None
 
         # Failed filter
-        msg.error = ErrorRecord(
+        return ErrorRecord(
             self.detection_filter_error_severity,
-            f"Detection confidence {msg.parsed.detection_confidence} "
+            f"Detection confidence {detection_confidence} "
             + f"less than filter threshold {self.detection_confidence_threshold}",
         )
 
+    def _filter_detection(self, msg: MessageRecord):
+        if msg.parsed is None:
+            return
+        error = self.detection_filter_error(msg.parsed.detection_confidence)
+        if error is not None:
+            msg.error = error
+
     def _handle_registration(self, reg_msg: MessageRecord, generator: IdGenerator):
         # Check for errors
         if reg_msg.error is not None:
@@ -310,6 +505,28 @@ class ChildConnection:
             msg.error = SilentError(f"Node ID {self.node_id} hijacked by another connection")
             return
 
+        # Drop copies of recent detections (before the message timestamp is adjusted)
+        duplicate_filter = self.shared_data.duplicate_filter
+        if (
+            duplicate_filter is not None
+            and msg.parsed.message_type == "detection_report"
+            and duplicate_filter.is_duplicate(msg)
+        ):
+            msg.error = SilentError("Duplicate of a recent detection report")
+            return
+
+        # Drop detections located outside all of the geofence's dropOutside zones
+        geofence = self.shared_data.geofence
+        if geofence is not None and msg.parsed.message_type == "detection_report":
+            msg.geofence_zones = geofence.zones_of(msg)
+            if (
+                geofence.drop_outside is not None
+                and msg.geofence_zones is not None
+                and not msg.geofence_zones & geofence.drop_outside
+            ):
+                msg.error = SilentError("Detection outside geofence")
+                return
+
         # Adjustment for trial with no time sync: fix up time in message before forwarding
         _apply_timestamp_offset(
             self.shared_data.config,
@@ -544,25 +761,33 @@ class ParentConnection:
         self.writer = writer
         self.message_format = message_format
         self.forward_all = connection_config.get("forwardAll", False)
-        self.parent_writer = ParentWriter(writer, self.message_format)
+        self.subscription = Subscription.from_config(connection_config.get("subscriptions", {}))
+        if self.subscription.zones is not None:
+            if self.shared_data.geofence is None:
+                raise RuntimeError("Parent subscribes to geofence zones, but none are configured")
+            self.shared_data.geofence.check_names(self.subscription.zones)
+        downsampling_config = connection_config.get("detectionDownsampling", {})
+        self.downsampler = (
+            DetectionDownsampler(writer, downsampling_config)
+            if downsampling_config.get("enable", False)
+            else None
+        )
+        self.parent_writer = ParentWriter(
+            writer, self.message_format, self.forward_all, self.subscription, self.downsampler
+        )
+        self.shared_data.parent_router.add(self.parent_writer)
         if self.forward_all:
-            self.shared_data.parent_all_writers.append(self.parent_writer)
             # Let "forward-all" enabled parents know about current status of nodes that
             # connected before it
             for node_info in self.shared_data.registered_sensors.values():
                 assert isinstance(node_info, SensorInfo)
-                self.writer(node_info.registration, node_info.registration.sapient_version)
-                if node_info.recent_status_new is not None:
-                    self.writer(
-                        node_info.recent_status_new, node_info.recent_status_new.sapient_version
-                    )
-                if node_info.recent_status_unchanged is not None:
-                    self.writer(
-                        node_info.recent_status_unchanged,
-                        node_info.recent_status_unchanged.sapient_version,
-                    )
-        else:
-            self.shared_data.parent_high_level_writers.append(self.parent_writer)
+                for msg in (
+                    node_info.registration,
+                    node_info.recent_status_new,
+                    node_info.recent_status_unchanged,
+                ):
+                    if msg is not None and self.subscription.wants(msg):
+                        self.writer(msg, msg.sapient_version)
 
     def handle_message(self, msg: MessageRecord, generator: IdGenerator):
         msg.updated_data_bytes = msg.received.data_bytes
@@ -583,10 +808,7 @@ class ParentConnection:
         )
 
     def handle_closed(self):
-        if self.forward_all:
-            self.shared_data.parent_all_writers.remove(self.parent_writer)
-        else:
-            self.shared_data.parent_high_level_writers.remove(self.parent_writer)
+        self.shared_data.parent_router.remove(self.parent_writer)
 
 
 class RecorderConnection:
@@ -642,9 +864,10 @@ class ConnectionCreator:
             reg_id,
             dmm_message_format,
             [],
-            [],
-            [],
+            ParentRouter(),
             parent_message_format,
+            DuplicateFilter.from_config(config.get("duplicateSuppression", {})),
+            Geofence.from_config(config.get("geofence", {})),
         )
         self.previous_connection_id = 0
 
@@ -0,0 +1,159 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+"""Limits the rate of detection reports forwarded to a Parent for each tracked object.
+
+A Parent behind a low-bandwidth link may not need every update of every track, but it does need the
+latest state of each one. The DetectionDownsampler forwards at most maxUpdatesPerSecond detections
+for each (node ID, object ID). A detection arriving sooner than that is held back, replacing any
+detection already held back for the same object, and is forwarded once the object is due another
+update, so the newest state of a track is always forwarded (at most one interval late) even if it
+then stops being updated. Objects not updated for staleSeconds are forgotten.
+
+Held-back detections are kept in a TimingWheel rather than in a timer for each object, so that
+scheduling is constant time and checking for due detections only looks at those due, however many
+objects are being tracked.
+"""
+
+import logging
+import math
+from dataclasses import dataclass
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import trio
+
+from sapient_apex_server.message_io import WriterType
+from sapient_apex_server.structures import MessageRecord
+
+logger = logging.getLogger("apex")
+
+
+class TimingWheel:
+    """Hashed timing wheel of items, each due at a deadline in seconds.
+
+    Time is divided into ticks, and each item is put in the slot of the tick it is due in (modulo
+    the number of slots). Advancing the wheel only looks at the slots of the ticks that have passed,
+    and keeps any item in those slots that is due in a later rotation of the wheel.
+    """
+
+    def __init__(self, tick: float, slot_count: int = 256, now: float = 0):
+        self.tick = tick
+        self.slots: List[List[Tuple[int, Hashable]]] = [[] for _ in range(slot_count)]
+        self.current_tick = math.floor(now / tick)
+
+    def schedule(self, item: Hashable, deadline: float):
+        """Adds an item, returned by advance() once deadline has passed."""
+        tick = max(math.ceil(deadline / self.tick), self.current_tick + 1)
+        self.slots[tick % len(self.slots)].append((tick, item))
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Removes and returns the items that are due by now, in order of when they are due."""
+        now_tick = math.floor(now / self.tick)
+        due = []
+        # After a gap of more than a whole rotation, every slot just needs to be looked at once
+        first_tick = max(self.current_tick + 1, now_tick - len(self.slots) + 1)
+        for tick in range(first_tick, now_tick + 1):
+            index = tick % len(self.slots)
+            slot = self.slots[index]
+            if slot:
+                due.extend(item for item_tick, item in slot if item_tick <= now_tick)
+                self.slots[index] = [entry for entry in slot if entry[0] > now_tick]
+        self.current_tick = max(self.current_tick, now_tick)
+        return due
+
+
+@dataclass
+class _Track:
+    """Downsampling state of one object."""
+
+    last_sent: float  # When a detection of the object was last forwarded
+    last_seen: float  # When a detection of the object was last received
+    pending: Optional[MessageRecord] = None  # Newest detection held back, if any
+    deadline: Optional[float] = None  # When the object's earliest entry in the wheel is due
+
+
+class DetectionDownsampler:
+    """Forwards detections to one Parent, from its "detectionDownsampling" config.
+
+    Each object has at most two entries in the wheel at once: when it is next due an update, if a
+    detection is held back, and when it would go stale. An entry that is no longer the object's
+    earliest one is ignored when it comes out of the wheel, and the stale check is rescheduled if
+    the object has been seen again since it was scheduled.
+    """
+
+    def __init__(self, writer: WriterType, config: dict):
+        max_updates_per_second = float(config["maxUpdatesPerSecond"])
+        if max_updates_per_second <= 0:
+            raise RuntimeError("detectionDownsampling maxUpdatesPerSecond must be positive")
+        self.writer = writer
+        self.interval = 1 / max_updates_per_second
+        self.stale_after = max(float(config.get("staleSeconds", 10)), self.interval)
+        # Held-back detections are forwarded up to a quarter of an interval after they are due
+        self.wheel = TimingWheel(self.interval / 4)
+        self.tracks: Dict[Tuple[str, str], _Track] = {}
+        self.held_back_count = 0
+        self.superseded_count = 0  # Held-back detections replaced by a newer one, never forwarded
+
+    @staticmethod
+    def _key(msg: MessageRecord) -> Optional[Tuple[str, str]]:
+        parsed_proto = msg.parsed.parsed_proto
+        if parsed_proto is None or not parsed_proto.detection_report.object_id:
+            return None
+        return (parsed_proto.node_id, parsed_proto.detection_report.object_id)
+
+    def _schedule(self, key: Tuple[str, str], track: _Track, deadline: float):
+        if track.deadline is not None and track.deadline <= deadline:
+            return  # The earlier entry will reschedule this one when it comes out of the wheel
+        track.deadline = deadline
+        self.wheel.schedule((key, deadline), deadline)
+
+    def send(self, msg: MessageRecord, now: float) -> bool:
+        """Forwards a detection or holds it back, returning whether it was forwarded now."""
+        key = self._key(msg)
+        if key is None:
+            self.writer(msg, msg.sapient_version)
+            return True
+        track = self.tracks.get(key)
+        if track is None:
+            track = self.tracks[key] = _Track(last_sent=-math.inf, last_seen=now)
+        track.last_seen = now
+        if track.pending is None and now >= track.last_sent + self.interval:
+            track.last_sent = now
+            self._schedule(key, track, now + self.stale_after)
+            self.writer(msg, msg.sapient_version)
+            return True
+        self.held_back_count += 1
+        if track.pending is not None:
+            self.superseded_count += 1
+        track.pending = msg
+        self._schedule(key, track, track.last_sent + self.interval)
+        return False
+
+    def advance(self, now: float):
+        """Forwards the held-back detections that are now due, and forgets stale objects."""
+        for key, deadline in self.wheel.advance(now):
+            track = self.tracks.get(key)
+            if track is None or track.deadline != deadline:
+                continue
+            track.deadline = None
+            if track.pending is not None:
+                msg, track.pending = track.pending, None
+                track.last_sent = now
+                self.writer(msg, msg.sapient_version)
+            elif now >= track.last_seen + self.stale_after:
+                del self.tracks[key]
+                continue
+            self._schedule(key, track, track.last_seen + self.stale_after)
+
+    async def run(self):
+        """Advances the wheel every tick until cancelled."""
+        while True:
+            await trio.sleep(self.wheel.tick)
+            self.advance(trio.current_time())
+
+    def counts_str(self) -> str:
+        return (
+            f"{self.held_back_count} detections held back, of which {self.superseded_count}"
+            f" were replaced by a newer one"
+        )
@@ -0,0 +1,179 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+"""Named polygon zones that detections are located in, from the "geofence" config.
+
+Detections from Child connections can be dropped if they are outside all of the "dropOutside"
+zones, and Parent connections can subscribe to only the detections inside particular zones. The
+zones containing each detection are looked up once, from the x and y of its location (which must
+be in the same coordinate system as the zones), however many Parents subscribe to them.
+
+There may be thousands of zones, so they are indexed by a grid of square cells, prepared when the
+config is read. Each zone either contains the whole of a cell, does not overlap it, or has edges
+that cross it. Only zones of the last sort need a point-in-polygon test, which counts the crossings
+of a ray from the point in the +x direction with the edges of the zone. The cell keeps only the
+edges that such a ray could cross (those overlapping the cell's row and reaching past its left
+side), so that the test does not look at every edge of a large zone. If NumPy is installed, the
+edges of each cell are kept in arrays and tested all at once.
+"""
+
+import math
+from bisect import bisect_right
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from sapient_apex_server.structures import MessageRecord
+
+try:
+    import numpy as np
+except ImportError:  # NumPy (the geofence extra) only speeds up the point-in-polygon tests
+    np = None
+
+Point = Tuple[float, float]
+Edge = Tuple[float, float, float, float]  # x1, y1, x2, y2
+
+
+@dataclass
+class _Cell:
+    """The zones overlapping one cell of the grid."""
+
+    inside: List[int] = field(default_factory=list)  # Zones containing the whole cell
+    boundary: List[int] = field(default_factory=list)  # Zones whose edges cross the cell
+    edges: List[Tuple[int, Edge]] = field(default_factory=list)  # (index into boundary, edge)
+    inside_names: frozenset = frozenset()
+    edge_array: Optional["np.ndarray"] = None  # Columns x1, y1, x2, y2
+    edge_boundary_index: Optional["np.ndarray"] = None
+
+
+def _crosses(edge: Edge, x: float, y: float) -> bool:
+    """Whether a ray from (x, y) in the +x direction crosses the edge (counting the lower end of
+    each edge but not the upper end, so that a ray through a vertex is counted correctly)."""
+    x1, y1, x2, y2 = edge
+    return (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+
+
+class Geofence:
+    """The zones of the "geofence" config, indexed by a grid to find those containing a point."""
+
+    def __init__(self, config: dict):
+        zones: Dict[str, List[Point]] = {}
+        for name, points in config["zones"].items():
+            if len(points) < 3:
+                raise RuntimeError(f"Geofence zone {name} must have at least 3 points")
+            zones[name] = [(float(x), float(y)) for x, y in points]
+        self.names = list(zones)
+        drop_outside = config.get("dropOutside")
+        self.drop_outside = self.check_names(drop_outside) if drop_outside else None
+
+        cell_size = config.get("gridCellSize")
+        if cell_size is None:
+            # Each zone covers a few cells, if they are of similar sizes
+            extents = [
+                max(max(xs) - min(xs), max(ys) - min(ys))
+                for xs, ys in (zip(*points) for points in zones.values())
+            ]
+            cell_size = sum(extents) / len(extents) or 1
+        self.cell_size = float(cell_size)
+        if self.cell_size <= 0:
+            raise RuntimeError("Geofence gridCellSize must be positive")
+
+        self.cells: Dict[Tuple[int, int], _Cell] = defaultdict(_Cell)
+        for zone_index, points in enumerate(zones.values()):
+            self._add_zone(zone_index, points)
+        self.cells = dict(self.cells)
+        for cell in self.cells.values():
+            self._prepare_cell(cell)
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["Geofence"]:
+        return cls(config) if config.get("zones") else None
+
+    def check_names(self, names: List[str]) -> frozenset:
+        """The given zone names, which must all be in the config."""
+        unknown = set(names) - set(self.names)
+        if unknown:
+            raise RuntimeError(f"Unknown geofence zones: {', '.join(sorted(unknown))}")
+        return frozenset(names)
+
+    def _cell_index(self, value: float) -> int:
+        return math.floor(value / self.cell_size)
+
+    def _add_zone(self, zone_index: int, points: List[Point]):
+        edges = [(x1, y1, x2, y2) for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1])]
+
+        # Every cell that an edge may cross, and the edges overlapping each row of cells
+        boundary_cells = set()
+        row_edges: Dict[int, List[Edge]] = defaultdict(list)
+        for edge in edges:
+            x1, y1, x2, y2 = edge
+            columns = range(self._cell_index(min(x1, x2)), self._cell_index(max(x1, x2)) + 1)
+            rows = range(self._cell_index(min(y1, y2)), self._cell_index(max(y1, y2)) + 1)
+            boundary_cells.update((i, j) for i in columns for j in rows)
+            for j in rows:
+                row_edges[j].append(edge)
+        for i, j in boundary_cells:
+            cell = self.cells[(i, j)]
+            boundary_index = len(cell.boundary)
+            cell.boundary.append(zone_index)
+            left = i * self.cell_size
+            cell.edges.extend(
+                (boundary_index, edge) for edge in row_edges[j] if max(edge[0], edge[2]) >= left
+            )
+
+        # Other cells within the zone's bounding box are wholly inside or outside it, as their
+        # centre is; the centres of each row are checked against the row's crossings at once
+        xs, ys = zip(*points)
+        first_column, last_column = self._cell_index(min(xs)), self._cell_index(max(xs))
+        for j in range(self._cell_index(min(ys)), self._cell_index(max(ys)) + 1):
+            centre_y = (j + 0.5) * self.cell_size
+            crossings = sorted(
+                x1 + (centre_y - y1) * (x2 - x1) / (y2 - y1)
+                for x1, y1, x2, y2 in row_edges[j]
+                if (y1 > centre_y) != (y2 > centre_y)
+            )
+            for i in range(first_column, last_column + 1):
+                if (i, j) in boundary_cells:
+                    continue
+                centre_x = (i + 0.5) * self.cell_size
+                if (len(crossings) - bisect_right(crossings, centre_x)) % 2:
+                    self.cells[(i, j)].inside.append(zone_index)
+
+    def _prepare_cell(self, cell: _Cell):
+        cell.inside_names = frozenset(self.names[zone_index] for zone_index in cell.inside)
+        if np is not None and cell.edges:
+            cell.edge_boundary_index = np.array([index for index, _ in cell.edges], dtype=np.intp)
+            cell.edge_array = np.array([edge for _, edge in cell.edges], dtype=np.float64)
+
+    def zones_at(self, x: float, y: float) -> frozenset:
+        """The names of the zones containing the point."""
+        cell = self.cells.get((self._cell_index(x), self._cell_index(y)))
+        if cell is None:
+            return frozenset()
+        if not cell.boundary:
+            return cell.inside_names
+
+        if cell.edge_array is not None:
+            x1, y1, x2, y2 = cell.edge_array.T
+            straddles = (y1 > y) != (y2 > y)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                crosses = straddles & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+            counts = np.bincount(
+                cell.edge_boundary_index[crosses], minlength=len(cell.boundary)
+            ).tolist()
+        else:
+            counts = [0] * len(cell.boundary)
+            for boundary_index, edge in cell.edges:
+                if _crosses(edge, x, y):
+                    counts[boundary_index] += 1
+        inside = [self.names[cell.boundary[i]] for i, count in enumerate(counts) if count % 2]
+        return cell.inside_names.union(inside) if inside else cell.inside_names
+
+    def zones_of(self, msg: MessageRecord) -> Optional[frozenset]:
+        """The names of the zones containing a detection, or None if it has no x-y location."""
+        parsed_proto = msg.parsed.parsed_proto if msg.parsed else None
+        if parsed_proto is None or not parsed_proto.detection_report.HasField("location"):
+            return None
+        location = parsed_proto.detection_report.location
+        return self.zones_at(location.x, location.y)
@@ -4,8 +4,8 @@
 
 import struct
 import xml.etree.ElementTree as ET
-from collections.abc import Callable
-from typing import Union
+from collections.abc import Callable, Hashable
+from typing import Optional, Union
 
 from google.protobuf.message import Message
 
@@ -18,6 +18,7 @@ from sapient_apex_server.translator.proto_to_proto_translator import (
     translate_v1_to_v2,
     translate_v2_to_v1,
 )
+from sapient_apex_server.trio_util import WritePriority
 from sapient_msg.bsi_flex_335_v1_0.sapient_message_pb2 import (
     SapientMessage as SapientMessageV1,
 )
@@ -25,10 +26,29 @@ from sapient_msg.bsi_flex_335_v1_0.sapient_message_pb2 import (
 WriterType = Callable[[Union[Message, ET.Element, MessageRecord], SapientVersion], None]
 
 
+# Message types written before any others already queued for a connection, so that commands are
+# not held up behind a backlog of detections. Registrations are included so that a node's
+# registration is never overtaken by its alerts.
+message_type_priorities = {
+    "registration": WritePriority.HIGH,
+    "registration_ack": WritePriority.HIGH,
+    "task": WritePriority.HIGH,
+    "task_ack": WritePriority.HIGH,
+    "alert": WritePriority.HIGH,
+    "alert_ack": WritePriority.HIGH,
+}
+
+
 class ConnectionWriter:
+    # The message record encoded most recently by any connection, with its formats and the encoded
+    # bytes. A message is forwarded by calling the writer of each destination in turn, so this lets
+    # all destinations with the same format and version share one encoded buffer (which
+    # BufferedWriter queues without copying). Records are only modified before being forwarded.
+    _last_encoded: Optional[tuple] = None
+
     def __init__(
         self,
-        writer: Callable[[bytes], None],
+        writer: Callable[..., None],
         generator: IdGenerator,
         encoding: MessageFormat = MessageFormat.PROTO,
         version: SapientVersion = SapientVersion.LATEST,
@@ -43,14 +63,54 @@ class ConnectionWriter:
         message: Union[Message, ET.Element, MessageRecord],
         version: SapientVersion = SapientVersion.LATEST,
     ) -> None:
-        data = message_to_bytes(
-            message,
-            self.generator,
-            encoding=self.encoding,
-            in_version=version,
-            out_version=self.version,
-        )
-        self.writer(data)
+        key = (message, self.encoding, version, self.version)
+        last_encoded = ConnectionWriter._last_encoded
+        if last_encoded is not None and all(a is b for a, b in zip(key, last_encoded)):
+            data = last_encoded[-1]
+        else:
+            data = message_to_bytes(
+                message,
+                self.generator,
+                encoding=self.encoding,
+                in_version=version,
+                out_version=self.version,
+            )
+            if isinstance(message, MessageRecord):
+                ConnectionWriter._last_encoded = (*key, data)
+        priority, droppable, coalesce_key = write_hints(message)
+        self.writer(data, priority=priority, droppable=droppable, coalesce_key=coalesce_key)
+
+
+def get_message_type(message: Union[Message, ET.Element, MessageRecord]) -> Optional[str]:
+    """The message type (name of the SapientMessage content field) of a message to be written."""
+    if isinstance(message, MessageRecord):
+        return message.parsed.message_type if message.parsed else None
+    if isinstance(message, ET.Element):
+        # The only XML messages Apex creates itself, other than errors
+        return "registration_ack" if message.tag == "SensorRegistrationACK" else None
+    return message.WhichOneof("content")
+
+
+def write_hints(
+    message: Union[Message, ET.Element, MessageRecord]
+) -> tuple[WritePriority, bool, Optional[Hashable]]:
+    """How a message should be queued for writing: its priority, whether it may be dropped for a
+    slow connection, and its key for coalescing (only the latest queued message with the same key
+    is kept); see BufferedWriter.
+
+    Detections are droppable, as are unchanged status reports, which add nothing to an earlier
+    report. Other status reports replace earlier ones from the same node. All other messages (e.g.
+    registrations, tasks and alerts) are kept.
+    """
+    message_type = get_message_type(message)
+    priority = message_type_priorities.get(message_type, WritePriority.NORMAL)
+    if message_type == "detection_report":
+        return priority, True, None
+    if isinstance(message, MessageRecord) and message.status_report is not None:
+        if message.status_report.is_unchanged:
+            return priority, True, None
+        return priority, False, ("status_report", message.parsed.node_id)
+    return priority, False, None
 
 
 def message_to_bytes(
@@ -68,7 +128,7 @@ def message_to_bytes(
 
     # ET.Element is for XMLv6 format only
     assert isinstance(message, (ET.Element, Message))
-    if isinstance(message, ET.Element) != (encoding == MessageFormat.XML):
+    if isinstance(message, ET.Element) and encoding != MessageFormat.XML:
         raise NotImplementedError("XML and ET.Element should be synonymous")
     if (encoding == MessageFormat.XML) != (out_version == SapientVersion.VERSION6):
         raise NotImplementedError("XML is only implemented for version 6")
@@ -86,8 +146,9 @@ def pick_message_record_component(
             # For the most part, XML and VERSION6 are synonymous, except that VERSION6 is not
             # really implemented per se. So converting from anything else is half-backed
             raise RuntimeError(f"No conversion to XML implemented for version {out_version}")
-        assert message.parsed.parsed_xml is not None
-        return message.parsed.parsed_xml
+        if message.parsed.parsed_xml is not None:
+            return message.parsed.parsed_xml
+        # XML is not derived for detections while overloaded, so is translated by encode() instead
     # XML + version > VERSION6 provided on a best effort basis
     assert message.parsed.parsed_proto is not None
     return message.parsed.parsed_proto
@@ -0,0 +1,94 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+"""Sheds optional work in stages when messages are read faster than they can be handled.
+
+Each connection reads messages into an unbounded channel, so that their received times are
+accurate, and all of them share a single parser thread. If messages arrive faster than they can be
+parsed, the backlog (and the latency of every message) grows without limit. The OverloadController
+watches the total backlog and the latency of parsed messages, and raises the LoadLevel as they pass
+each configured threshold, so that less work is done for each message. It goes back down a level
+only once both are below half of that level's thresholds, so that it does not flap between levels.
+"""
+
+import logging
+from datetime import timedelta
+from enum import IntEnum
+
+logger = logging.getLogger("apex")
+
+
+class LoadLevel(IntEnum):
+    """How much optional work is skipped; each level also skips the work of those below it."""
+
+    NORMAL = 0
+    SKIP_CONTENT_VALIDATION = 1  # Only validate message and detection timestamps
+    SKIP_DERIVED_FORMATS = 2  # Do not derive XML (translated later if needed) or JSON of detections
+    SAMPLE_DETECTIONS = 3  # Only handle one in every sampleInterval detections
+
+
+class OverloadController:
+    """Chooses the LoadLevel from the "overloadShedding" config, shared by all connections."""
+
+    def __init__(self, config: dict):
+        self.is_enabled = config.get("enable", False)
+        self.backlog_thresholds = config.get("backlogThresholds", [1000, 5000, 20000])
+        self.latency_thresholds = [
+            timedelta(seconds=seconds)
+            for seconds in config.get("latencyThresholdsSeconds", [1, 5, 20])
+        ]
+        if len(self.backlog_thresholds) != len(LoadLevel) - 1:
+            raise RuntimeError(
+                f"overloadShedding backlogThresholds must have {len(LoadLevel) - 1} values"
+            )
+        if len(self.latency_thresholds) != len(LoadLevel) - 1:
+            raise RuntimeError(
+                f"overloadShedding latencyThresholdsSeconds must have {len(LoadLevel) - 1} values"
+            )
+        self.sample_interval = max(int(config.get("sampleInterval", 10)), 1)
+
+        self.level = LoadLevel.NORMAL
+        self.backlog = 0  # Messages read from all connections but not yet parsed
+        self.detection_count = 0  # Detections seen while sampling, to keep one in sample_interval
+        self.shed_detection_count = 0
+
+    def _level_for(self, latency: timedelta, factor: float) -> LoadLevel:
+        level = LoadLevel.NORMAL
+        for level_above, backlog_threshold, latency_threshold in zip(
+            list(LoadLevel)[1:], self.backlog_thresholds, self.latency_thresholds
+        ):
+            if self.backlog >= backlog_threshold * factor or latency >= latency_threshold * factor:
+                level = level_above
+        return level
+
+    def update(self, latency: timedelta):
+        """Updates the level after a message is parsed, given how long after being read it was."""
+        if not self.is_enabled:
+            return
+        new_level = self._level_for(latency, 1)
+        if new_level < self.level:
+            new_level = max(new_level, self._level_for(latency, 0.5))
+        if new_level == self.level:
+            return
+        log = logger.warning if new_level > self.level else logger.info
+        log(
+            f"Load level changed from {self.level.name} to {new_level.name}"
+            f" (backlog {self.backlog} messages, latency {latency.total_seconds():.3f}s)"
+        )
+        if new_level < LoadLevel.SAMPLE_DETECTIONS <= self.level:
+            logger.info(f"{self.shed_detection_count} detections dropped by sampling")
+            self.shed_detection_count = 0
+        if new_level >= LoadLevel.SAMPLE_DETECTIONS > self.level:
+            self.detection_count = 0
+        self.level = new_level
+
+    def keep_detection(self) -> bool:
+        """Whether to handle a detection, which is always true unless sampling detections."""
+        if self.level < LoadLevel.SAMPLE_DETECTIONS:
+            return True
+        self.detection_count += 1
+        if (self.detection_count - 1) % self.sample_interval == 0:
+            return True
+        self.shed_detection_count += 1
+        return False
@@ -2,14 +2,20 @@
 # Copyright (c) 2019-2024 Roke Manor Research Ltd
 #
 
+import struct
 import xml.etree.ElementTree as ET
+from dataclasses import dataclass
 from datetime import datetime
+from typing import Callable, Iterator, Optional, Tuple, Union
 
 from google.protobuf.json_format import MessageToJson
 from google.protobuf.message import DecodeError
+from google.protobuf.timestamp_pb2 import Timestamp
 
 from sapient_apex_server.message_io import to_version
+from sapient_apex_server.overload import LoadLevel
 from sapient_apex_server.structures import (
+    ErrorRecord,
     MessageRecord,
     NoisyError,
     ParsedRecord,
@@ -32,6 +38,103 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Field numbers read by peek_detection(), which are the same in all supported BSI Flex 335 versions
+_TIMESTAMP_FIELD = 1  # SapientMessage.timestamp
+_NODE_ID_FIELD = 2  # SapientMessage.node_id
+_CONTENT_FIELDS = range(4, 13)  # SapientMessage.content oneof, registration to error
+_DETECTION_REPORT_FIELD = 7  # SapientMessage.detection_report
+_DETECTION_CONFIDENCE_FIELD = 7  # DetectionReport.detection_confidence
+
+_WIRE_VARINT, _WIRE_FIXED64, _WIRE_LENGTH_DELIMITED, _WIRE_FIXED32 = 0, 1, 2, 5
+
+
+def _read_varint(data: memoryview, pos: int) -> Tuple[int, int]:
+    result = shift = 0
+    while shift < 64:
+        if pos >= len(data):
+            raise ValueError("Truncated varint")
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+    raise ValueError("Varint too long")
+
+
+def _iter_fields(data: memoryview) -> Iterator[Tuple[int, int, Union[int, memoryview]]]:
+    """Yields (field number, wire type, value) for each field of a serialized protobuf message,
+    without parsing any nested messages. Values are ints for varints and memoryviews otherwise."""
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        field_number, wire_type = key >> 3, key & 7
+        if wire_type == _WIRE_VARINT:
+            value, pos = _read_varint(data, pos)
+            yield field_number, wire_type, value
+            continue
+        if wire_type == _WIRE_FIXED64:
+            size = 8
+        elif wire_type == _WIRE_LENGTH_DELIMITED:
+            size, pos = _read_varint(data, pos)
+        elif wire_type == _WIRE_FIXED32:
+            size = 4
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type}")
+        if pos + size > len(data):
+            raise ValueError("Truncated field")
+        yield field_number, wire_type, data[pos : pos + size]
+        pos += size
+
+
+@dataclass
+class PeekedDetection:
+    node_id: str
+    message_timestamp: datetime
+    detection_confidence: Optional[float]
+
+
+def peek_detection(data: bytes) -> Optional[PeekedDetection]:
+    """Reads the few fields of a serialized detection report needed to filter it, much faster than
+    a full parse. Returns None if the message is not a detection report, or if anything about it is
+    unusual, so that the full parse can deal with it."""
+    content_field = None
+    node_id = b""
+    timestamp = b""
+    detection_confidence = None
+    try:
+        for field_number, wire_type, value in _iter_fields(memoryview(data)):
+            if field_number == _TIMESTAMP_FIELD:
+                if wire_type != _WIRE_LENGTH_DELIMITED:
+                    return None
+                timestamp = value
+            elif field_number == _NODE_ID_FIELD:
+                if wire_type != _WIRE_LENGTH_DELIMITED:
+                    return None
+                node_id = value
+            elif field_number in _CONTENT_FIELDS:
+                if wire_type != _WIRE_LENGTH_DELIMITED:
+                    return None
+                if field_number != content_field:
+                    detection_confidence = None  # Setting another oneof field clears the last
+                content_field = field_number
+                if field_number != _DETECTION_REPORT_FIELD:
+                    continue
+                for report_field, report_wire_type, report_value in _iter_fields(value):
+                    if report_field == _DETECTION_CONFIDENCE_FIELD:
+                        if report_wire_type != _WIRE_FIXED32:
+                            return None
+                        (detection_confidence,) = struct.unpack("<f", report_value)
+        if content_field != _DETECTION_REPORT_FIELD:
+            return None
+        return PeekedDetection(
+            node_id=bytes(node_id).decode("utf-8"),
+            message_timestamp=Timestamp.FromString(bytes(timestamp)).ToDatetime(),
+            detection_confidence=detection_confidence or None,
+        )
+    except (ValueError, DecodeError):
+        return None
+
 
 def parse_proto(
     msg_data: ReceivedDataRecord,
@@ -39,6 +142,8 @@ def parse_proto(
     generator: IdGenerator,
     enable_message_conversion: bool,
     sapient_version: SapientVersion = SapientVersion.LATEST,  # Connection's SapientVersion
+    detection_filter: Optional[Callable[[Optional[float]], Optional[ErrorRecord]]] = None,
+    load_level: LoadLevel = LoadLevel.NORMAL,
 ) -> MessageRecord:
     result = MessageRecord(
         received=msg_data,
@@ -49,6 +154,25 @@ def parse_proto(
         error=None,
     )
 
+    # Drop detection reports that fail the confidence filter before the (much slower) full parse,
+    # validation and translation. They are stored, if at all, with just the fields peeked at.
+    if detection_filter is not None:
+        peeked = peek_detection(msg_data.data_bytes)
+        if peeked is not None:
+            result.error = detection_filter(peeked.detection_confidence)
+            if result.error is not None:
+                result.parsed = ParsedRecord(
+                    message_type="detection_report",
+                    node_id=peeked.node_id or None,
+                    internal_sensor_id=None,
+                    destination_node_id=None,
+                    message_timestamp=peeked.message_timestamp,
+                    detection_confidence=peeked.detection_confidence,
+                    parsed_proto=None,
+                    parsed_xml=None,
+                )
+                return result
+
     try:
         # Note: We need match the concrete SapientVersion to
         # the format of the incoming message. And not SapientVersion.LATEST
@@ -56,14 +180,26 @@ def parse_proto(
         # This sapient_version should be setup via the connection_config["icd_version"]
         msg_parsed = empty_sapient_message(sapient_version)
         msg_parsed.ParseFromString(bytes(msg_data.data_bytes))
-        result.data_json = MessageToJson(msg_parsed, preserving_proto_field_name=True)
     except DecodeError as e:
         result.error = NoisyError(f"DecodeError: {e}")
         return result
 
+    # While overloaded, detections are left without JSON, and without XML unless it is needed to
+    # forward them (see pick_message_record_component)
+    skip_derived_formats = load_level >= LoadLevel.SKIP_DERIVED_FORMATS and msg_parsed.HasField(
+        "detection_report"
+    )
+    if not skip_derived_formats:
+        result.data_json = MessageToJson(msg_parsed, preserving_proto_field_name=True)
+
     if validator.is_validation_required():
         errors = []
-        validator.validate_sapient_message(msg_parsed, result.received.timestamp, errors)
+        validator.validate_sapient_message(
+            msg_parsed,
+            result.received.timestamp,
+            errors,
+            validate_contents=load_level < LoadLevel.SKIP_CONTENT_VALIDATION,
+        )
         if errors:
             error_str = "\n".join(e.full_str() for e in errors)
             result.error = NoisyError(f"Validation {len(errors)} errors:\n{error_str}")
@@ -99,23 +235,25 @@ def parse_proto(
     sensor_ulid = msg_parsed.node_id
     sensor_id = ""
     if enable_message_conversion:
-        try:
-            result.data_decoded_xml = ET.tostring(
-                bsi_flex_v1_to_xml(
-                    # xml translator built for bsi flex 335 version 1
-                    to_version(msg_parsed, sapient_version, SapientVersion.BSI_FLEX_335_V1_0),
-                    generator,
-                ),
-                encoding="utf-8",
-                xml_declaration=True,
-            )
-        except Exception as e:
-            result.error = NoisyError(f"TranslationError: {e}")
-            return result
+        if not skip_derived_formats:
+            try:
+                result.data_decoded_xml = ET.tostring(
+                    bsi_flex_v1_to_xml(
+                        # xml translator built for bsi flex 335 version 1
+                        to_version(msg_parsed, sapient_version, SapientVersion.BSI_FLEX_335_V1_0),
+                        generator,
+                    ),
+                    encoding="utf-8",
+                    xml_declaration=True,
+                )
+            except Exception as e:
+                result.error = NoisyError(f"TranslationError: {e}")
+                return result
 
-        if msg_parsed.node_id:
+        # The translation adds the node ID if it is new, but might have been skipped
+        if msg_parsed.node_id in generator.node_id_map:
             sensor_id = generator.node_id_map[msg_parsed.node_id].xml_id
-        else:
+        elif not msg_parsed.node_id:
             sensor_ulid, sensor_id = generator.get_id_ulid_pair()
 
     if msg_parsed.HasField("registration"):
@@ -8,6 +8,7 @@ from datetime import datetime
 
 from google.protobuf.json_format import MessageToJson
 
+from sapient_apex_server.overload import LoadLevel
 from sapient_apex_server.structures import (
     MessageRecord,
     NoisyError,
@@ -73,6 +74,7 @@ def parse_xml(
     validator: Validator,
     generator: IdGenerator,
     enable_sensor_id_auto: bool,
+    load_level: LoadLevel = LoadLevel.NORMAL,
 ) -> MessageRecord:
     """Reads one message, decodes it to XML, and handles common errors."""
     record = MessageRecord(
@@ -181,12 +183,14 @@ def parse_xml(
             )
         if record.parsed.parsed_proto is not None:
             record.data_binary_proto = record.parsed.parsed_proto.SerializeToString()
-            record.data_json = MessageToJson(
-                record.parsed.parsed_proto,
-                preserving_proto_field_name=True,
-                indent=2,
-            )
-            record.data_json = record.data_json[0]
+            # While overloaded, detections are left without JSON
+            if load_level < LoadLevel.SKIP_DERIVED_FORMATS or root.tag != "DetectionReport":
+                record.data_json = MessageToJson(
+                    record.parsed.parsed_proto,
+                    preserving_proto_field_name=True,
+                    indent=2,
+                )
+                record.data_json = record.data_json[0]
             record.parsed.node_id = record.parsed.parsed_proto.node_id
             record.parsed.destination_node_id = record.parsed.parsed_proto.destination_id or None
     except Exception as e:
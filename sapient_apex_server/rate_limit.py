@@ -0,0 +1,171 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+"""Token bucket limits on the rate messages are read from each connection and each node.
+
+These are checked as each message is read, before it is parsed, so that a node sending far more
+messages than it should cannot use up the parser thread and SQLite thread shared by all connections.
+"""
+
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime
+from enum import Enum, auto
+from typing import Dict, Optional
+
+from sapient_apex_server.structures import (
+    MessageFormat,
+    MessageRecord,
+    ReceivedDataRecord,
+    SapientVersion,
+    SilentError,
+)
+
+logger = logging.getLogger("apex")
+
+
+class RateLimitAction(Enum):
+    """What is done with messages read faster than a rate limit allows."""
+
+    DROP = auto()  # Discard them without parsing or storing them
+    SAMPLE = auto()  # Handle one in every sampleInterval of them as usual, and discard the rest
+    RECORD_ONLY = auto()  # Store them in the database, but do not parse or forward them
+
+
+@dataclass
+class TokenBucket:
+    """Allows burst messages at once, refilling at rate messages per second."""
+
+    rate: float
+    burst: float
+    tokens: float = field(init=False)
+    updated: Optional[float] = None
+
+    def __post_init__(self):
+        self.tokens = self.burst
+
+    def take(self, now: float) -> bool:
+        """Takes a token if there is one, returning whether there was."""
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """A rate limit from the config, e.g. a connection's "rateLimit" or one of "nodeRateLimits"."""
+
+    messages_per_second: float
+    burst: float
+    action: RateLimitAction = RateLimitAction.DROP
+    sample_interval: int = 10
+
+    @classmethod
+    def from_config(cls, config: dict) -> "RateLimit":
+        messages_per_second = float(config["messagesPerSecond"])
+        return cls(
+            messages_per_second=messages_per_second,
+            burst=float(config.get("burst", messages_per_second)),
+            action=RateLimitAction[config.get("action", "DROP")],
+            sample_interval=max(int(config.get("sampleInterval", 10)), 1),
+        )
+
+    def new_bucket(self) -> TokenBucket:
+        return TokenBucket(self.messages_per_second, self.burst)
+
+
+class RateLimiter:
+    """Checks the messages read from one connection against its rate limit, if it has one, and
+    against the limit for the node it is registered as, if there is one.
+
+    Node limits are shared by all connections (through node_buckets), so that a node cannot get
+    around its limit by reconnecting. The counts of messages over either limit are kept for the
+    disconnect reason, and logged when the connection goes back within its limits.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        connection_limit: Optional[RateLimit],
+        node_limits: Dict[str, RateLimit],
+        node_buckets: Dict[str, TokenBucket],
+    ):
+        self.name = name
+        self.connection_limit = connection_limit
+        self.connection_bucket = connection_limit.new_bucket() if connection_limit else None
+        self.node_limits = node_limits
+        self.node_buckets = node_buckets
+        self.is_limiting = False
+        self.over_limit_count = 0  # Messages over a limit in the current period of limiting
+        self.dropped_count = 0
+        self.sampled_count = 0
+        self.recorded_count = 0
+
+    def check(self, node_id: Optional[str], now: float) -> Optional[RateLimitAction]:
+        """Returns None if the message should be handled as usual, or else DROP or RECORD_ONLY."""
+        limit = None
+        if self.connection_bucket is not None and not self.connection_bucket.take(now):
+            limit = self.connection_limit
+        node_limit = self.node_limits.get(node_id) if node_id is not None else None
+        if node_limit is not None:
+            bucket = self.node_buckets.get(node_id)
+            if bucket is None:
+                bucket = self.node_buckets[node_id] = node_limit.new_bucket()
+            if not bucket.take(now) and limit is None:
+                limit = node_limit
+
+        if limit is None:
+            if self.is_limiting:
+                self.is_limiting = False
+                logger.info(
+                    f"{self.name} back within rate limit after {self.over_limit_count} messages"
+                    f" over it ({self.counts_str()} in total)"
+                )
+            return None
+        if not self.is_limiting:
+            self.is_limiting = True
+            self.over_limit_count = 0
+            logger.warning(f"{self.name} over rate limit, action {limit.action.name}")
+        self.over_limit_count += 1
+
+        if limit.action == RateLimitAction.RECORD_ONLY:
+            self.recorded_count += 1
+            return RateLimitAction.RECORD_ONLY
+        # Sampling handles the first message over the limit, and every sample_interval-th after it
+        sample_index = (self.over_limit_count - 1) % limit.sample_interval
+        if limit.action == RateLimitAction.SAMPLE and sample_index == 0:
+            self.sampled_count += 1
+            return None
+        self.dropped_count += 1
+        return RateLimitAction.DROP
+
+    def counts_str(self) -> str:
+        return (
+            f"{self.dropped_count} dropped, {self.sampled_count} sampled and"
+            f" {self.recorded_count} recorded only"
+        )
+
+
+def rate_limited_record(
+    msg_data: ReceivedDataRecord, message_format: MessageFormat, sapient_version: SapientVersion
+) -> MessageRecord:
+    """A record of a message over a RECORD_ONLY rate limit, to store without parsing it."""
+    if message_format == MessageFormat.XML:
+        data_decoded_xml = bytes(msg_data.data_bytes[:-1]).decode("utf8", errors="replace")
+        data_binary_proto = None
+    else:
+        data_decoded_xml = ""
+        data_binary_proto = bytes(msg_data.data_bytes)
+    return MessageRecord(
+        received=msg_data,
+        data_decoded_xml=data_decoded_xml,
+        data_binary_proto=data_binary_proto,
+        decoded_timestamp=datetime.utcnow(),
+        sapient_version=sapient_version,
+        error=SilentError("Over rate limit, so not parsed"),
+    )
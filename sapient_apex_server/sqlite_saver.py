@@ -28,9 +28,45 @@ from sapient_apex_server.time_util import datetime_to_int, datetime_to_str
 
 logger = logging.getLogger("apex")
 
+# Optional full-text index of the message JSON, used by the GUI's search box. It is an external
+# content table, so only the index is stored and not another copy of the JSON. Only JSON is indexed
+# because the XML (if any) is a conversion of the same message. These must be run as separate
+# statements, as the trigger contains semicolons.
+sql_create_search_table = """
+CREATE VIRTUAL TABLE IF NOT EXISTS MessageSearch
+    USING fts5(json, content='Message', content_rowid='id')
+"""
+sql_create_search_trigger = """
+CREATE TRIGGER IF NOT EXISTS message_search_insert AFTER INSERT ON Message BEGIN
+    INSERT INTO MessageSearch(rowid, json) VALUES (new.id, new.json);
+END
+"""
+# Indexes all the messages already in the database, for when the index is created afterwards
+sql_rebuild_search_index = "INSERT INTO MessageSearch(MessageSearch) VALUES('rebuild')"
+
+# Indices of the queries the SqliteInterface answers the REST API with, only created when it is
+# enabled (apiConfig.useSqliteDatabase) so that Apex does not otherwise maintain them
+sql_create_api_indices = [
+    """
+CREATE INDEX IF NOT EXISTS index_message_type_node_timestamp
+    ON Message(parsed_type, parsed_node_id, parsed_timestamp)
+""",
+    """
+CREATE INDEX IF NOT EXISTS index_message_type_timestamp
+    ON Message(parsed_type, parsed_timestamp)
+""",
+]
+
 
 class SqliteSaver:
-    def __init__(self, url: str, conversion_enabled: bool, echo: bool = False):
+    def __init__(
+        self,
+        url: str,
+        conversion_enabled: bool,
+        echo: bool = False,
+        search_index: bool = False,
+        api_indices: bool = False,
+    ):
         if ":///" not in url:
             url = f"sqlite:///{url}"
 
@@ -42,6 +78,10 @@ class SqliteSaver:
 
         if "sqlite" in url:
             sqlite_setup(self.connection)
+            if search_index:
+                create_search_index(self.connection)
+            if api_indices:
+                create_api_indices(self.connection)
         with self.connection.begin():
             self.connection.execute(
                 insert(Version).values(
@@ -205,6 +245,8 @@ class SqliteSaver:
                         relative_filepath=new_db_rel_filename, absolute_filepath=new_db_abs_filename
                     )
                 )
+                # Flush first, otherwise expunging discards the pending RolloverFilename row
+                session.flush()
                 session.expunge_all()
 
         except SQLAlchemyError as e:
@@ -221,12 +263,21 @@ class SqliteSaver:
 
 
 def rollover(
-    old_saver: SqliteSaver, path: Optional[Path] = None, conversion_enabled: bool = True
+    old_saver: SqliteSaver,
+    path: Optional[Path] = None,
+    conversion_enabled: bool = True,
+    search_index: bool = False,
+    api_indices: bool = False,
 ) -> SqliteSaver:
     # Create new saver instance
     date_str = datetime_to_str(datetime.utcnow()).replace(":", "-")
     sqlite_rel_filename = str(path or Path(f"data/data-{date_str}.sqlite"))
-    new_saver = SqliteSaver(sqlite_rel_filename, conversion_enabled)
+    new_saver = SqliteSaver(
+        sqlite_rel_filename,
+        conversion_enabled,
+        search_index=search_index,
+        api_indices=api_indices,
+    )
     sqlite_abs_filename = os.path.abspath(str(sqlite_rel_filename))
     # Export active connections and recent messages from current database
     connections, messages = old_saver.rollover_export(
@@ -261,3 +312,20 @@ def sqlite_setup(connection):
         for statement in script.split(";"):
             if statement.strip():
                 connection.execute(text(statement.strip()))
+
+
+def create_search_index(connection):
+    """Creates the full-text search index of messages, which is then kept up to date as messages are
+    inserted. Messages already in the database are indexed too, which takes a while for a large
+    database, so is best done when it is created."""
+    with connection.begin():
+        connection.execute(text(sql_create_search_table))
+        connection.execute(text(sql_create_search_trigger))
+        connection.execute(text(sql_rebuild_search_index))
+
+
+def create_api_indices(connection):
+    """Creates the indices of the REST API queries answered from the database."""
+    with connection.begin():
+        for statement in sql_create_api_indices:
+            connection.execute(text(statement))
@@ -21,7 +21,9 @@ logger = logging.getLogger("apex")
 
 
 class SqliteThread:
-    def __init__(self, filename, rollover_config, conversion_enabled):
+    def __init__(
+        self, filename, rollover_config, conversion_enabled, search_index=False, api_indices=False
+    ):
         self.pending = []
         # Semaphore for waiting for thread to start and db to initialise
         self.start_semaphore = Semaphore(value=0)
@@ -30,6 +32,8 @@ class SqliteThread:
         self.filename = filename
         self.rollover_config = rollover_config
         self.conversion_enabled = conversion_enabled
+        self.search_index = search_index
+        self.api_indices = api_indices
 
         if self.rollover_config.get("enable"):
             unit = self.rollover_config.get("unit")
@@ -66,13 +70,23 @@ class SqliteThread:
             self.condition.notify()
 
     def rollover(self, old_saver: SqliteSaver) -> SqliteSaver:
-        return rollover_impl(old_saver, conversion_enabled=self.conversion_enabled)
+        return rollover_impl(
+            old_saver,
+            conversion_enabled=self.conversion_enabled,
+            search_index=self.search_index,
+            api_indices=self.api_indices,
+        )
 
     def stop(self):
         self.add(None)
 
     def run(self):
-        saver = SqliteSaver(self.filename, self.conversion_enabled)
+        saver = SqliteSaver(
+            self.filename,
+            self.conversion_enabled,
+            search_index=self.search_index,
+            api_indices=self.api_indices,
+        )
         self.start_semaphore.release()
         next_rollover = datetime.now() + self.rollover_interval
         while True:
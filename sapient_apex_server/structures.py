@@ -51,6 +51,11 @@ class SapientVersion(IntEnum):
         raise NotImplementedError()
 
 
+def to_sapient_version(icd_version: str) -> SapientVersion:
+    """The SapientVersion of a config's "icd_version", either its name or its protocol name."""
+    return SapientVersion[icd_version.replace(" ", "_").replace(".", "_").replace("-", "_").upper()]
+
+
 class DatabaseOperation(Enum):
     CREATE = 0
     READ = 1
@@ -81,6 +86,7 @@ class ReceivedDataRecord:
     message_id: int
     timestamp: datetime
     data_bytes: bytes
+    is_rate_limited: bool = False  # Over a RECORD_ONLY rate limit, so only stored, not parsed
 
 
 @dataclass
@@ -171,6 +177,7 @@ class MessageRecord:
     saved_timestamp: Optional[datetime] = None
     updated_data_bytes: Optional[bytes] = None  # After time offset adjustment
     sapient_version: SapientVersion = SapientVersion.LATEST
+    geofence_zones: Optional[frozenset] = None  # Geofence zones containing a located detection
 
     def type_str(self):
         if self.parsed is None:
@@ -2,12 +2,40 @@
 # Copyright (c) 2019-2024 Roke Manor Research Ltd
 #
 
+import logging
 import struct
+from collections import deque
+from collections.abc import Hashable
+from enum import Enum, IntEnum, auto
 from threading import Lock
+from typing import Optional, Union
 
 import trio
 
 
+logger = logging.getLogger("apex")
+
+# Most chunks passed to a single sendmsg() call (IOV_MAX is 1024 on Linux) and most bytes, so that
+# a large backlog is sent in several calls rather than one huge one
+_MAX_WRITE_CHUNKS = 1024
+_MAX_WRITE_BYTES = 1024 * 1024
+
+
+class SlowConsumerPolicy(Enum):
+    """What a BufferedWriter does when more data is queued than its limit."""
+
+    DISCONNECT = auto()  # Raise an error from perform_writes(), which closes the connection
+    DROP = auto()  # Coalesce and then drop the oldest droppable messages, keeping the others
+    BLOCK = auto()  # Writers wait in wait_writable() until the queue has been written
+
+
+class WritePriority(IntEnum):
+    """Priority of a message queued in a BufferedWriter; higher priority messages are sent first."""
+
+    HIGH = 0
+    NORMAL = 1
+
+
 class BufferedWriter:
     """Like a trio SendStream, but send() just buffers data and returns immediately.
 
@@ -23,42 +51,199 @@ class BufferedWriter:
        because typically writes are done from the "wrong" coroutine (e.g. writing to ASMs is done
        from the DMM coroutine, and a broken ASM connection should not close the DMM connection).
 
+    Messages are queued as they are, rather than copied into one buffer, and written together with
+    a single (vectored) sendmsg() call where the platform supports it. So a message forwarded to
+    many connections is not copied for each of them, and a large message is not copied at all.
+
+    There is a queue for each WritePriority, and messages are taken from the highest priority queue
+    first, so that e.g. a task is not held up behind a backlog of detections. Only a message that
+    has been partly written always goes first, as it must be finished before any other.
+
+    If more than max_data bytes are queued, what happens depends on the policy (see
+    SlowConsumerPolicy). With the DROP policy, queued messages with the same coalesce key are
+    replaced by the latest one, and then the oldest droppable messages are dropped, until the queue
+    is down to half of max_data. Messages that are neither are always kept, but if they alone
+    exceed max_data then the connection is closed as with the DISCONNECT policy. With the BLOCK
+    policy, the connection is closed if the queue reaches twice max_data despite blocking.
+
     The creator of this class should call nursery.start_soon(writer.perform_writes) after
     constructing this class.
     """
 
-    def __init__(self, send_stream: trio.abc.SendStream, max_data: int):
+    def __init__(
+        self,
+        send_stream: trio.abc.SendStream,
+        max_data: int,
+        policy: SlowConsumerPolicy = SlowConsumerPolicy.DISCONNECT,
+        name: str = "Connection",
+    ):
         self.send_stream = send_stream
-        self.buffered_bytes = bytearray()
+        # Queued messages for each priority, as tuples of (data, droppable, coalesce_key)
+        self.queues: list[deque[tuple[bytes, bool, Optional[Hashable]]]] = [
+            deque() for _ in WritePriority
+        ]
+        # Remainder of a message that was only partly written, which must be written next
+        self.partial: Optional[memoryview] = None
+        self.buffered_size = 0  # Including messages being written
         self.parking_lot = trio.lowlevel.ParkingLot()
+        self.writable_parking_lot = trio.lowlevel.ParkingLot()
         self.exception = None
         self.max_data = max_data
+        self.policy = policy
+        self.name = name
+        self.dropped_count = 0
+        self.coalesced_count = 0
+        self.is_shedding = False  # Whether messages have been dropped since the queue was short
+        # Only sockets (and not on Windows) support writing a list of buffers in one call
+        self.socket = getattr(send_stream, "socket", None)
+        if not hasattr(self.socket, "sendmsg"):
+            self.socket = None
 
     async def perform_writes(self):
-        """Waits for messages to be buffered then writes them; analogous to drain() in asyncio."""
-        while True:
-            while self.exception is None and len(self.buffered_bytes) == 0:
-                await self.parking_lot.park()
-            if self.exception is not None:
-                raise self.exception
-            message_data = self.buffered_bytes
-            self.buffered_bytes = bytearray()
-            await self.send_stream.send_all(message_data)
-
-    def write_nowait(self, message):
-        """Adds message data to the queue to write soon."""
+        """Waits for messages to be buffered then writes them; analogous to drain() in asyncio.
+
+        Once this returns (by an error writing, or by being cancelled), nothing more is written, so
+        the writer is closed and any task waiting in wait_writable() is woken.
+        """
+        try:
+            while True:
+                while self.exception is None and self.buffered_size == 0:
+                    await self.parking_lot.park()
+                if self.exception is not None:
+                    raise self.exception
+                # Messages are taken off the queues while being written, so they cannot be dropped
+                batch = self._take_batch()
+                batch_data = [chunk[0] for _, chunk in batch]
+                if self.partial is not None:
+                    batch_data.insert(0, self.partial)
+                if self.socket is not None:
+                    sent_size = await self.socket.sendmsg(batch_data)
+                else:
+                    await self.send_stream.send_all(
+                        batch_data[0] if len(batch_data) == 1 else b"".join(batch_data)
+                    )
+                    sent_size = sum(len(data) for data in batch_data)
+                if self.exception is None:
+                    self._remove_sent(batch, sent_size)
+        finally:
+            if self.exception is None:
+                self.exception = RuntimeError(f"{self.name} closed")
+            for queue in self.queues:
+                queue.clear()
+            self.writable_parking_lot.unpark_all()
+
+    def _take_batch(self) -> list[tuple[WritePriority, tuple]]:
+        """Removes the messages to write next from the queues, highest priority first."""
+        batch = []
+        batch_size = 0 if self.partial is None else len(self.partial)
+        for priority, queue in zip(WritePriority, self.queues):
+            while queue and len(batch) < _MAX_WRITE_CHUNKS - 1 and batch_size < _MAX_WRITE_BYTES:
+                chunk = queue.popleft()
+                batch.append((priority, chunk))
+                batch_size += len(chunk[0])
+        return batch
+
+    def _remove_sent(self, batch: list[tuple[WritePriority, tuple]], sent_size: int):
+        """Accounts for a write of the given number of bytes from the partial message and batch."""
+        self.buffered_size -= sent_size
+        if self.partial is not None:
+            if sent_size < len(self.partial):
+                self.partial = self.partial[sent_size:]
+                sent_size = 0
+            else:
+                sent_size -= len(self.partial)
+                self.partial = None
+        unsent_start = len(batch)
+        for i, (_, (data, _, _)) in enumerate(batch):
+            if sent_size < len(data):
+                if sent_size > 0:
+                    # Partial write, so keep the rest of this message (without copying it)
+                    self.partial = memoryview(data)[sent_size:]
+                    i += 1
+                unsent_start = i
+                break
+            sent_size -= len(data)
+        # Put the unsent messages back at the front of their queues
+        for priority, chunk in reversed(batch[unsent_start:]):
+            self.queues[priority].appendleft(chunk)
+        if self.buffered_size <= self.max_data:
+            self.writable_parking_lot.unpark_all()
+        if self.is_shedding and self.buffered_size <= self.max_data // 2:
+            self.is_shedding = False
+            logger.info(
+                f"{self.name} caught up with its writes ({self.dropped_count} messages dropped,"
+                f" {self.coalesced_count} coalesced so far)"
+            )
+
+    def write_nowait(
+        self,
+        message: bytes,
+        priority: WritePriority = WritePriority.NORMAL,
+        droppable: bool = False,
+        coalesce_key: Optional[Hashable] = None,
+    ):
+        """Adds message data to the queue to write soon.
+
+        The message is queued rather than copied, so must not be modified afterwards.
+
+        :param priority: Messages of higher priority are written before any already queued
+        :param droppable: Whether the message may be dropped if the queue is full (DROP policy)
+        :param coalesce_key: If the queue is full (DROP policy), only the latest queued message
+            with the same key is kept
+        """
         if self.exception is not None:
             # Already exceeded buffer limit
             return
-        self.buffered_bytes.extend(message)
-        if len(self.buffered_bytes) > self.max_data:
-            self.exception = RuntimeError(
-                f"Send buffer full ({len(self.buffered_bytes)} > {self.max_data} bytes)"
-            )
-            self.buffered_bytes = None
+        self.queues[priority].append((message, droppable, coalesce_key))
+        self.buffered_size += len(message)
+        if self.buffered_size > self.max_data:
+            if self.policy == SlowConsumerPolicy.DROP:
+                self._shed()
+            limit = 2 * self.max_data if self.policy == SlowConsumerPolicy.BLOCK else self.max_data
+            if self.buffered_size > limit:
+                self.exception = RuntimeError(
+                    f"Send buffer full ({self.buffered_size} > {limit} bytes)"
+                )
+                for queue in self.queues:
+                    queue.clear()
+                self.writable_parking_lot.unpark_all()
         # Wake the writer (if it is waiting)
         self.parking_lot.unpark()
 
+    def _shed(self):
+        """Coalesces and then drops queued messages (not ones being written) until the queue is
+        down to half of its limit, so this is not needed again on every message."""
+        if not self.is_shedding:
+            self.is_shedding = True
+            logger.warning(
+                f"{self.name} is not keeping up with its writes ({self.buffered_size} bytes"
+                f" queued), so dropping messages"
+            )
+        target_size = self.max_data // 2
+        for queue in reversed(self.queues):
+            kept = deque()
+            seen_keys = set()
+            while queue:
+                data, droppable, coalesce_key = chunk = queue.pop()
+                if coalesce_key is not None and coalesce_key in seen_keys:
+                    self.buffered_size -= len(data)
+                    self.coalesced_count += 1
+                else:
+                    if coalesce_key is not None:
+                        seen_keys.add(coalesce_key)
+                    kept.appendleft(chunk)
+            for chunk in kept:
+                if chunk[1] and self.buffered_size > target_size:
+                    self.buffered_size -= len(chunk[0])
+                    self.dropped_count += 1
+                else:
+                    queue.append(chunk)
+
+    async def wait_writable(self):
+        """Waits until the queue is within its limit, for connections with the BLOCK policy."""
+        while self.exception is None and self.buffered_size > self.max_data:
+            await self.writable_parking_lot.park()
+
 
 async def receive_until(
     receive_stream: trio.abc.ReceiveStream,
@@ -12,7 +12,12 @@ TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.dirname(TESTS_DIR)
 sys.path.append(ROOT_DIR)
 
+from sapient_apex_server.parse_proto import parse_proto
+from sapient_apex_server.structures import MessageRecord, ReceivedDataRecord
 from sapient_apex_server.time_util import datetime_to_str
+from sapient_apex_server.translator.id_generator import IdGenerator
+from sapient_apex_server.validate_proto import ValidationOptions, Validator
+from sapient_msg.latest.sapient_message_pb2 import SapientMessage
 
 
 def json_to_proto(message_class: type, json_dict: dict) -> Message:
@@ -21,6 +26,21 @@ def json_to_proto(message_class: type, json_dict: dict) -> Message:
     return msg
 
 
+def to_record(msg: dict) -> MessageRecord:
+    """Parses a message template into the record that Apex would have received."""
+    return parse_proto(
+        msg_data=ReceivedDataRecord(
+            connection_id=1,
+            message_id=1,
+            timestamp=datetime.utcnow(),
+            data_bytes=ParseDict(msg, SapientMessage()).SerializeToString(),
+        ),
+        validator=Validator(ValidationOptions()),
+        generator=IdGenerator({}),
+        enable_message_conversion=True,
+    )
+
+
 def get_register_template(node_id: str) -> dict:
     return {
         "timestamp": datetime_to_str(datetime.utcnow()),
@@ -0,0 +1,64 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+from types import SimpleNamespace
+
+from sapient_apex_server.downsample import DetectionDownsampler, TimingWheel
+from sapient_apex_server.structures import SapientVersion
+from sapient_msg.latest.sapient_message_pb2 import SapientMessage
+
+
+def test_timing_wheel():
+    """Items come out of the wheel once due, including those due after a whole rotation, and
+    advancing by more than a rotation at once still finds every item due."""
+    wheel = TimingWheel(tick=0.5, slot_count=4)
+    wheel.schedule("a", 1.2)
+    wheel.schedule("b", 0.1)
+    wheel.schedule("c", 3.4)  # In the same slot as "a", but a rotation later
+    assert wheel.advance(0.4) == []
+    assert wheel.advance(1.0) == ["b"]
+    assert wheel.advance(1.5) == ["a"]
+    assert wheel.advance(3.4) == []
+    assert wheel.advance(3.5) == ["c"]
+    wheel.schedule("d", 4.0)
+    wheel.schedule("e", 9.0)
+    assert sorted(wheel.advance(100)) == ["d", "e"]
+    assert not any(wheel.slots)
+
+
+def _detection(object_id: str, label: str):
+    message = SapientMessage(node_id="node")
+    message.detection_report.object_id = object_id
+    message.detection_report.report_id = label
+    return SimpleNamespace(
+        parsed=SimpleNamespace(parsed_proto=message), sapient_version=SapientVersion.LATEST
+    )
+
+
+def test_detection_downsampler():
+    """Each object is forwarded at most once an interval, with its newest detection held back in
+    between, and is forgotten once stale."""
+    sent = []
+    downsampler = DetectionDownsampler(
+        lambda msg, version: sent.append(msg.parsed.parsed_proto.detection_report.report_id),
+        {"maxUpdatesPerSecond": 2, "staleSeconds": 2},
+    )
+    assert downsampler.send(_detection("a", "a1"), 10.0)
+    assert downsampler.send(_detection("b", "b1"), 10.1)
+    assert not downsampler.send(_detection("a", "a2"), 10.2)
+    assert not downsampler.send(_detection("a", "a3"), 10.3)
+    downsampler.advance(10.4)
+    assert sent == ["a1", "b1"]
+    downsampler.advance(10.5)
+    assert sent == ["a1", "b1", "a3"]  # The final state of "a", although it is not updated again
+    assert downsampler.send(_detection("b", "b2"), 10.6)
+    assert not downsampler.send(_detection("b", "b3"), 10.7)
+    downsampler.advance(11.2)  # Due at 11.1, rounded up to the next tick of the wheel
+    assert sent == ["a1", "b1", "a3", "b2", "b3"]
+    assert (downsampler.held_back_count, downsampler.superseded_count) == (3, 1)
+
+    downsampler.advance(12.4)
+    assert set(downsampler.tracks) == {("node", "b")}
+    downsampler.advance(12.75)
+    assert not downsampler.tracks and not any(downsampler.wheel.slots)
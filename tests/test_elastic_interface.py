@@ -22,7 +22,11 @@ from sapient_apex_api.interface.elastic_interface import (
     ElasticInterface,
     message_template,
 )
-from sapient_apex_api.response_models import NodeDefinition, NodeDefinitionResponse
+from sapient_apex_api.response_models import (
+    DetectionSource,
+    NodeDefinition,
+    NodeDefinitionResponse,
+)
 from sapient_apex_server.structures import DatabaseOperation
 from sapient_apex_server.time_util import datetime_to_pb, datetime_to_str
 from sapient_msg.latest.registration_pb2 import Registration
@@ -396,5 +400,171 @@ def test_get_node_definitions(interface: ElasticInterface, index: str, ndocs: in
     assert comparison == expected
 
 
+def partitioned_interface(interval: str = "days", **config) -> ElasticInterface:
+    return ElasticInterface(
+        {"useSsl": False, "partitionInterval": interval, **config},
+        index="messages",
+        _start_op_thread=False,
+    )
+
+
+def test_partition_names():
+    interface = partitioned_interface()
+    document = {"timestamp": "2024-02-29T23:59:59.5Z"}
+    assert interface.get_partition(document) == "messages-2024.02.29"
+    assert interface.partitions == {"messages-2024.02.29"}
+
+    interface = partitioned_interface("months")
+    assert interface.get_partition(document) == "messages-2024.02"
+    start = interface.get_partition_start("messages-2024.12")
+    assert interface.get_partition_end(start) == datetime(2025, 1, 1)
+    assert interface.get_partition_start("messages-other") is None
+
+    with pytest.raises(ValueError):
+        partitioned_interface("fortnights")
+
+
+def test_partitions_in_time_range():
+    interface = partitioned_interface()
+    interface.partitions = {f"messages-2024.01.{day:02}" for day in range(1, 11)}
+    assert interface.get_indices(datetime(2024, 1, 3, 12), datetime(2024, 1, 5)) == [
+        "messages-2024.01.05",
+        "messages-2024.01.04",
+        "messages-2024.01.03",
+    ]
+    assert interface.get_indices(datetime(2023, 1, 1), datetime(2023, 2, 1)) == []
+    assert len(interface.get_indices()) == 10
+
+    unpartitioned = ElasticInterface({"useSsl": False}, _start_op_thread=False)
+    assert unpartitioned.get_indices(datetime(2024, 1, 3), datetime(2024, 1, 5)) == ["messages"]
+
+
+def test_retention():
+    interface = partitioned_interface(retentionDays=2)
+    today = datetime.utcnow()
+    interface.partitions = {
+        f"messages-{(today - timedelta(days=days)).strftime('%Y.%m.%d')}" for days in range(5)
+    }
+    with mock.patch("elasticsearch.client.IndicesClient.delete") as mocked_delete:
+        interface.apply_retention()
+    assert len(interface.partitions) == 3
+    assert mocked_delete.call_count == 2
+
+
+def test_retention_while_messages_arrive():
+    """Retention is applied periodically by the database thread even if it is never idle."""
+    interface = partitioned_interface(retentionDays=2)
+    expired = f"messages-{(datetime.utcnow() - timedelta(days=5)).strftime('%Y.%m.%d')}"
+    interface.partitions = {expired}
+    document = {"timestamp": datetime_to_str(datetime.utcnow())}
+    with (
+        mock.patch("sapient_apex_api.interface.elastic_interface.retention_check_seconds", 0.2),
+        mock.patch.object(ElasticInterface, "setup_partitions"),
+        mock.patch("elasticsearch.Elasticsearch.index"),
+        mock.patch("elasticsearch.client.IndicesClient.delete") as mocked_delete,
+    ):
+        interface.thread.start()
+        deadline = time.monotonic() + 5
+        while expired in interface.partitions and time.monotonic() < deadline:
+            interface.insert_into("messages", document)
+            time.sleep(0.01)
+        interface.stop()
+        interface.join()
+    assert expired not in interface.partitions
+    mocked_delete.assert_called_once_with(index=expired, ignore_unavailable=True)
+
+
+def test_status_report_searches_newest_partition_first():
+    interface = partitioned_interface()
+    interface.partitions = {"messages-2024.01.01", "messages-2024.01.02", "messages-2024.01.03"}
+    hit = {"_source": {"node_id": "1", "timestamp": "2024-01-03", "message": {"a": 1}}}
+    with mock.patch("elasticsearch.Elasticsearch.search") as mocked_search:
+        mocked_search.return_value = {"hits": {"hits": [hit]}}
+        assert interface.get_latest_status_report_message("1") == ("1", "2024-01-03", {"a": 1})
+        mocked_search.assert_called_once()
+        assert mocked_search.call_args.kwargs["index"] == "messages-2024.01.03"
+
+        mocked_search.reset_mock()
+        mocked_search.side_effect = [{"hits": {"hits": []}}, {"hits": {"hits": [hit]}}]
+        assert interface.get_latest_status_report_message("1") == ("1", "2024-01-03", {"a": 1})
+        assert mocked_search.call_args.kwargs["index"] == "messages-2024.01.02,messages-2024.01.01"
+
+
+def test_latest_registrations_paged():
+    interface = ElasticInterface({"useSsl": False}, _start_op_thread=False)
+
+    def page(node_ids, after_key):
+        buckets = [
+            {"latest": {"hits": {"hits": [{"_source": {"node_id": n, "timestamp": n}}]}}}
+            for n in node_ids
+        ]
+        return {"aggregations": {"node_ids": {"buckets": buckets, "after_key": after_key}}}
+
+    with mock.patch("elasticsearch.Elasticsearch.search") as mocked_search:
+        mocked_search.side_effect = [
+            page(["1", "3"], {"node_id": "3"}),
+            page(["2"], {"node_id": "2"}),
+            page([], None),
+        ]
+        registrations = interface.get_latest_registration_messages()
+    assert [r["node_id"] for r in registrations] == ["3", "2", "1"]
+    assert mocked_search.call_count == 3
+    assert mocked_search.call_args.kwargs["aggs"]["node_ids"]["composite"]["after"] == {
+        "node_id": "2"
+    }
+
+
+def test_detection_pages():
+    interface = partitioned_interface()
+    interface.partitions = {"messages-2024.01.01", "messages-2024.01.02", "messages-2024.01.03"}
+
+    def page(confidences, pit_id):
+        hits = [
+            {
+                "_source": {
+                    "node_id": "1",
+                    "timestamp": f"2024-01-02T00:00:0{i}Z",
+                    "message": {"detection_confidence": confidence},
+                },
+                "sort": [i],
+            }
+            for i, confidence in enumerate(confidences)
+        ]
+        return {"pit_id": pit_id, "hits": {"hits": hits}}
+
+    args = {
+        "node_ids": ["all"],
+        "detection_source": DetectionSource.all,
+        "detection_confidence": 0.5,
+        "detection_classification": "",
+        "detection_from": datetime(2024, 1, 2, 12),
+        "detection_to": datetime.min,
+        "page_size": 2,
+    }
+    with (
+        mock.patch("elasticsearch.Elasticsearch.open_point_in_time") as mocked_open,
+        mock.patch("elasticsearch.Elasticsearch.close_point_in_time") as mocked_close,
+        mock.patch("elasticsearch.Elasticsearch.search") as mocked_search,
+    ):
+        mocked_open.return_value = {"id": "pit1"}
+        mocked_search.side_effect = [page([0.9, 0.1], "pit2"), page([0.8], "pit3")]
+        detections, cursor = interface.get_detection_page(**args)
+        assert len(detections) == 1
+        assert mocked_open.call_args.kwargs["index"] == "messages-2024.01.03,messages-2024.01.02"
+        assert mocked_search.call_args.kwargs["pit"]["id"] == "pit1"
+        assert mocked_search.call_args.kwargs["search_after"] is None
+
+        detections, cursor = interface.get_detection_page(**args, cursor=cursor)
+        assert len(detections) == 1
+        assert cursor is None
+        assert mocked_search.call_args.kwargs["pit"]["id"] == "pit2"
+        assert mocked_search.call_args.kwargs["search_after"] == [1]
+        mocked_open.assert_called_once()
+        mocked_close.assert_called_once_with(id="pit3")
+
+    with pytest.raises(ValueError):
+        interface.get_detection_page(**args, cursor="not a cursor")
+
+
 if __name__ == "__main__":
     pytest.main()
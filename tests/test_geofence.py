@@ -0,0 +1,94 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+import math
+import random
+
+import pytest
+
+from sapient_apex_server import geofence
+from sapient_apex_server.geofence import Geofence
+
+
+@pytest.fixture(params=[True, False], ids=["numpy", "python"])
+def use_numpy(request, monkeypatch) -> bool:
+    """Runs a test with the NumPy edge tests (from the "geofence" extra) and without them."""
+    if request.param and geofence.np is None:
+        pytest.skip("NumPy is not installed (poetry install --extras geofence)")
+    if not request.param:
+        monkeypatch.setattr(geofence, "np", None)
+    return request.param
+
+
+def _brute_force_zones(zones: dict, x: float, y: float) -> frozenset:
+    """The zones containing the point, by testing every edge of every zone."""
+    result = set()
+    for name, points in zones.items():
+        edges = zip(points, points[1:] + points[:1])
+        crossings = sum(geofence._crosses((x1, y1, x2, y2), x, y) for (x1, y1), (x2, y2) in edges)
+        if crossings % 2:
+            result.add(name)
+    return frozenset(result)
+
+
+def _random_zones(rng: random.Random, count: int) -> dict:
+    """Star-shaped (so often concave) polygons of various sizes, some overlapping."""
+    zones = {}
+    for index in range(count):
+        centre_x, centre_y = rng.uniform(0, 100), rng.uniform(0, 100)
+        size = rng.choice([1, 5, 30])
+        vertex_count = rng.randint(3, 12)
+        zones[f"zone{index}"] = [
+            (
+                centre_x + size * rng.uniform(0.2, 1) * math.cos(2 * math.pi * k / vertex_count),
+                centre_y + size * rng.uniform(0.2, 1) * math.sin(2 * math.pi * k / vertex_count),
+            )
+            for k in range(vertex_count)
+        ]
+    return zones
+
+
+def test_geofence_matches_brute_force(use_numpy: bool):
+    """Looking up points in the grid finds the same zones as testing every zone."""
+    rng = random.Random(1234)
+    zones = _random_zones(rng, 200)
+    for cell_size in (None, 0.7, 50):
+        config = (
+            {"zones": zones} if cell_size is None else {"zones": zones, "gridCellSize": cell_size}
+        )
+        fence = Geofence(config)
+        for _ in range(500):
+            x, y = rng.uniform(-20, 120), rng.uniform(-20, 120)
+            assert fence.zones_at(x, y) == _brute_force_zones(zones, x, y)
+
+
+@pytest.mark.filterwarnings("error::RuntimeWarning")
+def test_geofence_config(use_numpy: bool):
+    """Square zones include their interior, including whole cells of the grid, but not outside.
+
+    Their horizontal edges are never divided by, or are only divided by in NumPy without warnings.
+    """
+    fence = Geofence(
+        {
+            "zones": {
+                "perimeter": [[0, 0], [100, 0], [100, 100], [0, 100]],
+                "sectorB": [[50, 50], [60, 50], [60, 60], [50, 60]],
+            },
+            "dropOutside": ["perimeter"],
+            "gridCellSize": 10,
+        }
+    )
+    assert fence.drop_outside == {"perimeter"}
+    assert any(cell.inside and not cell.boundary for cell in fence.cells.values())
+    assert (fence.cells[(5, 5)].edge_array is not None) == use_numpy
+    assert fence.zones_at(55, 55) == {"perimeter", "sectorB"}
+    assert fence.zones_at(55, 50) == {"perimeter", "sectorB"}  # On a horizontal edge
+    assert fence.zones_at(25, 75) == {"perimeter"}
+    assert fence.zones_at(-1, 50) == frozenset()
+    assert fence.zones_at(500, 500) == frozenset()
+    assert Geofence.from_config({}) is None
+    with pytest.raises(RuntimeError, match="Unknown geofence zones: sectorC"):
+        fence.check_names(["sectorB", "sectorC"])
+    with pytest.raises(RuntimeError, match="at least 3 points"):
+        Geofence({"zones": {"line": [[0, 0], [1, 1]]}})
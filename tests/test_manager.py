@@ -7,7 +7,7 @@ from typing import Optional
 import sys
 import os
 from datetime import datetime
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 import pytest
 
 TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -87,6 +87,16 @@ class TestManager:
         self.manager.add_sapient_message(self._get_message_record(None, None, None, None, None))
         self.mock_interface.insert_into.assert_not_called()
 
+    def test_add_message_dropped_before_parsing(self, before_each):
+        """Detections dropped by the confidence filter before parsing are skipped without errors."""
+        dummy_message = self._get_message_record(
+            "detection_report", "1234", None, datetime.utcnow(), None
+        )
+        with patch("sapient_apex_api.manager.logger") as mocked_logger:
+            self.manager.add_sapient_message(dummy_message)
+        self.mock_interface.insert_into.assert_not_called()
+        mocked_logger.error.assert_not_called()
+
 
 if __name__ == "__main__":
     pytest.main(
@@ -14,7 +14,7 @@ from unittest import TestCase, main
 import ulid
 from google.protobuf.json_format import ParseDict
 
-from sapient_apex_server.parse_proto import parse_proto
+from sapient_apex_server.parse_proto import parse_proto, peek_detection
 from sapient_apex_server.translator.id_generator import IdGenerator
 from tests.msg_templates import (
     get_alert_ack_message_template,
@@ -32,14 +32,14 @@ TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.dirname(TESTS_DIR)
 sys.path.append(ROOT_DIR)
 
-from sapient_apex_server.structures import ReceivedDataRecord
+from sapient_apex_server.structures import ReceivedDataRecord, SilentError
 from sapient_apex_server.validate_proto import ValidationOptions, Validator
 from sapient_msg.latest.sapient_message_pb2 import SapientMessage
 
 parse_proto_partial = functools.partial(parse_proto, enable_message_conversion=False)
 
 
-def parse_message(msg_bytes, id_generator: IdGenerator):
+def parse_message(msg_bytes, id_generator: IdGenerator, **kwargs):
     raw_message = ReceivedDataRecord(
         connection_id=1,
         message_id=1,
@@ -66,7 +66,7 @@ def parse_message(msg_bytes, id_generator: IdGenerator):
             },
         }
     )
-    return parse_proto_partial(raw_message, Validator(validation_options), id_generator)
+    return parse_proto_partial(raw_message, Validator(validation_options), id_generator, **kwargs)
 
 
 class MsgParsingTestCase(TestCase):
@@ -165,6 +165,42 @@ class MsgParsingTestCase(TestCase):
         msg_parsed_dict = json.loads(msg_parsed.data_json)
         self.assertDictEqual(msg_parsed_dict, msg)
 
+    def test_detection_early_drop(self):
+        """Detections failing the confidence filter are found from the raw bytes, without parsing."""
+        self.add_node_id_to_map()
+        msg = get_detection_message_template(
+            node_id=self.node_id,
+            report_id=ulid.new().str,
+            object_id=ulid.new().str,
+        )
+        msg["detection_report"]["detection_confidence"] = 0.25
+        message = ParseDict(msg, SapientMessage())
+        msg_bytes = message.SerializeToString()
+
+        peeked = peek_detection(msg_bytes)
+        self.assertEqual(peeked.node_id, self.node_id)
+        self.assertEqual(peeked.message_timestamp, message.timestamp.ToDatetime())
+        self.assertEqual(peeked.detection_confidence, 0.25)
+        self.assertIsNone(peek_detection(msg_bytes[:-1]))
+        status = get_status_message_template(node_id=self.node_id, report_id=ulid.new().str)
+        self.assertIsNone(peek_detection(ParseDict(status, SapientMessage()).SerializeToString()))
+
+        def detection_filter(confidence):
+            return SilentError("Low confidence") if confidence and confidence < 0.5 else None
+
+        msg_parsed = parse_message(msg_bytes, self.id_generator, detection_filter=detection_filter)
+        self.assertEqual(msg_parsed.error.description, "Low confidence")
+        self.assertIsNone(msg_parsed.parsed.parsed_proto)
+        self.assertEqual(msg_parsed.parsed.message_type, "detection_report")
+        self.assertEqual(msg_parsed.parsed.node_id, self.node_id)
+
+        message.detection_report.detection_confidence = 0.75
+        msg_parsed = parse_message(
+            message.SerializeToString(), self.id_generator, detection_filter=detection_filter
+        )
+        self.assertIsNone(msg_parsed.error)
+        self.assertEqual(msg_parsed.parsed.detection_confidence, 0.75)
+
 
 if __name__ == "__main__":
     main(
@@ -178,5 +214,6 @@ if __name__ == "__main__":
             "MsgParsingTestCase.test_alert_msg",
             "MsgParsingTestCase.test_alert_ack_msg",
             "MsgParsingTestCase.test_error_msg",
+            "MsgParsingTestCase.test_detection_early_drop",
         ]
     )
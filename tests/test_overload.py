@@ -0,0 +1,51 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+from datetime import timedelta
+
+from sapient_apex_server.overload import LoadLevel, OverloadController
+
+
+def test_overload_levels():
+    """The level goes straight up to match the backlog or latency, but only comes down a level once
+    both are below half of its thresholds."""
+    controller = OverloadController(
+        {"enable": True, "backlogThresholds": [10, 20, 40], "latencyThresholdsSeconds": [1, 2, 4]}
+    )
+    controller.backlog = 25
+    controller.update(timedelta(0))
+    assert controller.level == LoadLevel.SKIP_DERIVED_FORMATS
+    controller.update(timedelta(seconds=5))
+    assert controller.level == LoadLevel.SAMPLE_DETECTIONS
+    controller.update(timedelta(seconds=3))
+    assert controller.level == LoadLevel.SAMPLE_DETECTIONS
+    controller.backlog = 8
+    controller.update(timedelta(seconds=1.5))
+    assert controller.level == LoadLevel.SKIP_DERIVED_FORMATS
+    controller.backlog = 0
+    controller.update(timedelta(0))
+    assert controller.level == LoadLevel.NORMAL
+
+
+def test_overload_sampling():
+    controller = OverloadController({"enable": True, "sampleInterval": 3})
+    assert all(controller.keep_detection() for _ in range(5))
+    controller.level = LoadLevel.SAMPLE_DETECTIONS
+    assert [controller.keep_detection() for _ in range(7)] == [
+        True,
+        False,
+        False,
+        True,
+        False,
+        False,
+        True,
+    ]
+    assert controller.shed_detection_count == 4
+
+
+def test_overload_disabled():
+    controller = OverloadController({})
+    controller.backlog = 10**6
+    controller.update(timedelta(days=1))
+    assert controller.level == LoadLevel.NORMAL
@@ -0,0 +1,47 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+from sapient_apex_server.rate_limit import RateLimit, RateLimitAction, RateLimiter, TokenBucket
+
+
+def test_token_bucket():
+    """A bucket allows a burst at once, then refills at its rate up to the burst size."""
+    bucket = TokenBucket(rate=10, burst=2)
+    assert [bucket.take(0.0) for _ in range(3)] == [True, True, False]
+    assert bucket.take(0.1) and not bucket.take(0.1)
+    assert [bucket.take(10.0) for _ in range(3)] == [True, True, False]
+
+
+def test_rate_limiter_sample():
+    """Over a SAMPLE limit, the first message and every sampleInterval-th after it are handled."""
+    limit = RateLimit.from_config(
+        {"messagesPerSecond": 1, "burst": 1, "action": "SAMPLE", "sampleInterval": 3}
+    )
+    limiter = RateLimiter("Connection 1", limit, {}, {})
+    drop = RateLimitAction.DROP
+    assert [limiter.check(None, 0.0) for _ in range(8)] == [
+        None,  # Within the limit
+        None,  # First over the limit
+        drop,
+        drop,
+        None,
+        drop,
+        drop,
+        None,
+    ]
+    assert (limiter.dropped_count, limiter.sampled_count) == (4, 3)
+    assert limiter.check(None, 5.0) is None and not limiter.is_limiting
+
+
+def test_rate_limiter_node():
+    """Node limits apply to the node across all connections, which share the node's bucket."""
+    node_limits = {"node": RateLimit.from_config({"messagesPerSecond": 1, "action": "RECORD_ONLY"})}
+    node_buckets = {}
+    first = RateLimiter("Connection 1", None, node_limits, node_buckets)
+    second = RateLimiter("Connection 2", None, node_limits, node_buckets)
+    assert first.check(None, 0.0) is None and first.check("other", 0.0) is None
+    assert first.check("node", 0.0) is None
+    assert second.check("node", 0.5) == RateLimitAction.RECORD_ONLY
+    assert second.recorded_count == 1 and first.recorded_count == 0
+    assert second.check("node", 1.0) is None
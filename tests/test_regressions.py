@@ -6,15 +6,24 @@ import json
 import struct
 import xml.etree.ElementTree as ET
 from collections.abc import Callable
+from datetime import datetime, timedelta
 from textwrap import dedent
 from typing import Sequence, Union
+from unittest.mock import Mock
 
 import trio
+import trio.testing
 from google.protobuf.json_format import MessageToDict
 from google.protobuf.json_format import Parse as MessageFromJson
 from google.protobuf.message import Message
 from pytest import fixture
 
+from sapient_apex_server import apex_server
+from sapient_apex_server.connection import DuplicateFilter, DuplicateKey
+from sapient_apex_server.geofence import Geofence
+from sapient_apex_server.overload import LoadLevel
+from sapient_apex_server.structures import MessageRecord, ParsedRecord, ReceivedDataRecord
+from sapient_apex_server.trio_util import receive_size_prefixed, receive_until
 from sapient_msg.latest.sapient_message_pb2 import SapientMessage
 
 
@@ -93,6 +102,335 @@ async def test_proto_asm_to_proto_dmm(
     assert to_dict(await dmm.receive_some()) == to_dict(proto_sensor_status)
 
 
+async def test_parent_subscriptions(
+    add_dummy_node: Callable,
+    proto_registration: dict,
+    proto_detection_report: dict,
+    proto_sensor_status: dict,
+):
+    """Parents are only sent the message types, nodes and detection confidences they subscribe to."""
+    parents = {
+        "all": add_dummy_node("Parent", format="PROTO", forwardAll=True),
+        "types": add_dummy_node(
+            "Parent",
+            format="PROTO",
+            forwardAll=True,
+            subscriptions={"messageTypes": ["detection_report"]},
+        ),
+        "confident": add_dummy_node(
+            "Parent", format="PROTO", forwardAll=True, subscriptions={"minDetectionConfidence": 0.5}
+        ),
+        "nodes": add_dummy_node(
+            "Parent",
+            format="PROTO",
+            forwardAll=True,
+            subscriptions={"nodeIds": ["00000000-0000-4000-8000-000000000000"]},
+        ),
+    }
+    asm: trio.abc.Stream = add_dummy_node("Child", format="PROTO")
+    await trio.testing.wait_all_tasks_blocked()
+
+    await asm.send_all(serialize_dict(proto_registration))
+    await asm.receive_some()  # Registration ack
+    for confidence in (0.3, 0.9):
+        detection = {**proto_detection_report}
+        detection["detectionReport"] = {
+            **detection["detectionReport"],
+            "detectionConfidence": confidence,
+        }
+        await asm.send_all(serialize_dict(detection))
+    await asm.send_all(serialize_dict(proto_sensor_status))
+
+    async def receive_types(stream: trio.abc.Stream, count: int) -> list:
+        read_buffer = bytearray()
+        result = []
+        for _ in range(count):
+            message = SapientMessage()
+            message.ParseFromString(
+                bytes(await receive_size_prefixed(stream, read_buffer, 10**6))
+            )
+            content_type = message.WhichOneof("content")
+            if content_type == "detection_report":
+                content_type += f" {message.detection_report.detection_confidence:.1f}"
+            result.append(content_type)
+        assert not read_buffer
+        return result
+
+    with trio.fail_after(5):
+        assert await receive_types(parents["all"], 4) == [
+            "registration",
+            "detection_report 0.3",
+            "detection_report 0.9",
+            "status_report",
+        ]
+        assert await receive_types(parents["types"], 2) == [
+            "detection_report 0.3",
+            "detection_report 0.9",
+        ]
+        assert await receive_types(parents["confident"], 3) == [
+            "registration",
+            "detection_report 0.9",
+            "status_report",
+        ]
+    await trio.testing.wait_all_tasks_blocked()
+    assert parents["nodes"].receiving.statistics().current_buffer_used == 0
+    assert parents["types"].receiving.statistics().current_buffer_used == 0
+
+
+async def test_rate_limit_record_only(
+    add_dummy_node: Callable,
+    callbacks,
+    proto_registration: dict,
+    proto_detection_report: dict,
+    proto_sensor_status: dict,
+):
+    """Messages over a RECORD_ONLY rate limit are stored without being parsed or forwarded."""
+    parent = add_dummy_node("Parent", format="PROTO", forwardAll=True)
+    asm: trio.abc.Stream = add_dummy_node(
+        "Child",
+        format="PROTO",
+        rateLimit={"messagesPerSecond": 0.001, "burst": 3, "action": "RECORD_ONLY"},
+    )
+    await trio.testing.wait_all_tasks_blocked()
+    for message in [proto_registration] + [proto_detection_report] * 3 + [proto_sensor_status]:
+        await asm.send_all(serialize_dict(message))
+    await trio.testing.wait_all_tasks_blocked()
+
+    read_buffer = bytearray()
+    with trio.fail_after(5):
+        for expected_type in ["registration", "detection_report", "detection_report"]:
+            message = SapientMessage()
+            message.ParseFromString(
+                bytes(await receive_size_prefixed(parent, read_buffer, 10**6))
+            )
+            assert message.WhichOneof("content") == expected_type
+    await trio.testing.wait_all_tasks_blocked()  # The rest are not parsed, so not in a thread
+    assert not read_buffer
+    assert parent.receiving.statistics().current_buffer_used == 0
+
+    stored = [call.args[0] for call in callbacks.on_message_receive.call_args_list]
+    assert [msg.type_str() for msg in stored] == ["registration"] + ["detection_report"] * 2 + [
+        "--"
+    ] * 2
+    assert all(msg.error.description == "Over rate limit, so not parsed" for msg in stored[3:])
+    assert stored[4].data_binary_proto == serialize_dict(proto_sensor_status)[4:]
+
+
+async def test_overload_shedding(
+    server,
+    add_dummy_node: Callable,
+    callbacks,
+    monkeypatch,
+    proto_registration: dict,
+    proto_detection_report: dict,
+):
+    """While overloaded, detections are sampled before being parsed, and are parsed without deriving
+    XML or JSON, but XML is still translated for connections that need it."""
+    parse_proto = Mock(wraps=apex_server.parse_proto)
+    monkeypatch.setattr(apex_server, "parse_proto", parse_proto)
+    server.overload.level = LoadLevel.SAMPLE_DETECTIONS
+    server.overload.sample_interval = 2
+    dmm: trio.abc.Stream = add_dummy_node("Peer", format="XML")
+    asm: trio.abc.Stream = add_dummy_node("Child", format="PROTO")
+    await trio.testing.wait_all_tasks_blocked()
+
+    await asm.send_all(serialize_dict(proto_registration))
+    assert to_xml(await dmm.receive_some()).tag == "SensorRegistration"
+    for _ in range(3):
+        await asm.send_all(serialize_dict(proto_detection_report))
+    with trio.fail_after(5):
+        read_buffer = bytearray()
+        for _ in range(2):
+            message = await receive_until(dmm, read_buffer, b"\0", 10**6)
+            assert to_xml(message).tag == "DetectionReport"
+    await trio.testing.wait_all_tasks_blocked()
+    assert not read_buffer and dmm.receiving.statistics().current_buffer_used == 0
+
+    stored = [call.args[0] for call in callbacks.on_message_receive.call_args_list]
+    assert [msg.type_str() for msg in stored] == ["registration"] + ["detection_report"] * 2
+    assert stored[1].data_json is None and stored[1].data_decoded_xml == ""
+    assert server.overload.shed_detection_count == 1
+    assert parse_proto.call_count == 3  # The detection not sampled was not parsed
+
+
+async def test_duplicate_detections(
+    server,
+    add_dummy_node: Callable,
+    callbacks,
+    proto_registration: dict,
+    proto_detection_report: dict,
+):
+    """Copies of recent detection reports are recorded as silent errors and not forwarded."""
+    server.connection_creator.shared_data.duplicate_filter = DuplicateFilter(
+        DuplicateKey.PAYLOAD, timedelta(seconds=5), max_entries=100
+    )
+    dmm: trio.abc.Stream = add_dummy_node("Peer", format="PROTO")
+    asm: trio.abc.Stream = add_dummy_node("Child", format="PROTO")
+    await trio.testing.wait_all_tasks_blocked()
+
+    await asm.send_all(serialize_dict(proto_registration))
+    for confidence in (0.75, 0.75, 0.25):
+        detection = {**proto_detection_report}
+        detection["detectionReport"] = {
+            **detection["detectionReport"],
+            "detectionConfidence": confidence,
+        }
+        await asm.send_all(serialize_dict(detection))
+    with trio.fail_after(5):
+        read_buffer = bytearray()
+        received = [
+            SapientMessage.FromString(bytes(await receive_size_prefixed(dmm, read_buffer, 10**6)))
+            for _ in range(3)
+        ]
+    assert [message.detection_report.detection_confidence for message in received[1:]] == [
+        0.75,
+        0.25,
+    ]
+    await trio.testing.wait_all_tasks_blocked()
+    assert not read_buffer and dmm.receiving.statistics().current_buffer_used == 0
+    stored = [call.args[0] for call in callbacks.on_message_receive.call_args_list]
+    assert [msg.error.description if msg.error else None for msg in stored] == [
+        None,
+        None,
+        "Duplicate of a recent detection report",
+        None,
+    ]
+
+
+async def test_detection_downsampling(
+    add_dummy_node: Callable,
+    proto_registration: dict,
+    proto_detection_report: dict,
+):
+    """A downsampling Parent gets the first detection of an object at once and the newest one once
+    it is due another update; the one in between is never forwarded to it."""
+    downsampled = add_dummy_node(
+        "Parent",
+        format="PROTO",
+        forwardAll=True,
+        detectionDownsampling={"enable": True, "maxUpdatesPerSecond": 4},
+    )
+    asm: trio.abc.Stream = add_dummy_node("Child", format="PROTO")
+    await trio.testing.wait_all_tasks_blocked()
+
+    await asm.send_all(serialize_dict(proto_registration))
+    for confidence in (0.25, 0.5, 0.75):
+        detection = {**proto_detection_report}
+        detection["detectionReport"] = {
+            **detection["detectionReport"],
+            "detectionConfidence": confidence,
+        }
+        await asm.send_all(serialize_dict(detection))
+    with trio.fail_after(5):
+        read_buffer = bytearray()
+        received = [
+            SapientMessage.FromString(
+                bytes(await receive_size_prefixed(downsampled, read_buffer, 10**6))
+            )
+            for _ in range(3)
+        ]
+    assert [message.detection_report.detection_confidence for message in received[1:]] == [
+        0.25,
+        0.75,
+    ]
+    await trio.sleep(0.5)
+    assert not read_buffer and downsampled.receiving.statistics().current_buffer_used == 0
+
+
+async def test_geofence(
+    server,
+    add_dummy_node: Callable,
+    callbacks,
+    proto_registration: dict,
+    proto_detection_report: dict,
+):
+    """Detections outside the perimeter are dropped, and Parents subscribed to zones are only sent
+    the detections inside them."""
+    server.connection_creator.shared_data.geofence = Geofence(
+        {
+            "zones": {
+                "perimeter": [[49, -3], [53, -3], [53, 1], [49, 1]],
+                "sectorB": [[50.5, -1.5], [51, -1.5], [51, -1], [50.5, -1]],
+                "sectorC": [[51, -1], [52, -1], [52, 0], [51, 0]],
+            },
+            "dropOutside": ["perimeter"],
+        }
+    )
+    parents = {
+        zone: add_dummy_node(
+            "Parent", format="PROTO", forwardAll=True, subscriptions={"zones": [zone]}
+        )
+        for zone in ("sectorB", "sectorC")
+    }
+    asm: trio.abc.Stream = add_dummy_node("Child", format="PROTO")
+    await trio.testing.wait_all_tasks_blocked()
+
+    await asm.send_all(serialize_dict(proto_registration))
+    for report_id, x, y in [("inB", 50.789, -1.118), ("outside", 60, 0), ("inC", 51.5, -0.5)]:
+        detection = {**proto_detection_report}
+        detection["detectionReport"] = {
+            **detection["detectionReport"],
+            "reportId": report_id,
+            "location": {**detection["detectionReport"]["location"], "x": x, "y": y},
+        }
+        await asm.send_all(serialize_dict(detection))
+
+    with trio.fail_after(5):
+        for zone, report_id in [("sectorB", "inB"), ("sectorC", "inC")]:
+            read_buffer = bytearray()
+            received = [
+                SapientMessage.FromString(
+                    bytes(await receive_size_prefixed(parents[zone], read_buffer, 10**6))
+                )
+                for _ in range(2)
+            ]
+            assert received[0].WhichOneof("content") == "registration"
+            assert received[1].detection_report.report_id == report_id
+    await trio.testing.wait_all_tasks_blocked()
+    assert all(p.receiving.statistics().current_buffer_used == 0 for p in parents.values())
+    stored = [call.args[0] for call in callbacks.on_message_receive.call_args_list]
+    assert [msg.error.description if msg.error else None for msg in stored] == [
+        None,
+        None,
+        "Detection outside geofence",
+        None,
+    ]
+
+
+def test_duplicate_filter_window(proto_detection_report: dict):
+    """Detections are remembered for the window after they were received, and by object key."""
+    duplicate_filter = DuplicateFilter(DuplicateKey.OBJECT, timedelta(seconds=5), max_entries=2)
+    start = datetime(2024, 1, 1)
+
+    def record(seconds: float, object_id: str = "01HX0000000000000000000000") -> MessageRecord:
+        detection = {**proto_detection_report}
+        detection["detectionReport"] = {**detection["detectionReport"], "objectId": object_id}
+        message = MessageFromJson(json.dumps(detection), SapientMessage())
+        return MessageRecord(
+            received=ReceivedDataRecord(1, 1, start + timedelta(seconds=seconds), b""),
+            data_decoded_xml="",
+            data_binary_proto=b"",
+            decoded_timestamp=start,
+            parsed=ParsedRecord(
+                message_type="detection_report",
+                node_id=message.node_id,
+                internal_sensor_id=None,
+                destination_node_id=None,
+                message_timestamp=message.timestamp.ToDatetime(),
+                detection_confidence=None,
+                parsed_proto=message,
+                parsed_xml=None,
+            ),
+        )
+
+    assert not duplicate_filter.is_duplicate(record(0))
+    assert duplicate_filter.is_duplicate(record(4))
+    assert not duplicate_filter.is_duplicate(record(6))  # The first has expired
+    assert not duplicate_filter.is_duplicate(record(7, "01HX0000000000000000000001"))
+    assert not duplicate_filter.is_duplicate(record(8, "01HX0000000000000000000002"))
+    assert not duplicate_filter.is_duplicate(record(9))  # Too many newer entries to remember it
+
+
 XML_TYPES = Union[bytes, bytearray, str, ET.Element]
 PROTO_TYPES = Union[bytes, bytearray, str, Message, dict]
 
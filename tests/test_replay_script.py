@@ -9,17 +9,40 @@ from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import List
 
+import pytest
 import trio
 from google.protobuf.json_format import ParseDict
 from pytest import fixture
+from sqlalchemy import text
 
-from sapient_apex_replay.replay import read_proto_message, read_xml_message, start_replayer
-from sapient_apex_server.sqlite_saver import SqliteSaver
-from sapient_apex_server.structures import ConnectionRecord, ReceivedDataRecord, MessageFormat
-from sapient_apex_server.time_util import datetime_to_str
+from sapient_apex_replay.archive_index import ArchiveIndex
+from sapient_apex_replay.benchmark import LatencyTracker
+from sapient_apex_replay.replay import (
+    Database,
+    ReplayMessage,
+    Sleeper,
+    read_proto_message,
+    read_xml_message,
+    replay_indices,
+    send_blocks,
+    start_replayer,
+)
+from sapient_apex_server.sqlite_saver import SqliteSaver, rollover
+from sapient_apex_server.structures import (
+    ConnectionRecord,
+    DisconnectionRecord,
+    MessageFormat,
+    ReceivedDataRecord,
+)
+from sapient_apex_server.time_util import datetime_to_int, datetime_to_str
 from sapient_apex_server.translator.id_generator import IdGenerator
 from sapient_apex_server.validate_proto import ValidationOptions, Validator
 from sapient_msg.latest.sapient_message_pb2 import SapientMessage
+from tests.msg_templates import (
+    get_detection_message_template,
+    get_register_template,
+    get_status_message_template,
+)
 from tests.test_msg_parsing import parse_proto_partial as parse_proto
 from tests.test_routing import NodeType, get_messages
 
@@ -153,3 +176,410 @@ def test_replay_script(replay_test_config):
             # Just checking for the presense of the xml header, the remaining contents
             # should be already be validated in other tests.
             assert received_message.find("<?xml version") == 0
+
+
+def test_initial_messages(replay_test_config):
+    """Checks the latest registration and status reports before the start time are found, and
+    that only the messages inside the time window are replayed."""
+    start_time = datetime.utcnow() - timedelta(seconds=60)
+    validator = Validator(ValidationOptions())
+    node_ids = [str(uuid.uuid4()) for _ in range(2)]
+    unchanged = get_status_message_template(node_ids[0], "4")
+    unchanged["status_report"]["info"] = "INFO_UNCHANGED"
+    messages = [
+        # (seconds from start, message)
+        (-30, get_register_template(node_ids[0])),
+        (-29, get_status_message_template(node_ids[0], "1")),
+        (-28, unchanged),
+        (-27, get_status_message_template(node_ids[0], "2")),
+        (-26, get_register_template(node_ids[1])),
+        (-25, get_status_message_template(node_ids[1], "3")),
+        (-24, unchanged),
+        (-23, get_detection_message_template(node_ids[0], "1", "1")),
+        (1, get_detection_message_template(node_ids[0], "2", "1")),
+        (2, get_status_message_template(node_ids[1], "5")),
+        (120, get_detection_message_template(node_ids[0], "3", "1")),
+    ]
+    db_saver = SqliteSaver(replay_test_config["filename"], True)
+    db_saver.insert_connection(
+        ConnectionRecord(id=1, type="CHILD", format="PROTO", peer="127.0.0.1:1", time=start_time)
+    )
+    msg_list = []
+    for i, (seconds, msg) in enumerate(messages):
+        raw_message = ReceivedDataRecord(
+            connection_id=1,
+            message_id=i,
+            timestamp=start_time + timedelta(seconds=seconds),
+            data_bytes=ParseDict(msg, SapientMessage()).SerializeToString(),
+        )
+        msg_list.append(
+            parse_proto(
+                msg_data=raw_message,
+                validator=validator,
+                generator=id_generator,
+                enable_message_conversion=True,
+            )
+        )
+    db_saver.insert_message_multi(msg_list)
+    db_saver.close()
+
+    config = replay_test_config.copy()
+    config["start_time"] = datetime_to_str(start_time)
+    config["end_time"] = datetime_to_str(start_time + timedelta(seconds=60))
+    database = Database(config)
+    database.connect()
+    try:
+        message_format = MessageFormat[config["format"]]
+        initial = [msg.data for msg in database.get_initial_messages(message_format)]
+        replayed = [msg.data for msg in database.get_messages(message_format)]
+    finally:
+        database.close()
+
+    def msg_data(i):
+        if message_format == MessageFormat.PROTO:
+            return msg_list[i].data_binary_proto
+        return msg_list[i].data_decoded_xml
+
+    # The first status report and unchanged report of the first node are superseded
+    assert sorted(initial) == sorted(msg_data(i) for i in (0, 3, 4, 5, 6))
+    assert replayed == [msg_data(8), msg_data(9)]
+
+
+async def test_send_blocks_coalesces(autojump_clock):
+    """Messages due at nearly the same time are sent with a single write."""
+    sent = []
+
+    class RecordingConnection:
+        async def send_messages(self, messages):
+            sent.append((trio.current_time(), [msg.data for msg in messages]))
+
+    start_time = datetime(2024, 1, 1)
+    sleeper = Sleeper({"start_time": datetime_to_str(start_time), "speed_multiplier": 2})
+    blocks_send, blocks_receive = trio.open_memory_channel(1)
+
+    def message(seconds: float, data: bytes):
+        timestamp = datetime_to_int(start_time + timedelta(seconds=seconds))
+        return ReplayMessage(timestamp, data, "1", "detection_report")
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(send_blocks, blocks_receive, RecordingConnection(), sleeper, 0.01)
+        async with blocks_send:
+            await blocks_send.send([message(0, b"a"), message(0.01, b"b")])
+            await blocks_send.send([message(0.015, b"c"), message(1, b"d")])
+
+    assert [msg_data_list for _, msg_data_list in sent] == [[b"a", b"b", b"c"], [b"d"]]
+    assert sent[1][0] - sent[0][0] == pytest.approx(0.5)
+    assert sleeper.stats.message_count == 4
+    assert sleeper.stats.send_count == 2
+
+
+async def test_send_blocks_max_speed(autojump_clock):
+    """In max speed mode messages are sent without waiting, and tracked for latency."""
+    sent = []
+
+    class RecordingConnection:
+        async def send_messages(self, messages):
+            sent.append([msg.data for msg in messages])
+
+    sleeper = Sleeper(
+        {"start_time": "2024-01-01T00:00:00Z", "speed_multiplier": 1, "max_speed": True}
+    )
+    tracker = LatencyTracker()
+    start = trio.current_time()
+    blocks_send, blocks_receive = trio.open_memory_channel(2)
+    async with blocks_send:
+        await blocks_send.send([ReplayMessage(0, b"a", "1", "registration")])
+        await blocks_send.send(
+            [
+                ReplayMessage(10_000_000, b"b", "1", "detection_report"),
+                ReplayMessage(20_000_000, b"c", "1", "detection_report"),
+            ]
+        )
+    await send_blocks(blocks_receive, RecordingConnection(), sleeper, 0.01, tracker)
+
+    assert sent == [[b"a"], [b"b", b"c"]]
+    assert trio.current_time() == start
+    assert tracker.sent_count == 3
+
+    tracker.on_received(("1", "detection_report"), start + 0.002)
+    tracker.on_received(("1", "registration"), start + 0.004)
+    tracker.on_received(("2", "registration"), start + 0.004)
+    assert tracker.latencies == pytest.approx([0.002, 0.004])
+    assert (tracker.pending_count, tracker.unmatched_count) == (1, 1)
+    assert "p50: 3.0ms" in str(tracker)
+
+
+async def test_multiple_connections(tmp_path):
+    """Each recorded connection is replayed on its own connection, to the configured port."""
+    start_time = datetime.utcnow() - timedelta(seconds=60)
+    validator = Validator(ValidationOptions())
+    node_ids = [str(uuid.uuid4()) for _ in range(3)]
+    db_saver = SqliteSaver(str(tmp_path / "multi.sqlite"), True)
+    for connection_id, client_type in ((1, "CHILD"), (2, "CHILD"), (3, "CHILD"), (4, "PEER")):
+        db_saver.insert_connection(
+            ConnectionRecord(
+                id=connection_id,
+                type=client_type,
+                format="PROTO",
+                peer=f"127.0.0.1:{connection_id}",
+                time=start_time - timedelta(seconds=30),
+            )
+        )
+    db_saver.update_disconnection(
+        DisconnectionRecord(connection_id=3, time=start_time - timedelta(seconds=1), reason="")
+    )
+    messages = [
+        # (connection ID, seconds from start, message)
+        (1, -20, get_register_template(node_ids[0])),
+        (2, -19, get_register_template(node_ids[1])),
+        (3, -18, get_register_template(node_ids[2])),
+        (4, -17, get_register_template(str(uuid.uuid4()))),
+        (1, 0.1, get_detection_message_template(node_ids[0], "1", "1")),
+        (2, 0.2, get_detection_message_template(node_ids[1], "2", "1")),
+        (1, 0.3, get_detection_message_template(node_ids[0], "3", "1")),
+        (4, 0.4, get_detection_message_template(node_ids[1], "4", "1")),
+    ]
+    msg_list = []
+    for i, (connection_id, seconds, msg) in enumerate(messages):
+        raw_message = ReceivedDataRecord(
+            connection_id=connection_id,
+            message_id=i,
+            timestamp=start_time + timedelta(seconds=seconds),
+            data_bytes=ParseDict(msg, SapientMessage()).SerializeToString(),
+        )
+        msg_list.append(
+            parse_proto(
+                msg_data=raw_message,
+                validator=validator,
+                generator=id_generator,
+                enable_message_conversion=True,
+            )
+        )
+    db_saver.insert_message_multi(msg_list)
+    db_saver.close()
+
+    received = []
+
+    async def receive(stream: trio.SocketStream):
+        messages_bytes = []
+        received.append(messages_bytes)
+        read_buffer = bytearray()
+        try:
+            while True:
+                messages_bytes.append(await read_proto_message(stream, read_buffer))
+        except EOFError:
+            pass
+
+    async with trio.open_nursery() as nursery:
+        listeners = await nursery.start(trio.serve_tcp, receive, 0)
+        port = listeners[0].socket.getsockname()[1]
+        config = {
+            "log_level": "INFO",
+            "filename": str(tmp_path / "multi.sqlite"),
+            "host": "127.0.0.1",
+            "start_time": datetime_to_str(start_time),
+            "end_time": datetime_to_str(start_time + timedelta(seconds=1)),
+            "speed_multiplier": 10,
+            "connections": [{"type": "Child", "format": "PROTO", "port": port}],
+        }
+        await start_replayer(config)
+        nursery.cancel_scope.cancel()
+
+    def msg_data(i):
+        return msg_list[i].data_binary_proto
+
+    # Connection 3 was closed before the start time, and there is no Peer port configured
+    assert sorted(received) == sorted(
+        [[msg_data(0), msg_data(4), msg_data(6)], [msg_data(1), msg_data(5)]]
+    )
+
+
+def test_rolled_over_files(tmp_path, monkeypatch):
+    """Replay continues from one file to the next after a rollover, without replaying the messages
+    copied into the new file."""
+    start_time = datetime.utcnow() - timedelta(seconds=60)
+    validator = Validator(ValidationOptions())
+    node_id = str(uuid.uuid4())
+    messages = [
+        # (seconds from start, message)
+        (-30, get_register_template(node_id)),
+        (-20, get_status_message_template(node_id, "1")),
+        (1, get_detection_message_template(node_id, "1", "1")),
+        (2, get_detection_message_template(node_id, "2", "1")),
+        (3, get_detection_message_template(node_id, "3", "1")),
+        (4, get_detection_message_template(node_id, "4", "1")),
+    ]
+    msg_list = []
+    for i, (seconds, msg) in enumerate(messages):
+        raw_message = ReceivedDataRecord(
+            connection_id=1,
+            message_id=i,
+            timestamp=start_time + timedelta(seconds=seconds),
+            data_bytes=ParseDict(msg, SapientMessage()).SerializeToString(),
+        )
+        msg_list.append(
+            parse_proto(
+                msg_data=raw_message,
+                validator=validator,
+                generator=id_generator,
+                enable_message_conversion=True,
+            )
+        )
+
+    # The second file starts with copies of the registration, status and latest detection
+    db_saver = SqliteSaver(str(tmp_path / "data-1.sqlite"), True)
+    db_saver.insert_connection(
+        ConnectionRecord(id=1, type="CHILD", format="PROTO", peer="127.0.0.1:1", time=start_time)
+    )
+    db_saver.insert_message_multi(msg_list[:4])
+    new_saver = rollover(db_saver, tmp_path / "data-2.sqlite")
+    db_saver.close()
+    new_saver.insert_message_multi(msg_list[4:])
+    new_saver.close()
+
+    config = {
+        "filename": "",
+        "data_directory": str(tmp_path),
+        "start_time": datetime_to_str(start_time),
+        "end_time": datetime_to_str(start_time + timedelta(seconds=60)),
+    }
+    database = Database(config)
+    database.connect()
+    try:
+        initial = [msg.data for msg in database.get_initial_messages(MessageFormat.PROTO)]
+        replayed = [msg.data for msg in database.get_messages(MessageFormat.PROTO)]
+        connections = database.get_connections()
+    finally:
+        database.close()
+
+    def msg_data(i):
+        return msg_list[i].data_binary_proto
+
+    assert initial == [msg_data(0), msg_data(1)]
+    assert replayed == [msg_data(i) for i in range(2, 6)]
+    assert [connection.id for connection in connections] == [1]
+
+    # The time range of each file is cached, and only read again if the file changes (as it did
+    # when the replay created its indices)
+    ArchiveIndex(tmp_path).get_files()
+
+    def read_time_range(path):
+        raise AssertionError(f"{path} indexed again")
+
+    monkeypatch.setattr(ArchiveIndex, "_read_time_range", staticmethod(read_time_range))
+    files = ArchiveIndex(tmp_path).get_files_covering(
+        datetime_to_int(start_time + timedelta(seconds=3)),
+        datetime_to_int(start_time + timedelta(seconds=60)),
+    )
+    assert [os.path.basename(file.filename) for file in files] == ["data-2.sqlite"]
+
+
+def test_filters(tmp_path):
+    """Only the messages matching the configured filters are replayed, including the initial
+    messages from before the start time."""
+    start_time = datetime.utcnow() - timedelta(seconds=60)
+    validator = Validator(ValidationOptions())
+    node_ids = [str(uuid.uuid4()) for _ in range(3)]
+    messages = [
+        # (connection ID, seconds from start, message)
+        (1, -30, get_register_template(node_ids[0])),
+        (1, -29, get_status_message_template(node_ids[0], "1")),
+        (2, -28, get_register_template(node_ids[1])),
+        (2, -27, get_status_message_template(node_ids[1], "2")),
+        (2, -26, get_register_template(node_ids[2])),
+        (1, 1, get_detection_message_template(node_ids[0], "1", "1")),
+        (2, 2, get_detection_message_template(node_ids[1], "2", "1")),
+        (2, 3, get_status_message_template(node_ids[1], "3")),
+        (2, 4, get_detection_message_template(node_ids[2], "3", "1")),
+        (2, 5, get_detection_message_template(node_ids[1], "4", "1")),
+    ]
+    filename = str(tmp_path / "filters.sqlite")
+    db_saver = SqliteSaver(filename, True)
+    for connection_id in (1, 2):
+        db_saver.insert_connection(
+            ConnectionRecord(
+                id=connection_id,
+                type="CHILD",
+                format="PROTO",
+                peer=f"127.0.0.1:{connection_id}",
+                time=start_time - timedelta(seconds=60),
+            )
+        )
+    msg_list = []
+    for i, (connection_id, seconds, msg) in enumerate(messages):
+        raw_message = ReceivedDataRecord(
+            connection_id=connection_id,
+            message_id=i,
+            timestamp=start_time + timedelta(seconds=seconds),
+            data_bytes=ParseDict(msg, SapientMessage()).SerializeToString(),
+        )
+        msg_list.append(
+            parse_proto(
+                msg_data=raw_message,
+                validator=validator,
+                generator=id_generator,
+                enable_message_conversion=True,
+            )
+        )
+    db_saver.insert_message_multi(msg_list)
+    db_saver.close()
+
+    def replay(**filters):
+        config = {
+            "filename": filename,
+            "start_time": datetime_to_str(start_time),
+            "end_time": datetime_to_str(start_time + timedelta(seconds=60)),
+            **filters,
+        }
+        database = Database(config)
+        database.connect()
+        try:
+            initial = database.get_initial_messages(MessageFormat.PROTO)
+            replayed = list(database.get_messages(MessageFormat.PROTO))
+            connection_ids = [connection.id for connection in database.get_connections()]
+        finally:
+            database.close()
+        expected = {msg.data_binary_proto: i for i, msg in enumerate(msg_list)}
+        return (
+            sorted(expected[msg.data] for msg in initial),
+            [expected[msg.data] for msg in replayed],
+            connection_ids,
+        )
+
+    assert replay() == ([0, 1, 2, 3, 4], [5, 6, 7, 8, 9], [1, 2])
+    assert replay(node_ids=[node_ids[1]]) == ([2, 3], [6, 7, 9], [1, 2])
+    assert replay(message_types=["detection_report"]) == ([], [5, 6, 8, 9], [1, 2])
+    assert replay(connection_ids=[1]) == ([0, 1], [5], [1])
+    assert replay(node_ids=node_ids[1:], message_types=["status_report"]) == ([3], [7], [1, 2])
+
+
+def test_replay_creates_indices(tmp_path):
+    """Apex does not create the indices used to seek to the start time, which are instead created
+    when the database is first replayed."""
+    filename = str(tmp_path / "indices.sqlite")
+    db_saver = SqliteSaver(filename, True)
+    db_saver.close()
+
+    def index_names():
+        connection = Database._open(filename)
+        try:
+            return set(
+                connection.execute(
+                    text("SELECT name FROM sqlite_master WHERE type = 'index'")
+                ).scalars()
+            )
+        finally:
+            connection.close()
+
+    assert not index_names() & set(replay_indices)
+    now = datetime.utcnow()
+    database = Database(
+        {
+            "filename": filename,
+            "start_time": datetime_to_str(now),
+            "end_time": datetime_to_str(now + timedelta(seconds=60)),
+        }
+    )
+    database.connect()
+    database.close()
+    assert set(replay_indices) <= index_names()
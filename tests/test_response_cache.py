@@ -0,0 +1,94 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+from sapient_apex_api.response_cache import ResponseCache
+from sapient_apex_server.apex import app
+from tests.msg_templates import (
+    get_detection_message_template,
+    get_register_template,
+    get_status_message_template,
+    to_record,
+)
+
+
+def make_cache(ttl_seconds: float = 60.0) -> ResponseCache:
+    cache = ResponseCache(ttl_seconds)
+    cache.settle_seconds = 0.0
+    return cache
+
+
+def test_hit_and_miss():
+    cache = make_cache()
+    compute = mock.MagicMock(return_value=["a"])
+    assert cache.get(("locations", "1"), ["1"], compute) == ["a"]
+    assert cache.get(("locations", "1"), ["1"], compute) == ["a"]
+    assert cache.get(("locations", "2"), ["2"], compute) == ["a"]
+    assert compute.call_count == 2
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_ttl_expiry():
+    cache = make_cache(ttl_seconds=10.0)
+    compute = mock.MagicMock(return_value=["a"])
+    with mock.patch("sapient_apex_api.response_cache.time.monotonic", return_value=100.0):
+        cache.get("key", ["1"], compute)
+        cache.get("key", ["1"], compute)
+    with mock.patch("sapient_apex_api.response_cache.time.monotonic", return_value=111.0):
+        cache.get("key", ["1"], compute)
+    assert compute.call_count == 2
+
+
+def test_invalidation_by_message():
+    cache = make_cache()
+    compute = mock.MagicMock(return_value=["a"])
+    cache.get("node 1", ["1000001"], compute)
+    cache.get("node 2", ["1000002"], compute)
+    cache.get("all", ["all"], compute)
+
+    # Detections and unchanged status reports do not affect the cached responses
+    cache.on_message(to_record(get_detection_message_template("1000001", "1", "1")))
+    unchanged = get_status_message_template("1000001", "1")
+    unchanged["status_report"]["info"] = "INFO_UNCHANGED"
+    cache.on_message(to_record(unchanged))
+    assert len(cache.entries) == 3
+
+    cache.on_message(to_record(get_status_message_template("1000001", "2")))
+    assert set(cache.entries) == {"node 2"}
+    assert cache.invalidations == 2
+
+    cache.on_message(to_record(get_register_template("1000002")))
+    assert not cache.entries
+
+
+def test_not_cached_while_settling():
+    cache = ResponseCache(60.0)
+    compute = mock.MagicMock(return_value=["a"])
+    cache.invalidate("1000001")
+    cache.get("node 1", ["1000001"], compute)
+    cache.get("node 2", ["1000002"], compute)
+    assert set(cache.entries) == {"node 2"}
+
+
+def test_endpoints():
+    client = TestClient(app)
+    cache = make_cache()
+    with (
+        mock.patch("sapient_apex_api.controller.router.db_interface") as mock_db_interface,
+        mock.patch("sapient_apex_api.controller.router.response_cache", cache),
+    ):
+        mock_db_interface.get_node_definitions.return_value = []
+        for _ in range(3):
+            assert client.get("/node_definitions").status_code == 200
+        mock_db_interface.get_node_definitions.assert_called_once()
+
+        response = client.get("/cache")
+        assert response.status_code == 200
+        assert response.json() == {"hits": 2, "misses": 1, "invalidations": 0, "entries": 1}
+
+    with mock.patch("sapient_apex_api.controller.router.response_cache", None):
+        assert client.get("/cache").status_code == 503
@@ -2,14 +2,33 @@
 # Copyright (c) 2019-2024 Roke Manor Research Ltd
 #
 
+import re
 from datetime import datetime, timedelta
 from pathlib import Path
 
 from pytest import fixture
-from sqlalchemy import insert, select, update
+from sqlalchemy import insert, select, text, update
 from sqlalchemy.orm import Session
 
-from sapient_apex_server.sqlite_saver import SqliteSaver, rollover
+from sapient_apex_gui.connections.connections_query import sql_get_changed_connections
+from sapient_apex_gui.messages.messages_query import (
+    search_text_to_match,
+    sql_count_messages,
+    sql_filter_all,
+    sql_filter_connection,
+    sql_filter_connection_and_type,
+    sql_filter_search,
+    sql_get_message_payloads,
+    sql_get_messages_after,
+    sql_get_messages_before,
+)
+
+from sapient_apex_server.sqlite_saver import (
+    SqliteSaver,
+    create_search_index,
+    rollover,
+    sql_create_api_indices,
+)
 from sapient_apex_server.sqlite_schema import Connection, Message
 from sapient_apex_server.structures import SapientVersion
 
@@ -138,3 +157,172 @@ def test_rollover(database: SqliteSaver, tmp_path: Path):
         assert len(connections) == 2
         assert len(messages) == 3
         assert all(message.xml == "rollover this one" for message in messages)
+
+
+def test_api_indices(tmp_path: Path):
+    """The indices of the REST API queries are only created, including in rolled over databases,
+    when the REST API is answered from SQLite."""
+    api_index_names = {
+        re.search(r"INDEX IF NOT EXISTS (\w+)", statement).group(1)
+        for statement in sql_create_api_indices
+    }
+
+    def index_names(saver: SqliteSaver) -> set:
+        return set(
+            saver.connection.execute(
+                text("SELECT name FROM sqlite_master WHERE type = 'index'")
+            ).scalars()
+        )
+
+    saver = SqliteSaver(str(tmp_path / "without.sqlite"), True)
+    assert not index_names(saver) & api_index_names
+    saver.close()
+    saver = SqliteSaver(str(tmp_path / "with.sqlite"), True, api_indices=True)
+    assert api_index_names <= index_names(saver)
+    new_saver = rollover(saver, tmp_path / "rolled_over.sqlite", api_indices=True)
+    saver.close()
+    assert api_index_names <= index_names(new_saver)
+    new_saver.close()
+
+
+def test_gui_message_pages(database: SqliteSaver):
+    """The GUI messages tab pages through messages by ID, using indices rather than sorting."""
+    connection = database.connection
+    (asm_id,) = connection.execute(
+        select(Connection.id).where(Connection.client_type == "ASM")
+    ).one()
+
+    def get_ids(query: str, **params):
+        params = {"count_per_page": 2, **params}
+        rows = connection.execute(text(query), params).all()
+        plan = connection.execute(text("EXPLAIN QUERY PLAN " + query), params).all()
+        assert not any("TEMP B-TREE" in row.detail for row in plan)
+        return [row.id for row in rows]
+
+    all_ids = get_ids(sql_get_messages_after(sql_filter_all), after_id=0, count_per_page=10)
+    asm_ids = [message_id for message_id in all_ids if message_id != all_ids[1]]
+    after, before = (
+        sql_get_messages_after(sql_filter_connection),
+        sql_get_messages_before(sql_filter_connection),
+    )
+    assert get_ids(after, connection_id=asm_id, after_id=0) == asm_ids[:2]
+    assert get_ids(after, connection_id=asm_id, after_id=asm_ids[1]) == asm_ids[2:]
+    assert get_ids(before, connection_id=asm_id, before_id=2**63 - 1) == asm_ids[:0:-1]
+    assert get_ids(before, connection_id=asm_id, before_id=asm_ids[1]) == asm_ids[:1]
+    assert (
+        get_ids(
+            sql_get_messages_after(sql_filter_connection_and_type),
+            connection_id=asm_id,
+            parsed_type="detection_report",
+            after_id=0,
+        )
+        == asm_ids[1:]
+    )
+    assert connection.execute(
+        text(sql_count_messages(sql_filter_connection)), {"connection_id": asm_id}
+    ).scalar() == len(asm_ids)
+    payloads = connection.execute(text(sql_get_message_payloads), {"id": asm_ids[0]}).one()
+    assert (payloads.xml, payloads.proto) == ("rollover this one", b"Some bytes")
+
+
+def test_gui_message_search(database: SqliteSaver):
+    """The search index is built for existing messages, kept up to date as more are inserted, and
+    read in ID order so that search results are paged without sorting."""
+    connection = database.connection
+    create_search_index(connection)
+    (asm_id,) = connection.execute(
+        select(Connection.id).where(Connection.client_type == "ASM")
+    ).one()
+    connection.execute(
+        insert(Message).values(
+            [
+                {
+                    "connection_id": asm_id,
+                    "timestamp_received": 1,
+                    "timestamp_decoded": 1,
+                    "timestamp_saved": 1,
+                    "sapient_version": SapientVersion.LATEST,
+                    "xml": "",
+                    "proto": b"",
+                    "json": json_text,
+                    "forwarded_count": 0,
+                }
+                for json_text in (
+                    '{"detectionReport": {"objectId": "01HX-ABC", "classification": "Human"}}',
+                    '{"statusReport": {"system": "OK"}}',
+                    '{"detectionReport": {"objectId": "01HX-DEF", "classification": "Human"}}',
+                )
+            ]
+        )
+    )
+    search_filter = f"{sql_filter_connection} AND {sql_filter_search}"
+
+    def get_ids(query: str, search_text: str, **params):
+        params = {
+            "count_per_page": 10,
+            "connection_id": asm_id,
+            "search": search_text_to_match(search_text),
+            **params,
+        }
+        rows = connection.execute(text(query), params).all()
+        plan = connection.execute(text("EXPLAIN QUERY PLAN " + query), params).all()
+        assert not any("TEMP B-TREE" in row.detail for row in plan)
+        return [row.id for row in rows]
+
+    after = sql_get_messages_after(search_filter, is_search=True)
+    before = sql_get_messages_before(search_filter, is_search=True)
+    human_ids = get_ids(after, "human", after_id=0)
+    assert len(human_ids) == 2
+    assert get_ids(after, "human", after_id=human_ids[0]) == human_ids[1:]
+    assert get_ids(before, "human", before_id=2**63 - 1) == human_ids[::-1]
+    assert get_ids(after, "01HX-DEF", after_id=0) == human_ids[1:]
+    assert get_ids(after, "detectionReport OK", after_id=0) == []
+    assert get_ids(after, '"statusReport" OR "01HX-ABC"', after_id=0) == [
+        human_ids[0],
+        human_ids[0] + 1,
+    ]
+    assert (
+        connection.execute(
+            text(sql_count_messages(search_filter, is_search=True)),
+            {"connection_id": asm_id, "search": search_text_to_match("human")},
+        ).scalar()
+        == 2
+    )
+
+
+def test_gui_changed_connections(database: SqliteSaver):
+    """The GUI connections tab only rereads the connections that have changed since last time."""
+    connection = database.connection
+
+    def get_changed(last_message_id: int, last_connection_id: int, open_ids=()):
+        params = {
+            "last_message_id": last_message_id,
+            "last_connection_id": last_connection_id,
+            **{f"open{i}": open_id for i, open_id in enumerate(open_ids)},
+        }
+        rows = connection.execute(text(sql_get_changed_connections(len(open_ids))), params)
+        return {row.client_type: row for row in rows}
+
+    changed = get_changed(0, 0)
+    assert {client_type: row.new_msg_count for client_type, row in changed.items()} == {
+        "ASM": 3,
+        "Fusion": 1,
+    }
+    asm_id, fusion_id = changed["ASM"].id, changed["Fusion"].id
+    last_message_id = max(row.max_new_msg_id for row in changed.values())
+    last_connection_id = max(asm_id, fusion_id)
+
+    # Both are still open, so are reread, but have no new messages
+    changed = get_changed(last_message_id, last_connection_id, [asm_id, fusion_id])
+    assert {client_type: row.new_msg_count for client_type, row in changed.items()} == {
+        "ASM": None,
+        "Fusion": None,
+    }
+
+    # The disconnection is seen once, as the connection was open at the previous query
+    connection.execute(
+        update(Connection).where(Connection.id == fusion_id).values(disconnect_time=1)
+    )
+    changed = get_changed(last_message_id, last_connection_id, [asm_id, fusion_id])
+    assert changed["Fusion"].disconnect_time == 1
+    assert set(get_changed(last_message_id, last_connection_id, [asm_id])) == {"ASM"}
@@ -0,0 +1,244 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest import mock
+
+from fastapi.testclient import TestClient
+from google.protobuf.json_format import ParseDict
+from pytest import fixture
+
+from sapient_apex_api.interface.sqlite_interface import SqliteInterface
+from sapient_apex_api.response_models import DetectionSource
+from sapient_apex_server.apex import app
+from sapient_apex_server.sqlite_saver import SqliteSaver, rollover
+from sapient_apex_server.structures import ConnectionRecord, ReceivedDataRecord
+from sapient_apex_server.time_util import datetime_to_str
+from sapient_apex_server.translator.id_generator import IdGenerator
+from sapient_apex_server.validate_proto import ValidationOptions, Validator
+from sapient_msg.latest.sapient_message_pb2 import SapientMessage
+from tests.msg_templates import (
+    get_detection_message_template,
+    get_register_template,
+    get_status_message_template,
+)
+from tests.test_msg_parsing import parse_proto_partial as parse_proto
+
+NODE_IDS = ["1000001", "1000002"]
+
+
+def save_messages(db_saver: SqliteSaver, messages: list[dict], first_id: int = 0):
+    validator = Validator(ValidationOptions())
+    id_generator = IdGenerator({})
+    msg_list = []
+    for i, msg in enumerate(messages, start=first_id):
+        raw_message = ReceivedDataRecord(
+            connection_id=1,
+            message_id=i,
+            timestamp=datetime.utcnow(),
+            data_bytes=ParseDict(msg, SapientMessage()).SerializeToString(),
+        )
+        msg_list.append(
+            parse_proto(
+                msg_data=raw_message,
+                validator=validator,
+                generator=id_generator,
+                enable_message_conversion=True,
+            )
+        )
+    db_saver.insert_message_multi(msg_list)
+
+
+def with_timestamp(msg: dict, timestamp: datetime) -> dict:
+    msg["timestamp"] = datetime_to_str(timestamp)
+    return msg
+
+
+@fixture
+def start_time() -> datetime:
+    return datetime.utcnow() - timedelta(seconds=60)
+
+
+@fixture
+def db_saver(tmp_path: Path, start_time: datetime):
+    db_saver = SqliteSaver(str(tmp_path / "current.sqlite"), True, api_indices=True)
+    db_saver.insert_connection(
+        ConnectionRecord(id=1, type="CHILD", format="PROTO", peer="127.0.0.1:1", time=start_time)
+    )
+
+    messages = []
+    for node_id in NODE_IDS:
+        messages.append(with_timestamp(get_register_template(node_id), start_time))
+        for i in range(3):
+            status = get_status_message_template(node_id, str(i))
+            status["status_report"]["node_location"]["x"] = i
+            messages.append(with_timestamp(status, start_time + timedelta(seconds=i)))
+        for i in range(5):
+            detection = get_detection_message_template(node_id, str(i), "1")
+            detection["detection_report"]["detection_confidence"] = i / 5
+            messages.append(with_timestamp(detection, start_time + timedelta(seconds=10 + i)))
+    # A more recent registration for the first node replaces the original one
+    registration = get_register_template(NODE_IDS[0])
+    registration["registration"]["name"] = "Re-registered"
+    messages.append(with_timestamp(registration, start_time + timedelta(seconds=30)))
+    save_messages(db_saver, messages)
+
+    yield db_saver
+
+    db_saver.close()
+
+
+@fixture
+def interface(db_saver: SqliteSaver):
+    interface = SqliteInterface(db_saver.engine.url.database)
+    yield interface
+    interface.stop()
+    interface.join()
+
+
+def get_detections(interface: SqliteInterface, **kwargs):
+    args = {
+        "node_ids": ["all"],
+        "detection_source": DetectionSource.all,
+        "detection_confidence": 0.0,
+        "detection_classification": "",
+        "detection_from": datetime.min,
+        "detection_to": datetime.min,
+        "detection_interval": timedelta(0),
+        "detection_count": 10,
+    }
+    args.update(kwargs)
+    return interface.get_detections(**args)
+
+
+def get_detection_page(interface: SqliteInterface, **kwargs):
+    args = {
+        "node_ids": ["all"],
+        "detection_source": DetectionSource.all,
+        "detection_confidence": 0.0,
+        "detection_classification": "",
+        "detection_from": datetime.min,
+        "detection_to": datetime.min,
+        "page_size": 3,
+    }
+    args.update(kwargs)
+    return interface.get_detection_page(**args)
+
+
+def test_latest_registrations(interface: SqliteInterface):
+    registrations = interface.get_latest_registration_messages()
+    assert sorted(r["node_id"] for r in registrations) == NODE_IDS
+    names = {r["node_id"]: r["message"]["name"] for r in registrations}
+    assert names == {NODE_IDS[0]: "Re-registered", NODE_IDS[1]: "Test Radar"}
+    assert sorted(interface.get_registered_node_ids()) == NODE_IDS
+
+    definitions = interface.get_node_definitions()
+    assert all(d.node_definition[0].node_sub_type == ["Test Radar"] for d in definitions)
+
+
+def test_latest_status_report(interface: SqliteInterface, start_time: datetime):
+    node_id, timestamp, message = interface.get_latest_status_report_message(NODE_IDS[1])
+    assert node_id == NODE_IDS[1]
+    assert timestamp == datetime_to_str(start_time + timedelta(seconds=2))
+    assert message["node_location"]["x"] == 2
+
+    assert interface.get_latest_status_report_message("unknown") == ("", "", {})
+
+    locations = interface.get_locations(["all"])
+    assert sorted(location.node_id for location in locations) == NODE_IDS
+    assert all(location.node_location.x == 2 for location in locations)
+    assert len(interface.get_field_of_views([NODE_IDS[0]])) == 1
+
+
+def test_detections(interface: SqliteInterface, start_time: datetime):
+    assert len(get_detections(interface)) == 8  # Zero confidence is not above the 0.0 threshold
+    assert len(get_detections(interface, detection_count=2)) == 4
+    assert len(get_detections(interface, detection_confidence=0.5)) == 4
+    assert len(get_detections(interface, node_ids=[NODE_IDS[0]])) == 4
+    assert len(get_detections(interface, detection_classification="Air Vehicle")) == 8
+    assert len(get_detections(interface, detection_classification="Human")) == 0
+    assert len(get_detections(interface, detection_source=DetectionSource.fused)) == 0
+
+    detections = get_detections(
+        interface,
+        detection_from=start_time + timedelta(seconds=12),
+        detection_to=start_time + timedelta(seconds=13),
+    )
+    assert sorted(d.detection_report["report_id"] for d in detections) == ["2", "2", "3", "3"]
+    assert len(get_detections(interface, detection_interval=timedelta(seconds=1))) == 0
+
+
+def test_detection_pages(interface: SqliteInterface, start_time: datetime):
+    detections, cursor = get_detection_page(interface)
+    pages = [detections]
+    while cursor is not None:
+        detections, cursor = get_detection_page(interface, cursor=cursor)
+        pages.append(detections)
+    # 10 detections in pages of 3 (the zero confidence ones being filtered out of their pages)
+    assert [len(page) for page in pages] == [1, 3, 3, 1]
+    timestamps = [d.timestamp for page in pages for d in page]
+    assert timestamps == sorted(timestamps)
+
+    detections = list(
+        interface.iter_detections(
+            node_ids=[NODE_IDS[1]],
+            detection_source=DetectionSource.all,
+            detection_confidence=0.0,
+            detection_classification="",
+            detection_from=start_time + timedelta(seconds=11),
+            detection_to=start_time + timedelta(seconds=13),
+            page_size=2,
+        )
+    )
+    assert [d.detection_report["report_id"] for d in detections] == ["1", "2", "3"]
+    assert {d.node_id for d in detections} == {NODE_IDS[1]}
+
+
+def test_search(interface: SqliteInterface):
+    results = interface.search(
+        "messages", {"message_type": "detection_report"}, sort=["timestamp:asc"], size=3
+    )
+    assert [r["message"]["report_id"] for r in results] == ["0", "0", "1"]
+    results = list(interface.scan("messages", {"node_id": NODE_IDS[0]}))
+    assert len(results) == 1 + 3 + 5 + 1
+
+
+def test_follows_rollover(interface: SqliteInterface, db_saver: SqliteSaver, tmp_path: Path):
+    new_saver = rollover(db_saver, tmp_path / "next.sqlite")
+    try:
+        save_messages(new_saver, [get_status_message_template(NODE_IDS[0], "new")], first_id=100)
+        _, _, message = interface.get_latest_status_report_message(NODE_IDS[0])
+        assert message["report_id"] == "new"
+        assert interface.filename == str((tmp_path / "next.sqlite").absolute())
+    finally:
+        new_saver.close()
+
+
+def test_endpoints(interface: SqliteInterface):
+    client = TestClient(app)
+    with mock.patch("sapient_apex_api.controller.router.db_interface", interface):
+        response = client.get("/registered")
+        assert response.status_code == 200
+        assert sorted(response.json()) == NODE_IDS
+
+        response = client.get("/detections", params={"detection_confidence": 0.5})
+        assert response.status_code == 200
+        assert len(response.json()) == 4
+
+        response = client.get("/detections/page", params={"page_size": 6})
+        assert response.status_code == 200
+        assert len(response.json()["detections"]) == 4
+        cursor = response.json()["next_cursor"]
+        response = client.get("/detections/page", params={"page_size": 6, "cursor": cursor})
+        assert len(response.json()["detections"]) == 4
+        assert response.json()["next_cursor"] is None
+
+        response = client.get("/detections/page", params={"cursor": "not a cursor"})
+        assert response.status_code == 400
+
+        response = client.get("/detections/export", params={"page_size": 3})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        assert len(response.text.splitlines()) == 8
@@ -0,0 +1,97 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+import asyncio
+import time
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+from sapient_apex_api.response_models import StreamMessageType
+from sapient_apex_api.streaming import MessageBroadcaster, StreamFilter
+from sapient_apex_server.apex import app
+from sapient_apex_server.structures import MessageRecord
+from tests.msg_templates import (
+    get_alert_message_template,
+    get_detection_message_template,
+    get_register_template,
+    get_status_message_template,
+    to_record,
+)
+
+
+def detection(node_id: str, report_id: str, confidence: float = 0.9) -> MessageRecord:
+    msg = get_detection_message_template(node_id, report_id, "1")
+    msg["detection_report"]["detection_confidence"] = confidence
+    return to_record(msg)
+
+
+def test_filters():
+    async def run():
+        broadcaster = MessageBroadcaster()
+        everything = broadcaster.subscribe(StreamFilter(["all"], list(StreamMessageType)))
+        confident = broadcaster.subscribe(
+            StreamFilter(["1000002"], [StreamMessageType.detection_report], 0.5)
+        )
+
+        broadcaster.publish(to_record(get_register_template("1000001")))
+        broadcaster.publish(to_record(get_status_message_template("1000001", "1")))
+        broadcaster.publish(to_record(get_alert_message_template("1000001", "1")))
+        broadcaster.publish(detection("1000001", "1"))
+        broadcaster.publish(detection("1000002", "2", confidence=0.2))
+        broadcaster.publish(detection("1000002", "3", confidence=0.7))
+
+        types = [(await everything.get())["message_type"] for _ in range(5)]
+        assert types == ["status_report", "alert"] + ["detection_report"] * 3
+        assert not everything.queue
+
+        document = await confident.get()
+        assert document["node_id"] == "1000002"
+        assert document["message"]["report_id"] == "3"
+        assert not confident.queue
+
+    asyncio.run(run())
+
+
+def test_drop_oldest():
+    async def run():
+        broadcaster = MessageBroadcaster(queue_size=3)
+        subscriber = broadcaster.subscribe(StreamFilter(["all"], list(StreamMessageType)))
+        for i in range(5):
+            broadcaster.publish(detection("1000001", str(i)))
+
+        assert subscriber.dropped_count == 2
+        report_ids = [(await subscriber.get())["message"]["report_id"] for _ in range(3)]
+        assert report_ids == ["2", "3", "4"]
+
+        broadcaster.unsubscribe(subscriber)
+        broadcaster.publish(detection("1000001", "5"))
+        assert not subscriber.queue
+
+    asyncio.run(run())
+
+
+def test_websocket():
+    broadcaster = MessageBroadcaster()
+    client = TestClient(app)
+    with mock.patch("sapient_apex_api.controller.router.broadcaster", broadcaster):
+        with client.websocket_connect("/stream?message_types=alert") as websocket:
+            for _ in range(100):
+                if broadcaster.subscribers:
+                    break
+                time.sleep(0.01)
+            broadcaster.publish(detection("1000001", "1"))
+            broadcaster.publish(to_record(get_alert_message_template("1000001", "2")))
+            document = websocket.receive_json()
+            assert document["message_type"] == "alert"
+            assert document["message"]["alert_id"] == "2"
+
+    assert not broadcaster.subscribers
+
+
+def test_events_unavailable():
+    client = TestClient(app)
+    with mock.patch("sapient_apex_api.controller.router.broadcaster", None):
+        response = client.get("/stream/events")
+        assert response.status_code == 503
@@ -0,0 +1,143 @@
+#
+# Copyright (c) 2019-2024 Roke Manor Research Ltd
+#
+
+import trio
+import trio.testing
+
+from sapient_apex_server.trio_util import (
+    BufferedWriter,
+    SlowConsumerPolicy,
+    WritePriority,
+)
+
+
+async def _receive_exactly(stream: trio.abc.ReceiveStream, size: int) -> bytes:
+    received = bytearray()
+    while len(received) < size:
+        received.extend(await stream.receive_some())
+    return bytes(received)
+
+
+async def test_buffered_writer_socket():
+    """Queued messages are written in order, including ones only partly written by one sendmsg()
+    call, and the same buffer can be queued more than once (as when forwarded to several
+    connections)."""
+    left, right = trio.socket.socketpair()
+    send_stream, receive_stream = trio.SocketStream(left), trio.SocketStream(right)
+    writer = BufferedWriter(send_stream, max_data=100 * 1024 * 1024)
+    assert writer.socket is not None
+    shared = bytes(range(256)) * 4096  # 1MB, much larger than the socket buffer
+    messages = [b"first", shared, b"middle", shared] + [b"%d" % i for i in range(2000)]
+    expected = b"".join(messages)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(writer.perform_writes)
+        for message in messages:
+            writer.write_nowait(message)
+        assert await _receive_exactly(receive_stream, len(expected)) == expected
+        await trio.testing.wait_all_tasks_blocked()
+        assert writer.buffered_size == 0 and not any(writer.queues)
+        nursery.cancel_scope.cancel()
+
+
+async def test_buffered_writer_full():
+    """Writes to a stream without a socket are joined, and exceeding the limit is an error."""
+    send_stream, receive_stream = trio.testing.memory_stream_pair()
+    writer = BufferedWriter(send_stream, max_data=10)
+    assert writer.socket is None
+    writer.write_nowait(b"abc")
+    writer.write_nowait(b"def")
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(writer.perform_writes)
+        assert await _receive_exactly(receive_stream, 6) == b"abcdef"
+        nursery.cancel_scope.cancel()
+    # Once perform_writes() has stopped, the writer is closed and ignores further writes
+    writer.write_nowait(b"more")
+    assert writer.buffered_size == 0 and isinstance(writer.exception, RuntimeError)
+
+    writer = BufferedWriter(send_stream, max_data=10)
+    writer.write_nowait(b"too much data")
+    try:
+        await writer.perform_writes()
+    except RuntimeError as e:
+        assert "Send buffer full" in str(e)
+    else:
+        assert False, "Expected RuntimeError"
+
+
+async def test_buffered_writer_drop():
+    """With the DROP policy, a full queue keeps the latest message with each coalesce key, then
+    drops the oldest droppable messages, but keeps the others."""
+    send_stream, receive_stream = trio.testing.memory_stream_pair()
+    writer = BufferedWriter(send_stream, max_data=20, policy=SlowConsumerPolicy.DROP)
+    writer.write_nowait(b"<reg>")
+    writer.write_nowait(b"<s1>", coalesce_key="node")
+    writer.write_nowait(b"<det1>", droppable=True)
+    writer.write_nowait(b"<task>", priority=WritePriority.HIGH)  # Over the limit: drops det1
+    writer.write_nowait(b"<s2>", coalesce_key="node")
+    writer.write_nowait(b"<det2>", droppable=True)  # Over the limit: coalesces s1, drops det2
+    assert (writer.dropped_count, writer.coalesced_count) == (2, 1)
+    assert writer.buffered_size == len(b"<task><reg><s2>")
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(writer.perform_writes)
+        assert await _receive_exactly(receive_stream, writer.buffered_size) == b"<task><reg><s2>"
+        nursery.cancel_scope.cancel()
+
+    # Messages that cannot be dropped still close the connection if there are too many
+    writer.write_nowait(b"<another registration>")
+    assert isinstance(writer.exception, RuntimeError)
+
+
+async def test_buffered_writer_priority():
+    """High priority messages are written before normal ones already queued, but only after any
+    message that has been partly written."""
+    left, right = trio.socket.socketpair()
+    send_stream, receive_stream = trio.SocketStream(left), trio.SocketStream(right)
+    writer = BufferedWriter(send_stream, max_data=100 * 1024 * 1024)
+    first, second = b"1" * 1024 * 1024, b"2" * 1024 * 1024
+    async with trio.open_nursery() as nursery:
+        writer.write_nowait(first)
+        writer.write_nowait(second)
+        nursery.start_soon(writer.perform_writes)
+        await trio.testing.wait_all_tasks_blocked()
+        assert writer.partial is not None  # The first message did not fit in the socket buffer
+        writer.write_nowait(b"task", priority=WritePriority.HIGH)
+        expected = first + b"task" + second
+        assert await _receive_exactly(receive_stream, len(expected)) == expected
+        nursery.cancel_scope.cancel()
+
+
+async def test_buffered_writer_block():
+    """With the BLOCK policy, wait_writable() waits until the queue is back within its limit."""
+    send_stream, receive_stream = trio.testing.memory_stream_pair()
+    writer = BufferedWriter(send_stream, max_data=10, policy=SlowConsumerPolicy.BLOCK)
+    writer.write_nowait(b"0123456789abcdef")
+    assert writer.exception is None
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(writer.wait_writable)
+        await trio.testing.wait_all_tasks_blocked()
+        nursery.start_soon(writer.perform_writes)
+        assert await _receive_exactly(receive_stream, 16) == b"0123456789abcdef"
+        with trio.fail_after(1):
+            await writer.wait_writable()
+        nursery.cancel_scope.cancel()
+
+
+async def test_buffered_writer_block_closed():
+    """If the stream of a BLOCK writer is closed while it is over its limit, tasks waiting in
+    wait_writable() are woken rather than waiting forever."""
+    send_stream, receive_stream = trio.testing.memory_stream_pair()
+    writer = BufferedWriter(send_stream, max_data=10, policy=SlowConsumerPolicy.BLOCK)
+    writer.write_nowait(b"0123456789abcdef")
+    with trio.fail_after(1):
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(writer.wait_writable)
+            await trio.testing.wait_all_tasks_blocked()
+            await send_stream.aclose()
+            try:
+                await writer.perform_writes()
+            except trio.ClosedResourceError:
+                pass
+            else:
+                assert False, "Expected ClosedResourceError"
+    assert isinstance(writer.exception, RuntimeError)